@@ -0,0 +1,255 @@
+"""
+API JSON de ingesta: un proceso aparte de Streamlit para POS, scripts y otros sistemas.
+
+    python api.py --secrets .streamlit/secrets.toml --puerto 8502
+
+Usa el mismo secrets.toml que la app ([db] url) y la misma capa de datos (datos.py), así que
+las escrituras siguen las mismas reglas (merge con abiertos, versiones, movimientos). Cada
+pedido HTTP es una transacción con sentencias por conjunto; no hay rerun de ningún script.
+
+Autenticación: "Authorization: Bearer <token>" contra [api] tokens:
+
+    [api]
+    tokens = [{ token = "...", nombre = "pos", locales = ["principal"] }]
+
+Endpoints (el local va en ?local= o en el cuerpo; por defecto el primero del token):
+
+    GET  /api/faltantes[?sector=Cocina]     abiertos (Pendiente/Pedido) como JSON
+    POST /api/faltantes                     {"sector", "prioridad", "items": [{"producto", "cantidad",
+                                             "unidad", "categoria", "proveedor", "notas"}, ...]}
+    POST /api/faltantes/estado              {"ids": [...], "versiones": [...]?, "estado": "Recibido"}
+                                            (solo los cambios que permite la UI, ver datos.TRANSICIONES)
+
+Los POST aceptan "Idempotency-Key": un reintento con la misma clave no vuelve a escribir.
+El esquema lo crea la app: correrla al menos una vez antes de levantar la API.
+Sirve con starlette + uvicorn, que ya vienen con Streamlit.
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import uvicorn
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DataError, IntegrityError, ProgrammingError
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from datos import (
+    LOCAL_DEFAULT, PRIORIDAD, TRANSICIONES, aplicar_entrada, importar_lote, maestro_productos, marcar_aplicada,
+    params_lote, resolver_lote,
+)
+
+API_HILOS = 4
+MAX_ITEMS = 5000
+
+
+class ErrorPedido(Exception):
+    # Error del cliente (400) con un mensaje para devolver tal cual
+    pass
+
+
+# ============================================================
+# Datos
+# ============================================================
+def leer_abiertos(engine, local: str, sector: str | None) -> list[dict]:
+    with engine.connect() as c:
+        df = pd.read_sql(text("""
+            SELECT id, creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado,
+                   notas, version
+            FROM faltantes
+            WHERE local_id = :local
+              AND estado IN ('Pendiente','Pedido')
+              AND (CAST(:sector AS sector_t) IS NULL OR sector = CAST(:sector AS sector_t))
+            ORDER BY categoria, producto
+        """), c, params={"local": local, "sector": sector})
+    df["creado_en"] = pd.to_datetime(df["creado_en"], utc=True).map(lambda t: t.isoformat())
+    return json.loads(df.to_json(orient="records", force_ascii=False))
+
+
+def unidades_validas(c) -> list[str]:
+    return [r[0] for r in c.execute(text("SELECT unnest(enum_range(NULL::unidad_t))::text"))]
+
+
+def ya_aplicada(c, clave: str | None) -> bool:
+    # Misma tabla de idempotencia que el journal write-behind. Sin clave del cliente no se registra nada
+    if not clave:
+        return False
+    return not marcar_aplicada(c, f"api:{clave}")
+
+
+def cargar_faltantes(engine, local: str, cuerpo: dict, cliente: str, clave: str | None) -> dict:
+    items = cuerpo.get("items")
+    if not isinstance(items, list) or not items:
+        raise ErrorPedido("'items' tiene que ser una lista no vacía")
+    if len(items) > MAX_ITEMS:
+        raise ErrorPedido(f"como mucho {MAX_ITEMS} items por pedido")
+    if not cuerpo.get("sector"):
+        raise ErrorPedido("falta 'sector'")
+    df = pd.DataFrame(items)
+    if "producto" not in df.columns:
+        raise ErrorPedido("cada item necesita 'producto'")
+    df["cantidad"] = pd.to_numeric(df.get("cantidad", 1), errors="coerce")
+    df = df.fillna({col: "" for col in df.columns if col != "cantidad"})
+
+    with engine.begin() as c:
+        if ya_aplicada(c, clave):
+            return {"repetido": True}
+        lote = resolver_lote(df, maestro_productos(c, local), unidades_validas(c))
+        if lote.empty:
+            return {"sumados": 0, "nuevos": 0, "ignorados": len(df)}
+        params = params_lote(lote, local, cuerpo["sector"], cuerpo.get("prioridad") or PRIORIDAD[0], cliente, "API")
+        sumados, nuevos = importar_lote(c, params)
+    return {"sumados": sumados, "nuevos": nuevos, "ignorados": len(df) - len(lote)}
+
+
+def cambiar_estados(engine, local: str, cuerpo: dict, cliente: str, clave: str | None) -> dict:
+    ids = cuerpo.get("ids")
+    if not isinstance(ids, list) or not ids or not cuerpo.get("estado"):
+        raise ErrorPedido("hacen falta 'ids' (lista) y 'estado'")
+    versiones = cuerpo.get("versiones") or [None] * len(ids)
+    if not isinstance(versiones, list) or len(versiones) != len(ids):
+        raise ErrorPedido("'versiones' tiene que ser una lista del mismo largo que 'ids'")
+    try:
+        ids = [int(i) for i in ids]
+        versiones = [None if v is None else int(v) for v in versiones]
+    except (TypeError, ValueError):
+        raise ErrorPedido("'ids' y 'versiones' tienen que ser enteros")
+    if cuerpo["estado"] not in TRANSICIONES:
+        raise ErrorPedido(f"estado inválido: {cuerpo['estado']}")
+    p = {
+        "ids": ids,
+        "versiones": versiones,
+        "estado_nuevo": cuerpo["estado"],
+        "accion": "CAMBIO_ESTADO",
+        "local": local,
+        "usuario": cliente,
+        "rol": "API",
+    }
+    with engine.begin() as c:
+        if ya_aplicada(c, clave):
+            return {"repetido": True}
+        # El estado anterior se lee (y se bloquea) acá: lo que mande el cliente no se usa para el historial
+        p["anteriores"] = dict(c.execute(text("""
+            SELECT id, estado::text FROM faltantes
+            WHERE id = ANY(CAST(:ids AS bigint[])) AND local_id = :local
+            ORDER BY id
+            FOR UPDATE
+        """), {"ids": ids, "local": local}).all())
+        faltan = sorted(set(ids) - set(p["anteriores"]))
+        if faltan:
+            raise ErrorPedido(f"no hay faltantes con esos ids en el local {local}: {faltan}")
+        invalidos = sorted(i for i, ea in p["anteriores"].items() if p["estado_nuevo"] not in TRANSICIONES.get(ea, ()))
+        if invalidos:
+            raise ErrorPedido(
+                "cambios no permitidos: "
+                + ", ".join(f"{i} ({p['anteriores'][i]} → {p['estado_nuevo']})" for i in invalidos)
+            )
+        conflictos = aplicar_entrada(c, p)
+    return {"aplicados": len(set(p["ids"])) - len(conflictos), "conflictos": conflictos}
+
+
+# ============================================================
+# HTTP
+# ============================================================
+def cliente_del_token(request: Request, tokens: list[dict]) -> dict:
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else ""
+    for t in tokens:
+        if token and hmac.compare_digest(token.encode(), str(t.get("token", "")).encode()):
+            return t
+    raise HTTPException(401, "token inválido")
+
+
+def local_pedido(request: Request, cliente: dict, cuerpo: dict | None = None) -> str:
+    permitidos = cliente.get("locales") or [LOCAL_DEFAULT]
+    local = request.query_params.get("local") or (cuerpo or {}).get("local") or permitidos[0]
+    if local not in permitidos:
+        raise HTTPException(403, f"el token no tiene acceso al local {local}")
+    return local
+
+
+async def cuerpo_json(request: Request) -> dict:
+    try:
+        cuerpo = json.loads(await request.body() or b"{}")
+    except ValueError:
+        raise HTTPException(400, "el cuerpo no es JSON")
+    if not isinstance(cuerpo, dict):
+        raise HTTPException(400, "el cuerpo tiene que ser un objeto JSON")
+    return cuerpo
+
+
+def crear_app(secrets: dict) -> Starlette:
+    engine = create_engine(
+        secrets["db"]["url"],
+        pool_pre_ping=True,
+        pool_recycle=280,
+        pool_size=API_HILOS,
+        max_overflow=0,
+    )
+    tokens = secrets.get("api", {}).get("tokens", [])
+    pool = ThreadPoolExecutor(max_workers=API_HILOS, thread_name_prefix="api")
+
+    async def correr(fn, *args):
+        # La base es bloqueante: va a un pool de hilos acotado y el loop sigue atendiendo
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, fn, engine, *args)
+        except ErrorPedido as e:
+            raise HTTPException(400, str(e))
+        except (DataError, IntegrityError, ProgrammingError) as e:
+            raise HTTPException(400, str(e.orig).strip().splitlines()[0])
+
+    async def faltantes(request: Request) -> JSONResponse:
+        cliente = cliente_del_token(request, tokens)
+        if request.method == "GET":
+            local = local_pedido(request, cliente)
+            return JSONResponse(await correr(leer_abiertos, local, request.query_params.get("sector")))
+        cuerpo = await cuerpo_json(request)
+        return JSONResponse(await correr(
+            cargar_faltantes, local_pedido(request, cliente, cuerpo), cuerpo,
+            f"api:{cliente.get('nombre', '')}", request.headers.get("Idempotency-Key"),
+        ))
+
+    async def estado(request: Request) -> JSONResponse:
+        cliente = cliente_del_token(request, tokens)
+        cuerpo = await cuerpo_json(request)
+        return JSONResponse(await correr(
+            cambiar_estados, local_pedido(request, cliente, cuerpo), cuerpo,
+            f"api:{cliente.get('nombre', '')}", request.headers.get("Idempotency-Key"),
+        ))
+
+    async def error_http(request: Request, exc: HTTPException) -> JSONResponse:
+        return JSONResponse({"error": exc.detail}, status_code=exc.status_code)
+
+    return Starlette(
+        routes=[
+            Route("/api/faltantes", faltantes, methods=["GET", "POST"]),
+            Route("/api/faltantes/estado", estado, methods=["POST"]),
+        ],
+        exception_handlers={HTTPException: error_http},
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser(description="API JSON de ingesta de faltantes")
+    ap.add_argument("--secrets", default=".streamlit/secrets.toml", help="el mismo secrets.toml de la app")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--puerto", type=int, default=8502)
+    args = ap.parse_args()
+
+    with open(args.secrets, "rb") as f:
+        secrets = tomllib.load(f)
+    if not secrets.get("api", {}).get("tokens"):
+        raise SystemExit("Falta [api] tokens en el secrets.toml: sin tokens nadie podría usar la API.")
+
+    uvicorn.run(crear_app(secrets), host=args.host, port=args.puerto, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,676 @@
 import os
+import cProfile
+import hashlib
+import hmac
+import html
+import inspect
 import io
-from datetime import datetime, date
+import json
+import pstats
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import closing, contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+from zoneinfo import ZoneInfo
 
 import pandas as pd
 import streamlit as st
-from sqlalchemy import create_engine, text
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+from datos import (
+    CATEGORIAS, ESTADOS, LOCAL_DEFAULT, PRIORIDAD, SECTORES, UNIDADES, SQL_CAMBIAR_ESTADO, SQL_IMPORTAR,
+    aplicar_entrada, cruzar_abiertos, faltantes_de_conteo, importar_lote, marcar_aplicada, params_lote,
+    resolver_lote,
+)
+
+
+# ============================================================
+# Perfil de corridas: secciones cronometradas por rerun (últimas N por proceso)
+# ============================================================
+# Cada corrida se agrega al buffer al empezar y se va completando a medida que cierran
+# sus secciones, así también quedan las que terminan con st.rerun()/st.stop().
+PERFIL_CORRIDAS = 50
+_perfil_t0 = time.perf_counter()
+
+
+@st.cache_resource
+def perfil_buffer() -> tuple[deque, threading.Lock]:
+    return deque(maxlen=PERFIL_CORRIDAS), threading.Lock()
+
+
+def _perfil_nueva_corrida() -> dict:
+    corrida = {
+        "id": uuid.uuid4().hex[:12],  # estable: la lista del Admin se rearma en cada rerun
+        "inicio": datetime.now(timezone.utc).isoformat(),
+        "usuario": None,
+        "total_ms": 0.0,
+        "sql_ms": 0.0,
+        "secciones": [],
+        "cprofile": None,
+    }
+    buf, lock = perfil_buffer()
+    with lock:
+        buf.append(corrida)
+    return corrida
+
+
+_perfil = _perfil_nueva_corrida()
+_perfil_nivel = [0]
+
+
+def registrar_seccion(nombre: str, t0: float, nivel: int | None = None):
+    fin = time.perf_counter()
+    _perfil["secciones"].append({
+        "seccion": nombre,
+        "nivel": _perfil_nivel[0] if nivel is None else nivel,
+        "inicio_ms": round((t0 - _perfil_t0) * 1000, 1),
+        "dur_ms": round((fin - t0) * 1000, 1),
+    })
+    _perfil["total_ms"] = round((fin - _perfil_t0) * 1000, 1)
+
+
+@contextmanager
+def seccion(nombre: str):
+    t0 = time.perf_counter()
+    _perfil_nivel[0] += 1
+    try:
+        yield
+    finally:
+        _perfil_nivel[0] -= 1
+        registrar_seccion(nombre, t0)
+
+
+def _perfil_cprofile_inicio():
+    # cProfile a pedido del Admin (solo el hilo del script). Si una corrida anterior terminó
+    # con st.rerun()/st.stop() antes de cerrar_corrida(), su profiler se apaga acá.
+    viejo = st.session_state.pop("_cprofile_activo", None)
+    if viejo is not None:
+        viejo.disable()
+    if st.session_state.pop("perfil_cprofile_pedido", False):
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            return  # otra sesión ya está perfilando (un solo profiler activo por proceso)
+        st.session_state["_cprofile_activo"] = prof
+
+
+def cerrar_corrida():
+    cerrar_alcance()
+    _perfil["total_ms"] = round((time.perf_counter() - _perfil_t0) * 1000, 1)
+    prof = st.session_state.pop("_cprofile_activo", None)
+    if prof is not None:
+        prof.disable()
+        salida = io.StringIO()
+        pstats.Stats(prof, stream=salida).sort_stats("cumulative").print_stats(40)
+        _perfil["cprofile"] = salida.getvalue()
+
+
+_perfil_cprofile_inicio()
 
 
 @st.cache_resource
 def get_engine():
-    return create_engine(
+    engine = create_engine(
         st.secrets["db"]["url"],
         pool_pre_ping=True,
         pool_recycle=280,
     )
+    event.listen(engine, "commit", _marcar_escritura)
+    return engine
+
+
+# Réplica de lectura opcional ([db] read_url). Sin réplica, todo va al primario.
+READ_LAG_S = float(st.secrets["db"].get("read_lag_s", 5))
+
+
+@st.cache_resource
+def get_read_engine():
+    read_url = st.secrets["db"].get("read_url")
+    if not read_url:
+        return get_engine()
+    return create_engine(
+        read_url,
+        pool_pre_ping=True,
+        pool_recycle=280,
+    )
+
+
+def _marcar_escritura(conn):
+    # Se llama en cada COMMIT del primario. pandas también commitea sus lecturas, por eso qdf
+    # marca sus conexiones como solo_lectura. Fuera de una corrida (hilos propios) no hay sesión.
+    if conn.get_execution_options().get("solo_lectura"):
+        return
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        st.session_state["_ultima_escritura"] = time.monotonic()
+
+
+def _leer_del_primario() -> bool:
+    # Read-your-writes: la sesión que acaba de escribir lee del primario un rato
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return False
+    ultima = st.session_state.get("_ultima_escritura")
+    return ultima is not None and time.monotonic() - ultima < READ_LAG_S
+
+
+# ============================================================
+# Caché compartida entre réplicas ([cache] backend = "memoria" | "postgres" | "redis")
+# st.cache_* es por proceso: lo que tiene que valer para todo el despliegue (turnos de las
+# tareas periódicas, versiones de catálogos como los enums) pasa por acá.
+# "memoria" (default) se comporta como antes; "postgres" usa la tabla cache_compartida;
+# "redis" cualquier servidor compatible ([cache] url, requiere el paquete redis).
+# ============================================================
+CACHE_CONF = dict(st.secrets.get("cache", {}))
+CACHE_BACKEND = CACHE_CONF.get("backend", "memoria")
+CACHE_REVISAR_S = float(CACHE_CONF.get("revisar_s", 5))  # cada cuánto se relee una versión compartida
+
+
+@st.cache_resource
+def cache_memoria() -> tuple[dict, threading.Lock]:
+    # clave -> (valor, vence en time.monotonic() o None)
+    return {}, threading.Lock()
+
+
+@st.cache_resource
+def cache_redis():
+    import redis  # opcional: solo hace falta con backend = "redis"
+    return redis.Redis.from_url(CACHE_CONF.get("url", "redis://localhost:6379/0"), decode_responses=True)
+
+
+@contextmanager
+def _cache_pg():
+    # Conexión propia (no la de la corrida) marcada solo_lectura: tomar un turno o publicar una
+    # versión no es una escritura del usuario y no debe mandar la sesión a leer del primario
+    with get_engine().connect() as c:
+        c.execution_options(solo_lectura=True)
+        with c.begin():
+            yield c
+
+
+def cache_get(clave: str) -> str | None:
+    if CACHE_BACKEND == "redis":
+        return cache_redis().get(clave)
+    if CACHE_BACKEND == "postgres":
+        with _cache_pg() as c:
+            return c.execute(text("""
+                SELECT valor FROM cache_compartida
+                WHERE clave = :clave AND (vence IS NULL OR vence > now())
+            """), {"clave": clave}).scalar()
+    datos, lock = cache_memoria()
+    with lock:
+        valor, vence = datos.get(clave, (None, None))
+    return valor if vence is None or vence > time.monotonic() else None
+
+
+def cache_set(clave: str, valor: str, ttl: float | None = None, solo_si_falta: bool = False) -> bool:
+    # solo_si_falta: lo escribe solo si no está (o venció); devuelve si lo escribió (sirve de turno)
+    if CACHE_BACKEND == "redis":
+        return bool(cache_redis().set(clave, valor, px=int(ttl * 1000) if ttl else None, nx=solo_si_falta))
+    if CACHE_BACKEND == "postgres":
+        with _cache_pg() as c:
+            return c.execute(text(f"""
+                INSERT INTO cache_compartida AS cc (clave, valor, vence)
+                VALUES (:clave, :valor, now() + make_interval(secs => CAST(:ttl AS double precision)))
+                ON CONFLICT (clave) DO UPDATE SET valor = EXCLUDED.valor, vence = EXCLUDED.vence
+                {"WHERE cc.vence <= now()" if solo_si_falta else ""}
+                RETURNING clave
+            """), {"clave": clave, "valor": valor, "ttl": ttl}).first() is not None
+    datos, lock = cache_memoria()
+    ahora = time.monotonic()
+    with lock:
+        _, vence = datos.get(clave, (None, ahora))
+        if solo_si_falta and clave in datos and (vence is None or vence > ahora):
+            return False
+        datos[clave] = (valor, ahora + ttl if ttl else None)
+    return True
+
+
+def cache_del(clave: str):
+    if CACHE_BACKEND == "redis":
+        cache_redis().delete(clave)
+    elif CACHE_BACKEND == "postgres":
+        with _cache_pg() as c:
+            c.execute(text("DELETE FROM cache_compartida WHERE clave = :clave"), {"clave": clave})
+    else:
+        datos, lock = cache_memoria()
+        with lock:
+            datos.pop(clave, None)
+
+
+@st.cache_resource
+def proximos_turnos() -> tuple[dict, threading.Lock]:
+    # tarea -> time.monotonic() desde el que este proceso vuelve a pedir el turno
+    return {}, threading.Lock()
+
+
+def tomar_turno(tarea: str, cada_s: float) -> bool:
+    # True para una sola réplica (y un solo proceso) cada `cada_s`: el "cron" de las tareas periódicas.
+    # Las tareas se piden en cada rerun: el proceso va al backend a lo sumo una vez por intervalo
+    proximos, lock = proximos_turnos()
+    ahora = time.monotonic()
+    with lock:
+        if ahora < proximos.get(tarea, 0):
+            return False
+        proximos[tarea] = ahora + cada_s
+    return cache_set(f"turno:{tarea}", uuid.uuid4().hex, ttl=cada_s, solo_si_falta=True)
+
+
+def soltar_turno(tarea: str):
+    cache_del(f"turno:{tarea}")
+    proximos, lock = proximos_turnos()
+    with lock:
+        proximos.pop(tarea, None)
+
+
+def en_turno(tarea: str, cada_s: float, fn, *args, sin_turno=None):
+    # Corre fn si esta réplica tiene el turno; si falla lo suelta para que se reintente en la próxima corrida
+    if not tomar_turno(tarea, cada_s):
+        return sin_turno
+    try:
+        return fn(*args)
+    except Exception:
+        soltar_turno(tarea)
+        raise
+
+
+@st.cache_resource
+def versiones_vistas() -> tuple[dict, threading.Lock]:
+    # nombre -> (versión, time.monotonic() de la lectura): evita ir al backend en cada llamada
+    return {}, threading.Lock()
+
+
+def version_compartida(nombre: str) -> str:
+    vistas, lock = versiones_vistas()
+    ahora = time.monotonic()
+    with lock:
+        vista = vistas.get(nombre)
+    if vista is not None and ahora - vista[1] < CACHE_REVISAR_S:
+        return vista[0]
+    version = cache_get(f"version:{nombre}") or "0"
+    with lock:
+        vistas[nombre] = (version, ahora)
+    return version
+
+
+def invalidar_compartida(nombre: str):
+    # Las demás réplicas lo ven en a lo sumo CACHE_REVISAR_S; este proceso, en la próxima llamada
+    cache_set(f"version:{nombre}", uuid.uuid4().hex)
+    vistas, lock = versiones_vistas()
+    with lock:
+        vistas.pop(nombre, None)
+
+
+# ============================================================
+# Consultas lentas: sobre [db] slow_ms se guarda huella, params redactados,
+# duración y plan (en un hilo aparte, siempre con ROLLBACK; EXPLAIN ANALYZE solo para lecturas)
+# ============================================================
+SLOW_MS = float(st.secrets["db"].get("slow_ms", 500))  # <= 0 desactiva
+SLOW_REPETIR_S = 60  # misma huella: como mucho un plan por minuto
 
 
-def qdf(sql: str, params: dict | None = None) -> pd.DataFrame:
-    with get_engine().connect() as conn:
-        return pd.read_sql(text(sql), conn, params=params or {})
+def huella_sql(sql: str) -> tuple[str, str]:
+    norm = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    norm = re.sub(r"(?<![\w.])\d+(?:\.\d+)?\b", "?", norm)
+    norm = re.sub(r"(?<!:):\w+", "?", norm)
+    norm = re.sub(r"\s+", " ", norm).strip()
+    return hashlib.md5(norm.encode("utf-8")).hexdigest()[:12], norm
+
+
+def _redactar(params: dict | None) -> dict:
+    # Nunca se guardan valores: solo tipo y largo
+    out = {}
+    for k, v in (params or {}).items():
+        largo = f":{len(v)}" if isinstance(v, (str, list, tuple)) else ""
+        out[k] = f"<{type(v).__name__}{largo}>"
+    return out
+
+
+@st.cache_resource
+def slow_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="slow-log")
+
+
+@st.cache_resource
+def slow_ultimas() -> tuple[dict, threading.Lock]:
+    # Última captura por huella, compartida por todas las sesiones del proceso
+    return {}, threading.Lock()
+
+
+def _capturar_lenta(engine, primario, nombre_engine: str, sql: str, params: dict | None, ms: float):
+    huella, norm = huella_sql(sql)
+    plan = ""
+    if re.match(r"\s*(select|with|insert|update|delete)\b", sql, re.I):
+        try:
+            with engine.connect() as c:
+                trans = c.begin()
+                try:
+                    # EXPLAIN ANALYZE ejecuta la sentencia: solo para lecturas puras. Las que escriben
+                    # (también un WITH con INSERT/UPDATE/DELETE o un SELECT ... FOR UPDATE) van sin ANALYZE
+                    escribe = re.search(r"\b(insert|update|delete|merge)\b", sql, re.I)
+                    explain = "EXPLAIN " if escribe else "EXPLAIN (ANALYZE, BUFFERS) "
+                    filas = c.execute(text(explain + sql), params or {}).all()
+                    plan = "\n".join(r[0] for r in filas)
+                finally:
+                    trans.rollback()
+        except Exception as e:
+            plan = f"(no se pudo obtener el plan: {e})"
+    with primario.begin() as c:
+        c.execute(text("""
+            INSERT INTO consultas_lentas (huella, sql_norm, params, duracion_ms, engine, plan)
+            VALUES (:huella, :sql_norm, CAST(:params AS jsonb), :ms, :engine, :plan)
+        """), {
+            "huella": huella,
+            "sql_norm": norm,
+            "params": json.dumps(_redactar(params)),
+            "ms": ms,
+            "engine": nombre_engine,
+            "plan": plan,
+        })
+
+
+def _registrar_si_lenta(engine, sql: str, params: dict | None, t0: float):
+    ms = (time.perf_counter() - t0) * 1000
+    if get_script_run_ctx() is not None:  # los hilos de mantenimiento no cuentan para la corrida
+        _perfil["sql_ms"] = round(_perfil["sql_ms"] + ms, 1)
+    if SLOW_MS <= 0 or ms < SLOW_MS:
+        return
+    huella, _ = huella_sql(sql)
+    ultimas, lock = slow_ultimas()
+    with lock:
+        ahora = time.monotonic()
+        if ahora - ultimas.get(huella, -SLOW_REPETIR_S) < SLOW_REPETIR_S:
+            return
+        ultimas[huella] = ahora
+    primario = get_engine()
+    nombre_engine = "primario" if engine is primario else "replica"
+    slow_pool().submit(_capturar_lenta, engine, primario, nombre_engine, sql, params, ms)
+
+
+# ============================================================
+# Conexión por corrida: el hilo del script hace un solo checkout por engine y lo reusa en todas
+# sus lecturas y unidades de trabajo (transaccion). Se devuelve al pool al terminar la corrida
+# (cerrar_corrida) o, si se cortó con st.rerun()/st.stop()/error, al arrancar la siguiente corrida
+# en ese hilo o cuando otra corrida ve el hilo ya terminado.
+# Los lectores de leer_async (compartidos entre sesiones) y los hilos propios (journal, consultas
+# lentas) siguen con un checkout por consulta: si retuvieran conexiones por corrida, unas pocas
+# sesiones a la vez dejarían el pool vacío mientras el script espera sus lecturas.
+# ============================================================
+CONEXION_POR_CORRIDA = bool(st.secrets["db"].get("conexion_por_corrida", True))
+
+
+@st.cache_resource
+def alcances() -> tuple[dict, threading.Lock]:
+    # hilo del script -> {engine id: Connection} de su corrida en curso (todas las sesiones del proceso)
+    return {}, threading.Lock()
+
+
+def _cerrar_conexiones(conns: dict):
+    for conn in conns.values():
+        try:
+            if conn.in_transaction():
+                conn.rollback()
+            conn.close()
+        except Exception:
+            pass  # conexión rota: el pool la descarta
+
+
+def abrir_alcance():
+    if not CONEXION_POR_CORRIDA or get_script_run_ctx(suppress_warning=True) is None:
+        return
+    hilo = threading.current_thread()
+    reg, lock = alcances()
+    with lock:
+        viejos = [h for h in reg if h is hilo or not h.is_alive()]
+        cerrar = [reg.pop(h) for h in viejos]
+        reg[hilo] = {}
+    for conns in cerrar:
+        _cerrar_conexiones(conns)
+
+
+def cerrar_alcance():
+    reg, lock = alcances()
+    with lock:
+        conns = reg.pop(threading.current_thread(), None)
+    if conns:
+        _cerrar_conexiones(conns)
+
+
+def _capacidad_pool(engine) -> float:
+    pool = engine.pool
+    if not hasattr(pool, "checkedout"):
+        return 0  # NullPool y similares: no hay nada que retener
+    extra = getattr(pool, "_max_overflow", 0)
+    return float("inf") if extra < 0 else pool.size() + extra
+
+
+def conexion_corrida(engine):
+    # La conexión de la corrida en curso para este hilo (None: lector, hilo propio o sin corrida)
+    reg, lock = alcances()
+    with lock:
+        conns = reg.get(threading.current_thread())
+    if conns is None:
+        return None
+    conn = conns.get(id(engine))
+    if conn is not None and not conn.closed and not conn.invalidated:
+        return conn
+    # Sin retener si el pool está casi lleno: siempre queda lugar para los lectores
+    libres_lectores = _capacidad_pool(engine) - LECTURAS_HILOS
+    if libres_lectores <= 0 or engine.pool.checkedout() >= libres_lectores:
+        return None
+    conn = engine.connect()
+    conns[id(engine)] = conn
+    return conn
+
+
+# Transacción abierta por transaccion() en este hilo: las anidadas (y las lecturas del primario
+# que corran adentro) se suman a ella aunque no haya conexión de corrida retenida
+_tx_activa = threading.local()
+
+
+@contextmanager
+def usar_conexion(engine):
+    # Lectura sobre la conexión de la corrida; si deja abierta una transacción implícita, se cierra
+    activa = getattr(_tx_activa, "conn", None)
+    if activa is not None and activa.engine is engine:
+        yield activa
+        return
+    conn = conexion_corrida(engine)
+    if conn is None:
+        with engine.connect() as conn:
+            yield conn
+        return
+    afuera = not conn.in_transaction()
+    try:
+        yield conn
+    finally:
+        if afuera and conn.in_transaction():
+            conn.rollback()
+
+
+@contextmanager
+def transaccion():
+    # Unidad de trabajo en el primario sobre la conexión de la corrida (commit al salir, rollback si falla).
+    # Anidada en otra transaccion() se suma a la de afuera.
+    activa = getattr(_tx_activa, "conn", None)
+    if activa is not None:
+        yield activa
+        return
+    engine = get_engine()
+    conn = conexion_corrida(engine)
+    if conn is None:
+        with engine.begin() as c:
+            _tx_activa.conn = c
+            try:
+                yield c
+            finally:
+                _tx_activa.conn = None
+        return
+    if conn.in_transaction():
+        yield conn
+        return
+    conn.execution_options(solo_lectura=False)
+    with conn.begin():
+        _tx_activa.conn = conn
+        try:
+            yield conn
+        finally:
+            _tx_activa.conn = None
+
+
+def tipar(df: pd.DataFrame, tipos: dict[str, str]) -> pd.DataFrame:
+    # Aplica un esquema {columna: dtype} a las columnas que estén (las demás quedan como vienen)
+    presentes = {c: t for c, t in tipos.items() if c in df.columns}
+    return df.astype(presentes) if presentes else df
+
+
+def qdf(sql: str, params: dict | None = None, primario: bool = False,
+        tipos: dict[str, str] | None = None) -> pd.DataFrame:
+    engine = get_engine() if primario or _leer_del_primario() else get_read_engine()
+    t0 = time.perf_counter()
+    with usar_conexion(engine) as conn:
+        if not conn.in_transaction():  # dentro de una transaccion() el commit es de una escritura
+            conn.execution_options(solo_lectura=True)
+        df = pd.read_sql(text(sql), conn, params=params or {})
+    _registrar_si_lenta(engine, sql, params, t0)
+    return tipar(df, tipos) if tipos else df
 
 
 def exec_(sql: str, params: dict | None = None):
-    with get_engine().begin() as conn:
+    t0 = time.perf_counter()
+    with transaccion() as conn:
         conn.execute(text(sql), params or {})
+    _registrar_si_lenta(get_engine(), sql, params, t0)
+
+
+# Lecturas en paralelo: pool de hilos por proceso, compartido por todas las sesiones.
+# leer_async() devuelve un Future; la misma función+args en la misma corrida reusa el Future.
+# Tiene un hilo por conexión que las lecturas pueden tomar (primario + réplica): con menos hilos
+# que conexiones, las lecturas de sesiones concurrentes se encolan unas detrás de otras con el
+# pool de SQLAlchemy libre. El límite real de concurrencia sigue siendo el pool de conexiones.
+LECTURAS_HILOS = 4  # conexiones que conexion_corrida() deja libres para los lectores
+LECTURAS_MAX = 64   # tope de hilos cuando el pool de conexiones no tiene límite
+_lecturas: dict = {}  # se recrea en cada corrida del script
+
+
+@st.cache_resource
+def lector_pool() -> ThreadPoolExecutor:
+    engines = {id(e): e for e in (get_engine(), get_read_engine())}.values()
+    conexiones = sum(_capacidad_pool(e) if hasattr(e.pool, "checkedout") else float("inf") for e in engines)
+    hilos = int(min(max(conexiones, LECTURAS_HILOS), LECTURAS_MAX))
+    return ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="lectura")
+
+
+def leer_async(fn, *args) -> Future:
+    clave = (fn.__name__, args)
+    if clave not in _lecturas:
+        ctx = get_script_run_ctx()
+
+        def tarea():
+            hilo = threading.current_thread()
+            add_script_run_ctx(hilo, ctx)  # permite st.* (cache, secrets, session_state) en el hilo
+            try:
+                return fn(*args)
+            finally:
+                add_script_run_ctx(hilo, None)
+
+        _lecturas[clave] = lector_pool().submit(tarea)
+    return _lecturas[clave]
+
+
+def leer(fn, *args):
+    return leer_async(fn, *args).result()
+
+
+# Dominios cerrados como enums de PostgreSQL (4 bytes por valor en filas e índices, comparación por
+# clave fija y valores inválidos rechazados). Las listas de datos.py siembran las etiquetas en su orden;
+# si se agrega un valor a una lista, el enum lo suma al arrancar.
+DOMINIOS = {
+    "estado_t": ESTADOS,
+    "prioridad_t": PRIORIDAD,
+    "sector_t": SECTORES,
+    "categoria_t": CATEGORIAS,
+    "unidad_t": UNIDADES,
+}
+_COLS_FALTANTE = {
+    "estado": "estado_t", "prioridad": "prioridad_t", "sector": "sector_t",
+    "categoria": "categoria_t", "unidad": "unidad_t",
+}
+COLUMNAS_DOMINIO = {
+    "faltantes": _COLS_FALTANTE,
+    "faltantes_historico": _COLS_FALTANTE,
+    "pedido_items": _COLS_FALTANTE,
+    "snapshot_faltantes": {c: t for c, t in _COLS_FALTANTE.items() if c != "prioridad"},
+    "movimientos": {"estado_anterior": "estado_t", "estado_nuevo": "estado_t"},
+    "productos_par": {"sector": "sector_t"},
+}
+
+
+def _literal(valor: str) -> str:
+    return "'" + valor.replace("'", "''") + "'"
+
+
+def migrar_dominios():
+    # Crea/completa los enums y pasa a enum las columnas que todavía son text. Las etiquetas que ya
+    # hubiera en la base (o en el maestro de productos) se suman al enum: la migración no pierde datos.
+    # '' y los espacios pasan a NULL. ALTER TYPE ... ADD VALUE va en su propia transacción (exec_).
+    for tipo, valores in DOMINIOS.items():
+        exec_(f"""
+            DO $$ BEGIN
+                CREATE TYPE {tipo} AS ENUM ({", ".join(_literal(v) for v in valores)});
+            EXCEPTION WHEN duplicate_object THEN NULL;
+            END $$;
+        """)
+
+    pendientes = qdf("""
+        SELECT table_name AS tabla, column_name AS columna
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND data_type = 'text'
+          AND table_name = ANY(CAST(:tablas AS text[]))
+    """, {"tablas": list(COLUMNAS_DOMINIO)}, primario=True)
+    pendientes = [
+        (t, c, COLUMNAS_DOMINIO[t][c]) for t, c in pendientes.itertuples(index=False, name=None)
+        if c in COLUMNAS_DOMINIO[t]
+    ]
+
+    querer = {tipo: list(valores) for tipo, valores in DOMINIOS.items()}
+    origenes = [(t, c, tipo) for t, c, tipo in pendientes]
+    if pendientes:
+        origenes += [("productos", "categoria", "categoria_t"), ("productos", "unidad", "unidad_t")]
+    for t, c, tipo in origenes:
+        existentes = qdf(f"SELECT DISTINCT NULLIF(trim({c}), '') AS v FROM {t}", primario=True)["v"]
+        querer[tipo] += [v for v in existentes.dropna() if v not in querer[tipo]]
+
+    actuales = qdf("""
+        SELECT t.typname AS tipo, e.enumlabel AS valor
+        FROM pg_enum e JOIN pg_type t ON t.oid = e.enumtypid
+        WHERE t.typname = ANY(CAST(:tipos AS text[]))
+    """, {"tipos": list(DOMINIOS)}, primario=True)
+    hay = set(actuales.itertuples(index=False, name=None))
+    for tipo, valores in querer.items():
+        for v in valores:
+            if (tipo, v) not in hay:
+                exec_(f"ALTER TYPE {tipo} ADD VALUE IF NOT EXISTS {_literal(v)};")
+
+    if not pendientes:
+        return
+    # Una sola reescritura por tabla; la vista faltantes_todos depende de las columnas (se recrea después)
+    with get_engine().begin() as c:
+        c.execute(text("DROP VIEW IF EXISTS faltantes_todos"))
+        for tabla in dict.fromkeys(t for t, _, _ in pendientes):
+            cambios = ", ".join(
+                f"ALTER COLUMN {col} TYPE {tipo} USING NULLIF(trim({col}), '')::{tipo}"
+                for t, col, tipo in pendientes if t == tabla
+            )
+            c.execute(text(f"ALTER TABLE {tabla} {cambios}"))
 
 
 def init_schema():
@@ -97,15 +744,403 @@ def init_schema():
         );
     """)
 
+    # Histórico: misma forma que faltantes, recibe los cerrados viejos (ver archivar_cerrados)
+    exec_("""
+        CREATE TABLE IF NOT EXISTS faltantes_historico (
+            id bigint PRIMARY KEY,
+            creado_en timestamptz NOT NULL,
+            producto text NOT NULL,
+            categoria text,
+            cantidad double precision,
+            unidad text,
+            prioridad text,
+            sector text,
+            proveedor text,
+            estado text NOT NULL,
+            notas text
+        );
+    """)
+
+    # Backend "postgres" de la caché compartida (ver cache_get/cache_set)
+    exec_("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS cache_compartida (
+            clave text PRIMARY KEY,
+            valor text NOT NULL,
+            vence timestamptz
+        );
+    """)
+
+    # Claves de idempotencia ya aplicadas (journal write-behind y API); se borran en archivar_cerrados
+    exec_("""
+        CREATE TABLE IF NOT EXISTS journal_aplicado (
+            clave text PRIMARY KEY,
+            aplicado_en timestamptz NOT NULL DEFAULT now()
+        );
+    """)
+
+    exec_("""
+        CREATE TABLE IF NOT EXISTS consultas_lentas (
+            id bigserial PRIMARY KEY,
+            creado_en timestamptz NOT NULL DEFAULT now(),
+            huella text NOT NULL,
+            sql_norm text NOT NULL,
+            params jsonb,
+            duracion_ms double precision NOT NULL,
+            engine text,
+            plan text
+        );
+    """)
+
+    # Multi-local: cada fila pertenece a un local (lo existente queda en el local por defecto)
+    for tabla in ("productos", "faltantes", "faltantes_historico", "pedidos", "pedido_items", "movimientos"):
+        exec_(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS local_id text NOT NULL DEFAULT '{LOCAL_DEFAULT}';")
+
+    # El nombre de producto es único por local
+    exec_("ALTER TABLE productos DROP CONSTRAINT IF EXISTS productos_nombre_key;")
+    exec_("CREATE UNIQUE INDEX IF NOT EXISTS productos_local_nombre_key ON productos (local_id, nombre);")
+
+    # Concurrencia optimista: toda escritura sobre un faltante es "WHERE id=:id AND version=:v" y suma 1
+    exec_("ALTER TABLE faltantes ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;")
+
+    exec_("DROP INDEX IF EXISTS faltantes_estado_idx;")
+    exec_("DROP INDEX IF EXISTS pedidos_fecha_idx;")
+    exec_("CREATE INDEX IF NOT EXISTS faltantes_local_estado_idx ON faltantes (local_id, estado, sector);")
+    exec_("CREATE INDEX IF NOT EXISTS faltantes_historico_local_idx ON faltantes_historico (local_id, creado_en);")
+    exec_("CREATE INDEX IF NOT EXISTS movimientos_local_idx ON movimientos (local_id, id);")
+    exec_("CREATE INDEX IF NOT EXISTS movimientos_faltante_idx ON movimientos (faltante_id);")
+    exec_("CREATE INDEX IF NOT EXISTS pedidos_local_fecha_idx ON pedidos (local_id, fecha, id);")
+    exec_("CREATE INDEX IF NOT EXISTS pedido_items_pedido_idx ON pedido_items (pedido_id);")
+
+    # Estadísticas: resúmenes mantenidos en forma incremental desde movimientos (ver refrescar_stats)
+    exec_("""
+        CREATE TABLE IF NOT EXISTS stats_watermark (
+            nombre text PRIMARY KEY,
+            ultimo_mov_id bigint NOT NULL DEFAULT 0,
+            actualizado_en timestamptz NOT NULL DEFAULT now()
+        );
+    """)
+    # Movimientos restaurados por encima del watermark que ya sumó reset_stats (ver ahí)
+    exec_("""
+        CREATE TABLE IF NOT EXISTS stats_restaurados (
+            mov_id bigint PRIMARY KEY
+        );
+    """)
+
+    # Tablas de estadísticas de antes de multi-local: se vacían y se recalculan con local_id
+    exec_("""
+        DO $$
+        BEGIN
+            IF to_regclass('stats_producto') IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'stats_producto' AND column_name = 'local_id'
+            ) THEN
+                DROP TABLE stats_producto, stats_semanal;
+                TRUNCATE stats_watermark, stats_restaurados;
+            END IF;
+        END $$;
+    """)
+
+    exec_("""
+        CREATE TABLE IF NOT EXISTS stats_producto (
+            local_id text NOT NULL,
+            producto text NOT NULL,
+            proveedor text NOT NULL DEFAULT '',
+            veces bigint NOT NULL DEFAULT 0,
+            n_pedido bigint NOT NULL DEFAULT 0,
+            seg_pend_pedido double precision NOT NULL DEFAULT 0,
+            n_recibido bigint NOT NULL DEFAULT 0,
+            n_recibido_con_pedido bigint NOT NULL DEFAULT 0,
+            seg_pedido_recibido double precision NOT NULL DEFAULT 0,
+            seg_pend_recibido double precision NOT NULL DEFAULT 0,
+            cantidad_recibida double precision NOT NULL DEFAULT 0,
+            ultimo_faltante timestamptz,
+            PRIMARY KEY (local_id, producto, proveedor)
+        );
+    """)
+
+    exec_("""
+        CREATE TABLE IF NOT EXISTS stats_semanal (
+            local_id text NOT NULL,
+            semana date NOT NULL,
+            producto text NOT NULL,
+            proveedor text NOT NULL DEFAULT '',
+            veces bigint NOT NULL DEFAULT 0,
+            cantidad_recibida double precision NOT NULL DEFAULT 0,
+            PRIMARY KEY (local_id, semana, producto, proveedor)
+        );
+    """)
+
+    # Fotos periódicas de los faltantes abiertos, para reconstruir el estado a una fecha (ver estado_a_fecha)
+    exec_("""
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id bigserial PRIMARY KEY,
+            tomado_en timestamptz NOT NULL DEFAULT now(),
+            hasta_mov_id bigint NOT NULL
+        );
+    """)
+    exec_("""
+        CREATE TABLE IF NOT EXISTS snapshot_faltantes (
+            snapshot_id bigint NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+            faltante_id bigint NOT NULL,
+            local_id text NOT NULL,
+            producto text NOT NULL,
+            categoria text,
+            cantidad double precision,
+            unidad text,
+            sector text,
+            proveedor text,
+            estado text NOT NULL,
+            PRIMARY KEY (snapshot_id, local_id, faltante_id)
+        );
+    """)
+    exec_("CREATE INDEX IF NOT EXISTS snapshots_tomado_idx ON snapshots (tomado_en);")
+
+    # estado/prioridad/sector/categoría/unidad: de text a enums (ver DOMINIOS)
+    migrar_dominios()
+
+    # Vista con activos + histórico (historial, backup, auditoría)
+    exec_("""
+        CREATE OR REPLACE VIEW faltantes_todos AS
+        SELECT id, creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, notas, local_id
+        FROM faltantes
+        UNION ALL
+        SELECT id, creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, notas, local_id
+        FROM faltantes_historico;
+    """)
+
+    # Nivel par por producto y sector: lo que tendría que haber; el conteo genera faltantes contra esto
+    exec_("""
+        CREATE TABLE IF NOT EXISTS productos_par (
+            producto_id bigint NOT NULL REFERENCES productos (id) ON DELETE CASCADE,
+            sector sector_t NOT NULL,
+            par double precision NOT NULL CHECK (par > 0),
+            local_id text NOT NULL,
+            actualizado_en timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (producto_id, sector)
+        );
+    """)
+
+    # Contadores de faltantes por local/sector/categoría/estado, mantenidos por triggers de sentencia
+    exec_("""
+        CREATE TABLE IF NOT EXISTS faltantes_counters (
+            local_id text NOT NULL,
+            sector text NOT NULL,
+            categoria text NOT NULL,
+            estado text NOT NULL,
+            n bigint NOT NULL DEFAULT 0,
+            PRIMARY KEY (local_id, sector, categoria, estado)
+        );
+    """)
+    exec_("""
+        CREATE OR REPLACE FUNCTION faltantes_counters_delta() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO faltantes_counters AS fc (local_id, sector, categoria, estado, n)
+                SELECT local_id, COALESCE(sector::text, ''), COALESCE(categoria::text, ''), estado::text, count(*)
+                FROM nuevas GROUP BY 1, 2, 3, 4
+                ON CONFLICT (local_id, sector, categoria, estado) DO UPDATE SET n = fc.n + EXCLUDED.n;
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO faltantes_counters AS fc (local_id, sector, categoria, estado, n)
+                SELECT local_id, COALESCE(sector::text, ''), COALESCE(categoria::text, ''), estado::text, -count(*)
+                FROM viejas GROUP BY 1, 2, 3, 4
+                ON CONFLICT (local_id, sector, categoria, estado) DO UPDATE SET n = fc.n + EXCLUDED.n;
+            ELSE
+                -- Solo se tocan las claves que cambiaron (editar cantidad/notas no escribe contadores)
+                INSERT INTO faltantes_counters AS fc (local_id, sector, categoria, estado, n)
+                SELECT local_id, sector, categoria, estado, sum(d)
+                FROM (
+                    SELECT local_id, COALESCE(sector::text, '') AS sector, COALESCE(categoria::text, '') AS categoria,
+                           estado::text AS estado, -1 AS d
+                    FROM viejas
+                    UNION ALL
+                    SELECT local_id, COALESCE(sector::text, ''), COALESCE(categoria::text, ''), estado::text, 1
+                    FROM nuevas
+                ) x
+                GROUP BY 1, 2, 3, 4
+                HAVING sum(d) <> 0
+                ON CONFLICT (local_id, sector, categoria, estado) DO UPDATE SET n = fc.n + EXCLUDED.n;
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+    """)
+    # Triggers + recuento en una transacción con faltantes bloqueada: arranca siempre consistente
+    with get_engine().begin() as c:
+        c.execute(text("LOCK TABLE faltantes IN SHARE ROW EXCLUSIVE MODE"))
+        c.execute(text("""
+            DROP TRIGGER IF EXISTS faltantes_counters_ins ON faltantes;
+            DROP TRIGGER IF EXISTS faltantes_counters_upd ON faltantes;
+            DROP TRIGGER IF EXISTS faltantes_counters_del ON faltantes;
+            CREATE TRIGGER faltantes_counters_ins AFTER INSERT ON faltantes
+                REFERENCING NEW TABLE AS nuevas
+                FOR EACH STATEMENT EXECUTE FUNCTION faltantes_counters_delta();
+            CREATE TRIGGER faltantes_counters_upd AFTER UPDATE ON faltantes
+                REFERENCING OLD TABLE AS viejas NEW TABLE AS nuevas
+                FOR EACH STATEMENT EXECUTE FUNCTION faltantes_counters_delta();
+            CREATE TRIGGER faltantes_counters_del AFTER DELETE ON faltantes
+                REFERENCING OLD TABLE AS viejas
+                FOR EACH STATEMENT EXECUTE FUNCTION faltantes_counters_delta();
+        """))
+        c.execute(text("DELETE FROM faltantes_counters"))
+        c.execute(text("""
+            INSERT INTO faltantes_counters (local_id, sector, categoria, estado, n)
+            SELECT local_id, COALESCE(sector::text, ''), COALESCE(categoria::text, ''), estado::text, count(*)
+            FROM faltantes
+            GROUP BY 1, 2, 3, 4
+        """))
+
+    # Búsqueda por subcadena: pg_trgm + unaccent si se pueden instalar; si no, lower() (= ILIKE) sin índice
+    for ext in ("pg_trgm", "unaccent"):
+        try:
+            exec_(f"CREATE EXTENSION IF NOT EXISTS {ext};")
+        except Exception:
+            pass  # sin permisos o no disponible en el servidor
+    exts = dict(qdf(
+        "SELECT extname, extnamespace::regnamespace::text AS esquema FROM pg_extension",
+        primario=True,
+    ).itertuples(index=False, name=None))
+    if "unaccent" in exts:
+        esq = exts["unaccent"]
+        cuerpo = f"SELECT lower({esq}.unaccent('{esq}.unaccent'::regdictionary, $1))"
+    else:
+        cuerpo = "SELECT lower($1)"
+    previo = qdf("SELECT prosrc FROM pg_proc WHERE proname = 'norm_busqueda'", primario=True)
+    exec_(f"""
+        CREATE OR REPLACE FUNCTION norm_busqueda(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT AS $$ {cuerpo} $$;
+    """)
+    if "pg_trgm" in exts:
+        for col in ("producto", "proveedor", "notas"):
+            exec_(f"""
+                CREATE INDEX IF NOT EXISTS faltantes_{col}_trgm_idx
+                ON faltantes USING gin (norm_busqueda({col}) {exts['pg_trgm']}.gin_trgm_ops);
+            """)
+            # Si cambió la normalización (p.ej. se instaló unaccent después) el índice quedó viejo
+            if not previo.empty and previo.iloc[0]["prosrc"].strip() != cuerpo:
+                exec_(f"REINDEX INDEX faltantes_{col}_trgm_idx;")
+    exec_("CREATE INDEX IF NOT EXISTS faltantes_local_creado_idx ON faltantes (local_id, creado_en);")
+
+
+# Con varias réplicas, el DDL lo corre una sola (advisory lock de sesión) y solo si cambió:
+# la huella del código del esquema queda en esquema_version y las que llegan después no tocan nada.
+ESQUEMA_LOCK = 0x46414C54  # "FALT"
+
+
+def huella_esquema() -> str | None:
+    # El código del esquema y todas las constantes de módulo que lee: si cambia cualquiera, se vuelve a correr
+    try:
+        fuente = "".join(inspect.getsource(f) for f in (init_schema, migrar_dominios, _literal))
+    except (OSError, TypeError):
+        return None  # sin fuente (p.ej. empaquetado): se corre siempre, como antes
+    constantes = (DOMINIOS, COLUMNAS_DOMINIO, _COLS_FALTANTE, LOCAL_DEFAULT)
+    return hashlib.sha1((fuente + repr(constantes)).encode()).hexdigest()
+
 
 @st.cache_resource
 def ensure_schema():
-    init_schema()
+    huella = huella_esquema()
+    with get_engine().connect() as c:
+        c.execute(text("SELECT pg_advisory_lock(:k)"), {"k": ESQUEMA_LOCK})
+        try:
+            c.execute(text("""
+                CREATE TABLE IF NOT EXISTS esquema_version (
+                    id int PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                    huella text NOT NULL,
+                    aplicado_en timestamptz NOT NULL DEFAULT now()
+                )
+            """))
+            aplicada = c.execute(text("SELECT huella FROM esquema_version")).scalar()
+            c.commit()
+            if huella is not None and aplicada == huella:
+                return True
+            init_schema()
+            if huella is not None:
+                c.execute(text("""
+                    INSERT INTO esquema_version (id, huella) VALUES (1, :h)
+                    ON CONFLICT (id) DO UPDATE SET huella = EXCLUDED.huella, aplicado_en = now()
+                """), {"h": huella})
+                c.commit()
+        finally:
+            c.rollback()
+            c.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": ESQUEMA_LOCK})
+            c.commit()
+    # Enums y extensiones pueden haber cambiado: las demás réplicas releen sus catálogos
+    invalidar_compartida("esquema")
+    invalidar_compartida("dominios")
     return True
 
 
 # --- IMPORTANTE: esto va DESPUÉS de definir get_engine/exec_/init_schema ---
-ensure_schema()
+with seccion("schema"):
+    ensure_schema()
+
+
+def extensiones_busqueda() -> frozenset:
+    return _extensiones_busqueda(version_compartida("esquema"))
+
+
+@st.cache_resource(max_entries=2)
+def _extensiones_busqueda(version: str) -> frozenset:
+    return frozenset(qdf("SELECT extname FROM pg_extension", primario=True)["extname"])
+
+
+def dominios() -> dict[str, tuple[str, ...]]:
+    return _dominios(version_compartida("dominios"))
+
+
+@st.cache_resource(max_entries=2)
+def _dominios(version: str) -> dict[str, tuple[str, ...]]:
+    # Etiquetas de cada enum de DOMINIOS en su orden, leídas una vez por proceso y versión compartida
+    df_d = qdf("""
+        SELECT t.typname AS tipo, e.enumlabel AS valor
+        FROM pg_enum e JOIN pg_type t ON t.oid = e.enumtypid
+        WHERE t.typname = ANY(CAST(:tipos AS text[]))
+        ORDER BY t.typname, e.enumsortorder
+    """, {"tipos": list(DOMINIOS)}, primario=True)
+    return {tipo: tuple(g["valor"]) for tipo, g in df_d.groupby("tipo", sort=False)}
+
+
+def ampliar_dominios(tabla: str, df: pd.DataFrame):
+    # Para restores de backups viejos: '' pasa a NULL y las etiquetas que el enum no conoce se agregan
+    # (el dato viene de la propia base; rechazarlo dejaría el backup sin poder restaurarse)
+    nuevas = False
+    for col, tipo in COLUMNAS_DOMINIO.get(tabla, {}).items():
+        if col not in df.columns:
+            continue
+        df[col] = df[col].astype(object).where(df[col].notna(), None)
+        df[col] = [v.strip() or None if isinstance(v, str) else v for v in df[col]]
+        for v in dict.fromkeys(v for v in df[col] if v is not None):
+            if v not in dominios().get(tipo, ()):
+                exec_(f"ALTER TYPE {tipo} ADD VALUE IF NOT EXISTS {_literal(str(v))};")
+                nuevas = True
+    if nuevas:
+        invalidar_compartida("dominios")
+
+
+def renumerar(c, secuencia: str, *dfs: pd.DataFrame) -> dict:
+    # Restore: los ids del CSV pueden estar usados (otro local, o lo ya cargado en modo agregar).
+    # Se piden ids nuevos a la secuencia de `secuencia`, en el mismo orden que los viejos (el orden
+    # de movimientos importa), y se reescribe la columna id de cada df. Devuelve {viejo: nuevo}.
+    viejos = sorted({int(i) for df in dfs if "id" in df.columns for i in df["id"].dropna()})
+    if not viejos:
+        return {}
+    nuevos = sorted(int(r[0]) for r in c.execute(text(f"""
+        SELECT nextval(pg_get_serial_sequence('{secuencia}', 'id')) FROM generate_series(1, :n)
+    """), {"n": len(viejos)}))
+    mapa = dict(zip(viejos, nuevos))
+    for df in dfs:
+        if "id" in df.columns:
+            df["id"] = df["id"].map(mapa).astype("int64")
+    return mapa
+
+
+def traducir_ref(df: pd.DataFrame, col: str, mapa: dict, obligatoria: bool = True) -> pd.DataFrame:
+    # Referencia a un id renumerado; sin fila padre en el backup queda NULL, o se descarta si es NOT NULL
+    if df.empty or col not in df.columns:
+        return df
+    df[col] = pd.to_numeric(df[col], errors="coerce").map(mapa).astype("Int64")
+    return df[df[col].notna()] if obligatoria else df
 
 
 st.set_page_config(
@@ -118,6 +1153,22 @@ st.set_page_config(
 # ============================================================
 # AUTH (Login + Roles) - usa .streamlit/secrets.toml
 # ============================================================
+def locales_usuario(item) -> list[str]:
+    # [[auth.users]] puede traer locales = ["centro", "palermo"] o local = "centro".
+    # Sin eso, los de [auth] locales (o el local por defecto).
+    locales = item.get("locales") or ([item["local"]] if item.get("local") else None)
+    if not locales:
+        locales = st.secrets["auth"].get("locales", [LOCAL_DEFAULT])
+    return [str(x) for x in locales]
+
+
+def local_actual() -> str:
+    auth = st.session_state.get("auth", {})
+    locales = auth.get("locales") or [LOCAL_DEFAULT]
+    elegido = st.session_state.get("local_sel", auth.get("local"))
+    return elegido if elegido in locales else locales[0]
+
+
 def require_login():
     if "auth" not in st.session_state:
         st.session_state.auth = {"logged": False, "user": None, "role": None}
@@ -145,10 +1196,13 @@ def require_login():
                 break
 
         if ok:
+            locales = locales_usuario(ok)
             st.session_state.auth = {
                 "logged": True,
                 "user": ok["user"],
                 "role": ok.get("role", "Admin"),
+                "locales": locales,
+                "local": locales[0],
             }
             st.rerun()
         else:
@@ -157,23 +1211,292 @@ def require_login():
     st.stop()
 
 
-require_login()
+# ============================================================
+# Kiosco: pantalla de pared por sector, solo lectura (?kiosco=<token>, sin login)
+# ============================================================
+# [kiosco] tokens = [{ token = "...", sector = "Cocina", local = "principal" }]
+# Cada KIOSCO_CADA_S el fragmento lee solo un token de cambio (último movimiento del local +
+# abiertos del sector según faltantes_counters: dos lecturas por índice). La lista se vuelve a
+# leer y a armar solo cuando el token cambió.
+KIOSCO_CONF = dict(st.secrets.get("kiosco", {}))
+KIOSCO_CADA_S = float(KIOSCO_CONF.get("cada_s", 10))
+
+
+def kiosco_del_token(token: str) -> dict | None:
+    for k in KIOSCO_CONF.get("tokens", []):
+        if token and hmac.compare_digest(token.encode(), str(k.get("token", "")).encode()):
+            return {"sector": k["sector"], "local": k.get("local", LOCAL_DEFAULT), "nombre": k.get("nombre", k["sector"])}
+    return None
+
+
+def kiosco_cambio(local: str, sector: str) -> tuple[int, int]:
+    df = qdf("""
+        SELECT (SELECT COALESCE(max(id), 0) FROM movimientos WHERE local_id = :local) AS mov,
+               (SELECT COALESCE(sum(n), 0) FROM faltantes_counters
+                WHERE local_id = :local AND sector = :sector AND estado IN ('Pendiente','Pedido')) AS abiertos
+    """, {"local": local, "sector": sector})
+    return int(df.iloc[0]["mov"]), int(df.iloc[0]["abiertos"])
+
+
+def kiosco_faltantes(local: str, sector: str) -> pd.DataFrame:
+    return qdf("""
+        SELECT producto, categoria, cantidad, unidad, prioridad, estado
+        FROM faltantes
+        WHERE local_id = :local AND sector = CAST(:sector AS sector_t) AND estado IN ('Pendiente','Pedido')
+        ORDER BY prioridad, categoria, producto
+    """, {"local": local, "sector": sector})
+
+
+def kiosco_html(df: pd.DataFrame) -> str:
+    if df.empty:
+        return "<div class='kiosco-vacio'>✅ No hay faltantes abiertos</div>"
+    bloques = []
+    for categoria, g in df.groupby(df["categoria"].fillna("Otros"), sort=False):
+        items = "".join(
+            f"<div class='kiosco-item'>"
+            f"<span class='kiosco-estado kiosco-{str(r.estado).lower()}'>{html.escape(str(r.estado))}</span> "
+            f"<b>{html.escape(str(r.producto))}</b> "
+            f"<span class='kiosco-cant'>{float(r.cantidad or 0):g} {html.escape(str(r.unidad or ''))}</span>"
+            f"{' ⚡' if r.prioridad == 'Alta' else ''}</div>"
+            for r in g.itertuples(index=False)
+        )
+        bloques.append(f"<div class='kiosco-rubro'><h3>{html.escape(str(categoria))}</h3>{items}</div>")
+    return "<div class='kiosco-grilla'>" + "".join(bloques) + "</div>"
+
+
+def mostrar_kiosco(k: dict):
+    st.set_page_config(page_title=f"Faltantes · {k['nombre']}", layout="wide")
+    st.markdown("""
+    <style>
+    .kiosco-grilla { display: grid; grid-template-columns: repeat(auto-fill, minmax(320px, 1fr)); gap: 16px; }
+    .kiosco-rubro { background: #111827; border: 1px solid #1f2937; border-radius: 16px; padding: 14px 18px; }
+    .kiosco-rubro h3 { margin: 0 0 8px 0; color: #00bcd4; }
+    .kiosco-item { font-size: 1.35rem; padding: 6px 0; border-bottom: 1px solid #1f2937; }
+    .kiosco-cant { color: #cbd5e1; margin-left: 6px; }
+    .kiosco-estado { font-size: 0.8rem; font-weight: 700; padding: 3px 9px; border-radius: 999px; }
+    .kiosco-pendiente { background-color: #f59e0b; color: #000; }
+    .kiosco-pedido { background-color: #3b82f6; color: #fff; }
+    .kiosco-vacio { font-size: 2rem; text-align: center; padding: 48px; color: #10b981; }
+    </style>
+    """, unsafe_allow_html=True)
+    st.markdown(f"# 📋 Faltantes · {html.escape(k['nombre'])}")
+
+    @st.fragment(run_every=KIOSCO_CADA_S)
+    def tablero():
+        cambio = kiosco_cambio(k["local"], k["sector"])
+        vista = st.session_state.get("kiosco_vista")
+        if vista is None or vista["cambio"] != cambio:
+            df = kiosco_faltantes(k["local"], k["sector"])
+            vista = {
+                "cambio": cambio,
+                "html": kiosco_html(df),
+                "n": len(df),
+                "desde": pd.Timestamp.now(tz="America/Argentina/Buenos_Aires").strftime("%H:%M"),
+            }
+            st.session_state["kiosco_vista"] = vista
+        st.markdown(vista["html"], unsafe_allow_html=True)
+        st.caption(f"{vista['n']} abiertos · actualizado {vista['desde']} hs")
+
+    tablero()
+
+
+_kiosco_token = st.query_params.get("kiosco")
+if _kiosco_token is not None:
+    with seccion("kiosco"):
+        _kiosco = kiosco_del_token(_kiosco_token)
+        if _kiosco is None:
+            st.error("Token de kiosco inválido.")
+        else:
+            _perfil["usuario"] = f"kiosco:{_kiosco['nombre']}"
+            mostrar_kiosco(_kiosco)
+    cerrar_corrida()
+    st.stop()
 
+with seccion("login"):
+    require_login()
+LOCAL = local_actual()
+_perfil["usuario"] = st.session_state.auth.get("user")
+abrir_alcance()
 
 
 # ============================================================
-# UI config
+# Lecturas de la corrida (se lanzan todas juntas, ver leer_async)
 # ============================================================
+def ping_db() -> bool:
+    with get_engine().connect() as c:
+        c.execute(text("select 1"))
+    return True
+
+
+def load_product_master(local: str):
+    df_prod = qdf("""
+        SELECT nombre, categoria, unidad, proveedor
+        FROM productos
+        WHERE local_id = :local AND activo = true
+        ORDER BY nombre
+    """, {"local": local})
+    productos = df_prod["nombre"].dropna().tolist() if not df_prod.empty else []
+    prod_map = {r["nombre"]: r for _, r in df_prod.iterrows()} if not df_prod.empty else {}
+    return productos, prod_map
+
+
+# Esquema de los DataFrames de faltantes: las columnas de pocos valores distintos van como category
+# (un código entero por fila en vez de un string; filtrar es comparar códigos). Ojo: a una columna
+# category no se le puede asignar/fillna un valor nuevo sin pasarla antes a object.
+# El texto libre queda como lo trae pandas (Arrow-backed desde pandas 3).
+TIPOS_FALTANTES = {c: "category" for c in ("estado", "sector", "categoria", "prioridad", "unidad")}
+
+# Proyección explícita: sin local_id (ya filtrado) ni columnas que la vista no usa
+COLS_LISTA = "id, creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, notas, version"
+COLS_PEDIDO = "id, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, version"
+
+
+def lista_faltantes(local: str) -> pd.DataFrame:
+    return qdf(f"SELECT {COLS_LISTA} FROM faltantes WHERE local_id = :local ORDER BY id DESC",
+               {"local": local}, tipos=TIPOS_FALTANTES)
+
+
+def faltantes_abiertos(local: str) -> pd.DataFrame:
+    return qdf(f"""
+        SELECT {COLS_PEDIDO}
+        FROM faltantes
+        WHERE local_id = :local
+          AND estado IN ('Pendiente','Pedido')
+        ORDER BY categoria, producto
+    """, {"local": local}, tipos=TIPOS_FALTANTES)
+
+
+PEDIDOS_POR_PAGINA = 50
+
+
+def pedidos_resumen(local: str, desde, hasta, antes_de: int | None = None,
+                    limite: int = PEDIDOS_POR_PAGINA) -> pd.DataFrame:
+    # Una sola consulta: cabecera + cantidad de ítems, unidades y rubros (keyset por id)
+    filtro_antes = "AND p.id < :antes" if antes_de else ""
+    return qdf(f"""
+        SELECT
+            p.id,
+            p.creado_en,
+            p.fecha,
+            p.estados_incluidos,
+            count(i.id) AS items,
+            COALESCE(sum(i.cantidad), 0) AS unidades,
+            string_agg(DISTINCT COALESCE(i.categoria::text, 'OTROS'), ', ') AS categorias
+        FROM pedidos p
+        LEFT JOIN pedido_items i ON i.pedido_id = p.id
+        WHERE p.local_id = :local
+          AND p.fecha BETWEEN :desde AND :hasta
+          {filtro_antes}
+        GROUP BY p.id
+        ORDER BY p.id DESC
+        LIMIT :limite
+    """, {"local": local, "desde": desde, "hasta": hasta, "antes": antes_de, "limite": int(limite)})
+
+
+def historial_movimientos(local: str, limite: int) -> pd.DataFrame:
+    return qdf(f"""
+    SELECT
+        m.creado_en,
+        m.usuario,
+        m.rol,
+        m.faltante_id,
+        f.producto,
+        m.accion,
+        m.estado_anterior,
+        m.estado_nuevo,
+        m.nota
+    FROM movimientos m
+    JOIN faltantes_todos f ON f.id = m.faltante_id
+    WHERE m.local_id = :local
+    ORDER BY m.id DESC
+    LIMIT {int(limite)}
+    """, {"local": local})
+
 
+def productos_todos(local: str) -> pd.DataFrame:
+    return qdf(
+        """
+        SELECT id, nombre, categoria, unidad, proveedor, activo
+        FROM productos
+        WHERE local_id = :local
+        ORDER BY nombre
+        """,
+        {"local": local},
+    )
 
-# Defaults
-CATEGORIAS = ["Almacén", "Verdulería", "Fiambre", "Carnicería", "Pescaderia", "Limpieza", "Descartables", "Bebidas",  "Panaderia", "Frezzer", "Enfriado", "Otros"]
-PRIORIDAD = ["Alta", "Media", "Baja"]
-ESTADOS = ["Pendiente", "Pedido", "Recibido", "Anulado"]
-SECTORES = ["Cocina", "Barra", "Salón"]
-UNIDADES = ["und", "caja", "kg", "atado", "lt", "pack", "bolsa"]
+
+def _patron_like(texto: str) -> str:
+    return texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def buscar_faltantes(local: str, texto: str, proveedor: str) -> pd.DataFrame:
+    # Subcadena en PostgreSQL, sin acentos ni mayúsculas (índices trigram si hay pg_trgm), por relevancia
+    trgm = "pg_trgm" in extensiones_busqueda()
+    where, relevancia = ["local_id = :local"], []
+    params = {"local": local}
+    for nombre, valor, cols in [("q", texto, ["producto", "notas"]), ("prov", proveedor, ["proveedor"])]:
+        if not valor:
+            continue
+        params[nombre] = _patron_like(valor)
+        params[f"{nombre}_raw"] = valor
+        where.append("(" + " OR ".join(
+            f"norm_busqueda({c}) LIKE '%' || norm_busqueda(:{nombre}) || '%'" for c in cols
+        ) + ")")
+        if trgm:
+            relevancia.append("greatest(" + ", ".join(
+                f"similarity(norm_busqueda({c}), norm_busqueda(:{nombre}_raw))" for c in cols
+            ) + ") DESC")
+        else:
+            relevancia.append(f"(norm_busqueda({cols[0]}) LIKE norm_busqueda(:{nombre}) || '%') DESC")
+    return qdf(f"""
+        SELECT {COLS_LISTA} FROM faltantes
+        WHERE {" AND ".join(where)}
+        ORDER BY {", ".join(relevancia + ["id DESC"])}
+    """, params, tipos=TIPOS_FALTANTES)
+
+
+def contadores_faltantes(local: str) -> pd.DataFrame:
+    # Lee faltantes_counters (mantenida por triggers): unas decenas de filas, sin escanear faltantes
+    return qdf("""
+        SELECT sector, categoria, estado, n
+        FROM faltantes_counters
+        WHERE local_id = :local AND n > 0
+    """, {"local": local})
+
+
+def version_datos() -> str:
+    # Cambia con cada alta/edición de faltante (todas dejan movimiento)
+    df_v = qdf("""
+        SELECT (SELECT COALESCE(max(id), 0) FROM faltantes) AS f,
+               (SELECT COALESCE(max(id), 0) FROM movimientos) AS m
+    """)
+    return f"{int(df_v.iloc[0]['f'])}-{int(df_v.iloc[0]['m'])}"
+
+
+def pedidos_cursor(local: str, desde, hasta) -> int | None:
+    # Mismo criterio que la pestaña Pedidos: si cambió el rango se vuelve a la primera página
+    if st.session_state.get("p_rango") != (local, desde, hasta):
+        return None
+    return (st.session_state.get("p_cursores") or [None])[-1]
+
+
+_p_desde = st.session_state.get("p_desde", date.today())
+_p_hasta = st.session_state.get("p_hasta", date.today())
+for _fn, *_args in [
+    (ping_db,),
+    (load_product_master, LOCAL),
+    (lista_faltantes, LOCAL),
+    (faltantes_abiertos, LOCAL),
+    (contadores_faltantes, LOCAL),
+    (pedidos_resumen, LOCAL, _p_desde, _p_hasta, pedidos_cursor(LOCAL, _p_desde, _p_hasta)),
+    (historial_movimientos, LOCAL, int(st.session_state.get("hist_limite", 100))),
+    (productos_todos, LOCAL),
+    (version_datos,),
+]:
+    leer_async(_fn, *_args)
 
 # Premium Dark CSS (sin img global para no cortar logos)
+_t_css = time.perf_counter()
 st.markdown("""
 <style>
 body { background-color: #0f172a; }
@@ -261,14 +1584,15 @@ label, .stMarkdown, .stTextInput label, .stSelectbox label, .stNumberInput label
 }
 </style>
 """, unsafe_allow_html=True)
+registrar_seccion("CSS", _t_css)
 
-try:
-    with get_engine().connect() as c:
-        c.execute(text("select 1"))
-    st.success("✅ Conectado a Supabase OK")
-except Exception as e:
-    st.error(f"❌ No conecta: {e}")
-    st.stop()
+with seccion("ping"):
+    try:
+        leer(ping_db)
+        st.success("✅ Conectado a Supabase OK")
+    except Exception as e:
+        st.error(f"❌ No conecta: {e}")
+        st.stop()
 
 def init_schema():
     # OJO: en Supabase puede requerir permisos. Ideal hacerlo en SQL Editor.
@@ -328,38 +1652,592 @@ def init_schema():
         );
     """)
 
-    exec_("""
-        CREATE TABLE IF NOT EXISTS movimientos (
-            id bigserial PRIMARY KEY,
-            creado_en timestamptz NOT NULL DEFAULT now(),
-            usuario text,
-            rol text,
-            faltante_id bigint NOT NULL,
-            accion text NOT NULL,
-            estado_anterior text,
-            estado_nuevo text,
-            nota text
-        );
-    """)
+    exec_("""
+        CREATE TABLE IF NOT EXISTS movimientos (
+            id bigserial PRIMARY KEY,
+            creado_en timestamptz NOT NULL DEFAULT now(),
+            usuario text,
+            rol text,
+            faltante_id bigint NOT NULL,
+            accion text NOT NULL,
+            estado_anterior text,
+            estado_nuevo text,
+            nota text
+        );
+    """)
+
+
+def log_mov(faltante_id: int, accion: str, estado_anterior: str = "", estado_nuevo: str = "", nota: str = ""):
+    auth = st.session_state.get("auth", {})
+    exec_("""
+        INSERT INTO movimientos (usuario, rol, faltante_id, accion, estado_anterior, estado_nuevo, nota, local_id)
+        VALUES (:usuario, :rol, :fid, :accion, :ea, :en, :nota, :local)
+    """, {
+        "local": local_actual(),
+        "usuario": auth.get("user"),
+        "rol": auth.get("role"),
+        "fid": int(faltante_id),
+        "accion": accion,
+        "ea": estado_anterior or None,  # sin cambio de estado: NULL (columnas estado_t)
+        "en": estado_nuevo or None,
+        "nota": nota or "",
+    })
+
+
+def log_movs(ids: list[int], accion: str, estado_anterior: str = "", estado_nuevo: str = "", nota: str = ""):
+    # Igual que log_mov pero para muchos faltantes en un solo INSERT
+    if not ids:
+        return
+    auth = st.session_state.get("auth", {})
+    exec_("""
+        INSERT INTO movimientos (usuario, rol, faltante_id, accion, estado_anterior, estado_nuevo, nota, local_id)
+        SELECT :usuario, :rol, fid, :accion, :ea, :en, :nota, :local
+        FROM unnest(CAST(:ids AS bigint[])) AS fid
+    """, {
+        "local": local_actual(),
+        "usuario": auth.get("user"),
+        "rol": auth.get("role"),
+        "ids": [int(i) for i in ids],
+        "accion": accion,
+        "ea": estado_anterior or None,  # sin cambio de estado: NULL (columnas estado_t)
+        "en": estado_nuevo or None,
+        "nota": nota or "",
+    })
+
+
+# ============================================================
+# Cambios de estado (directo o write-behind con journal local)
+# ============================================================
+# Con [db] write_behind = true los cambios de estado se anotan en un SQLite local
+# (durable) y la UI los muestra enseguida. Un hilo los aplica en PostgreSQL por lotes;
+# cada entrada lleva una clave de idempotencia (journal_aplicado) para poder reintentar.
+WRITE_BEHIND = bool(st.secrets["db"].get("write_behind", False))
+JOURNAL_PATH = st.secrets["db"].get("journal_path", "faltantes_journal.sqlite")
+JOURNAL_LOTE = 50
+JOURNAL_MAX_INTENTOS = 10
+
+
+def _journal_conn() -> sqlite3.Connection:
+    jc = sqlite3.connect(JOURNAL_PATH, timeout=30, isolation_level=None)
+    jc.execute("PRAGMA journal_mode=WAL")
+    jc.execute("PRAGMA synchronous=FULL")
+    jc.execute("""
+        CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            clave TEXT NOT NULL UNIQUE,
+            payload TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            ultimo_error TEXT,
+            creado_en TEXT NOT NULL,
+            aplicado_en TEXT
+        )
+    """)
+    return jc
+
+
+def aplicar_del_journal(c, clave: str, payload: str) -> list[int]:
+    # Una entrada del journal, una sola vez aunque se reintente (clave en journal_aplicado)
+    if not marcar_aplicada(c, clave):
+        return []
+    return aplicar_entrada(c, json.loads(payload))
+
+
+def flush_journal(engine) -> int:
+    ahora = datetime.now(timezone.utc).isoformat()
+    with closing(_journal_conn()) as jc:
+        filas = jc.execute(
+            "SELECT id, clave, payload FROM journal WHERE estado = 'pendiente' ORDER BY id LIMIT ?",
+            (JOURNAL_LOTE,)
+        ).fetchall()
+        if not filas:
+            return 0
+
+        try:
+            with engine.begin() as c:
+                conflictos = [aplicar_del_journal(c, clave, payload) for _, clave, payload in filas]
+            jc.executemany(
+                "UPDATE journal SET estado = ?, ultimo_error = ?, aplicado_en = ? WHERE id = ?",
+                [
+                    ("conflicto" if conf else "aplicado", f"conflicto de versión: {conf}" if conf else None, ahora, id_)
+                    for (id_, _, _), conf in zip(filas, conflictos)
+                ]
+            )
+        except OperationalError:
+            raise  # base caída / red: se reintenta el lote entero más tarde
+        except Exception:
+            # Error de datos: se aplica de a una para aislar la entrada que falla
+            for id_, clave, payload in filas:
+                try:
+                    with engine.begin() as c:
+                        conf = aplicar_del_journal(c, clave, payload)
+                    jc.execute(
+                        "UPDATE journal SET estado = ?, ultimo_error = ?, aplicado_en = ? WHERE id = ?",
+                        ("conflicto" if conf else "aplicado", f"conflicto de versión: {conf}" if conf else None, ahora, id_)
+                    )
+                except OperationalError:
+                    raise
+                except Exception as e:
+                    jc.execute("""
+                        UPDATE journal
+                        SET intentos = intentos + 1,
+                            ultimo_error = ?,
+                            estado = CASE WHEN intentos + 1 >= ? THEN 'error' ELSE estado END
+                        WHERE id = ?
+                    """, (str(e)[:500], JOURNAL_MAX_INTENTOS, id_))
+
+        limite = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
+        jc.execute("DELETE FROM journal WHERE estado IN ('aplicado', 'conflicto') AND aplicado_en < ?", (limite,))
+        return len(filas)
+
+
+def _journal_loop(engine, despertar: threading.Event):
+    espera = 1.0
+    while True:
+        despertar.wait(timeout=espera)
+        despertar.clear()
+        try:
+            n = flush_journal(engine)
+            espera = 0.1 if n >= JOURNAL_LOTE else 2.0
+        except Exception:
+            espera = min(max(espera, 1.0) * 2, 60.0)  # backoff mientras la base no responde
+
+
+@st.cache_resource
+def iniciar_journal_worker() -> threading.Event:
+    despertar = threading.Event()
+    threading.Thread(
+        target=_journal_loop, args=(get_engine(), despertar), daemon=True, name="journal-writer"
+    ).start()
+    return despertar
+
+
+def journal_estado() -> tuple[dict[int, tuple[str, int]], int, int]:
+    # ((estado pendiente, cambios pendientes) por faltante, entradas pendientes, entradas con error/conflicto)
+    if not WRITE_BEHIND:
+        return {}, 0, 0
+    with closing(_journal_conn()) as jc:
+        filas = jc.execute("SELECT payload FROM journal WHERE estado = 'pendiente' ORDER BY id").fetchall()
+        errores = jc.execute("SELECT count(*) FROM journal WHERE estado IN ('error', 'conflicto')").fetchone()[0]
+    pend = {}
+    for (payload,) in filas:
+        p = json.loads(payload)
+        for fid in p["ids"]:
+            pend[int(fid)] = (p["estado_nuevo"], pend.get(int(fid), ("", 0))[1] + 1)
+    return pend, len(filas), int(errores)
+
+
+def aplicar_journal(df: pd.DataFrame) -> pd.DataFrame:
+    # Superpone los cambios todavía no sincronizados sobre lo leído de la base
+    # (la versión avanza igual que lo hará al aplicarse, para poder encadenar cambios)
+    pend, _, _ = journal_estado()
+    if not pend or df.empty:
+        return df
+    ids = df["id"].astype(int)
+    return df.assign(
+        estado=ids.map({k: v[0] for k, v in pend.items()}).fillna(df["estado"]).astype("category"),
+        version=df["version"] + ids.map({k: v[1] for k, v in pend.items()}).fillna(0).astype("int64"),
+    )
+
+
+def cambiar_estado(ids: list[int], versiones: list[int], estado_nuevo: str, estado_anterior: str = "",
+                   accion: str = "CAMBIO_ESTADO") -> list[int]:
+    # Solo cambia los faltantes que siguen en la versión que vio el usuario; devuelve los ids en conflicto
+    # (en write-behind el conflicto aparece al sincronizar, como entrada 'conflicto' del journal)
+    ids = [int(i) for i in ids]
+    versiones = [int(v) for v in versiones]
+    if not ids:
+        return []
+
+    if WRITE_BEHIND:
+        auth = st.session_state.get("auth", {})
+        payload = {
+            "ids": ids,
+            "versiones": versiones,
+            "estado_nuevo": estado_nuevo,
+            "estado_anterior": estado_anterior or "",
+            "accion": accion,
+            "local": local_actual(),
+            "usuario": auth.get("user"),
+            "rol": auth.get("role"),
+            "ts": datetime.now(timezone.utc).isoformat(),
+        }
+        with closing(_journal_conn()) as jc:
+            jc.execute(
+                "INSERT INTO journal (clave, payload, creado_en) VALUES (?, ?, ?)",
+                (uuid.uuid4().hex, json.dumps(payload), payload["ts"])
+            )
+        iniciar_journal_worker().set()
+        return []
+
+    params = {"estado": estado_nuevo, "ids": ids, "versiones": versiones, "local": local_actual()}
+    t0 = time.perf_counter()
+    with transaccion() as c:
+        cambiados = [int(r[0]) for r in c.execute(text(SQL_CAMBIAR_ESTADO), params)]
+        _registrar_si_lenta(get_engine(), SQL_CAMBIAR_ESTADO, params, t0)
+        # En la misma transacción: el cambio y su movimiento quedan los dos o ninguno
+        log_movs(cambiados, accion, estado_anterior, estado_nuevo)
+
+    conflictos = sorted(set(ids) - set(cambiados))
+    if conflictos:
+        avisar_conflicto(len(conflictos))
+    return conflictos
+
+
+def actualizar_faltante(fid: int, version: int, **campos) -> bool:
+    # UPDATE condicionado a la versión leída; False si otro lo cambió antes (no se toca nada)
+    sets = ", ".join(f"{k} = :{k}" for k in campos)
+    sql = f"UPDATE faltantes SET {sets}, version = version + 1 WHERE id = :id AND version = :version"
+    params = {**campos, "id": int(fid), "version": int(version)}
+    t0 = time.perf_counter()
+    with transaccion() as c:
+        ok = c.execute(text(sql), params).rowcount == 1
+    _registrar_si_lenta(get_engine(), sql, params, t0)
+    return ok
+
+
+def avisar_conflicto(n: int):
+    # Sobrevive al st.rerun(); se muestra en mostrar_conflictos()
+    st.session_state["conflictos_version"] = st.session_state.get("conflictos_version", 0) + n
+
+
+def mostrar_conflictos():
+    n = st.session_state.pop("conflictos_version", 0)
+    if n:
+        st.warning(
+            f"⚠ {n} faltante(s) ya habían sido modificados desde otro dispositivo y no se cambiaron. "
+            "La lista está actualizada: revisalos y volvé a intentar."
+        )
+
+
+def versiones_en_pantalla(vista: str, df: pd.DataFrame) -> dict:
+    # El clic llega en un rerun que ya relee la lista: la versión a comparar es la que estaba
+    # dibujada (corrida anterior), no la recién leída. Devuelve {id: versión} de lo que se
+    # mostró la vez pasada y guarda lo que se muestra ahora.
+    clave = f"versiones_{vista}"
+    previas = st.session_state.get(clave, {})
+    st.session_state[clave] = {} if df.empty else dict(zip(df["id"].astype(int).tolist(), df["version"].astype(int).tolist()))
+    return previas
+
+
+if WRITE_BEHIND:
+    iniciar_journal_worker()  # drena lo que haya quedado de una ejecución anterior
+
+
+# ============================================================
+# Archivo: faltantes cerrados viejos -> faltantes_historico
+# ============================================================
+ARCHIVO_DIAS = int(st.secrets["db"].get("archivo_dias", 30))
+IDEMPOTENCIA_DIAS = 7  # claves de journal_aplicado: un reintento llega mucho antes
+
+
+def archivar_cerrados(dias: int = ARCHIVO_DIAS) -> int:
+    # Cerrado = Recibido/Anulado. La fecha de cierre es el último movimiento (o creado_en si no hay).
+    with transaccion() as c:
+        res = c.execute(
+            text("""
+                WITH mover AS (
+                    DELETE FROM faltantes f
+                    WHERE f.estado IN ('Recibido','Anulado')
+                      AND COALESCE(
+                            (SELECT max(m.creado_en) FROM movimientos m WHERE m.faltante_id = f.id),
+                            f.creado_en
+                          ) < now() - make_interval(days => :dias)
+                    RETURNING f.id, f.creado_en, f.producto, f.categoria, f.cantidad, f.unidad,
+                              f.prioridad, f.sector, f.proveedor, f.estado, f.notas, f.local_id
+                )
+                INSERT INTO faltantes_historico
+                (id, creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, notas, local_id)
+                SELECT id, creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, notas, local_id
+                FROM mover
+            """),
+            {"dias": int(dias)}
+        )
+        c.execute(
+            text("DELETE FROM journal_aplicado WHERE aplicado_en < now() - make_interval(days => :dias)"),
+            {"dias": IDEMPOTENCIA_DIAS}
+        )
+        return int(res.rowcount or 0)
+
+
+def archivar_periodico(dias: int) -> int:
+    # Corre como mucho una vez por hora en todo el despliegue (el turno de la caché hace de "cron")
+    return en_turno("archivar", 3600, archivar_cerrados, dias, sin_turno=0)
+
+
+with seccion("archivo"):
+    try:
+        archivar_periodico(ARCHIVO_DIAS)
+    except Exception:
+        pass  # el archivo es mantenimiento; nunca debe romper la app
+
+
+# ============================================================
+# Estadísticas incrementales (frecuencia y demoras por producto/proveedor)
+# ============================================================
+# Faltantes anteriores a que se registrara el movimiento ALTA: cuentan solo como frecuencia.
+# :local NULL = todos los locales
+SQL_STATS_VIEJOS = """
+    WITH viejos AS (
+        SELECT f.local_id, f.producto, COALESCE(f.proveedor, '') AS proveedor, f.creado_en
+        FROM faltantes_todos f
+        WHERE (CAST(:local AS text) IS NULL OR f.local_id = :local)
+          AND NOT EXISTS (
+            SELECT 1 FROM movimientos m WHERE m.faltante_id = f.id AND m.accion = 'ALTA'
+          )
+    ), prod AS (
+        INSERT INTO stats_producto AS s (local_id, producto, proveedor, veces, ultimo_faltante)
+        SELECT local_id, producto, proveedor, count(*), max(creado_en)
+        FROM viejos
+        GROUP BY local_id, producto, proveedor
+        ON CONFLICT (local_id, producto, proveedor) DO UPDATE SET
+            veces = s.veces + EXCLUDED.veces,
+            ultimo_faltante = GREATEST(s.ultimo_faltante, EXCLUDED.ultimo_faltante)
+    )
+    INSERT INTO stats_semanal AS w (local_id, semana, producto, proveedor, veces)
+    SELECT local_id, date_trunc('week', creado_en AT TIME ZONE 'America/Argentina/Buenos_Aires')::date,
+           producto, proveedor, count(*)
+    FROM viejos
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (local_id, semana, producto, proveedor) DO UPDATE SET veces = w.veces + EXCLUDED.veces
+"""
+
+# Movimientos (desde, hasta] sumados a los resúmenes. :local NULL = todos los locales.
+# :restaurados elige entre los movimientos comunes y los de stats_restaurados (ver reset_stats)
+SQL_STATS_EVENTOS = """
+    WITH ev AS (
+        SELECT m.creado_en, m.accion, m.estado_nuevo,
+               f.local_id, f.producto, COALESCE(f.proveedor, '') AS proveedor,
+               COALESCE(f.cantidad, 0) AS cantidad, f.creado_en AS f_creado,
+               CASE WHEN m.estado_nuevo = 'Recibido' THEN (
+                   SELECT max(p.creado_en) FROM movimientos p
+                   WHERE p.faltante_id = m.faltante_id AND p.estado_nuevo = 'Pedido' AND p.id < m.id
+               ) END AS t_pedido
+        FROM movimientos m
+        JOIN faltantes_todos f ON f.id = m.faltante_id
+        WHERE m.id > :desde AND m.id <= :hasta
+          AND (CAST(:local AS text) IS NULL OR m.local_id = :local)
+          AND EXISTS (SELECT 1 FROM stats_restaurados r WHERE r.mov_id = m.id) = :restaurados
+          AND (
+                m.accion = 'ALTA'
+             OR (m.estado_nuevo IN ('Pedido','Recibido') AND m.estado_anterior IS DISTINCT FROM m.estado_nuevo)
+          )
+    ), prod AS (
+        INSERT INTO stats_producto AS s (
+            local_id, producto, proveedor, veces, n_pedido, seg_pend_pedido, n_recibido,
+            n_recibido_con_pedido, seg_pedido_recibido, seg_pend_recibido, cantidad_recibida, ultimo_faltante
+        )
+        SELECT local_id, producto, proveedor,
+            count(*) FILTER (WHERE accion = 'ALTA'),
+            count(*) FILTER (WHERE estado_nuevo = 'Pedido'),
+            COALESCE(sum(extract(epoch FROM creado_en - f_creado)) FILTER (WHERE estado_nuevo = 'Pedido'), 0),
+            count(*) FILTER (WHERE estado_nuevo = 'Recibido'),
+            count(t_pedido),
+            COALESCE(sum(extract(epoch FROM creado_en - t_pedido)), 0),
+            COALESCE(sum(extract(epoch FROM creado_en - f_creado)) FILTER (WHERE estado_nuevo = 'Recibido'), 0),
+            COALESCE(sum(cantidad) FILTER (WHERE estado_nuevo = 'Recibido'), 0),
+            max(f_creado) FILTER (WHERE accion = 'ALTA')
+        FROM ev
+        GROUP BY local_id, producto, proveedor
+        ON CONFLICT (local_id, producto, proveedor) DO UPDATE SET
+            veces = s.veces + EXCLUDED.veces,
+            n_pedido = s.n_pedido + EXCLUDED.n_pedido,
+            seg_pend_pedido = s.seg_pend_pedido + EXCLUDED.seg_pend_pedido,
+            n_recibido = s.n_recibido + EXCLUDED.n_recibido,
+            n_recibido_con_pedido = s.n_recibido_con_pedido + EXCLUDED.n_recibido_con_pedido,
+            seg_pedido_recibido = s.seg_pedido_recibido + EXCLUDED.seg_pedido_recibido,
+            seg_pend_recibido = s.seg_pend_recibido + EXCLUDED.seg_pend_recibido,
+            cantidad_recibida = s.cantidad_recibida + EXCLUDED.cantidad_recibida,
+            ultimo_faltante = GREATEST(s.ultimo_faltante, EXCLUDED.ultimo_faltante)
+    )
+    INSERT INTO stats_semanal AS w (local_id, semana, producto, proveedor, veces, cantidad_recibida)
+    SELECT local_id, date_trunc('week', creado_en AT TIME ZONE 'America/Argentina/Buenos_Aires')::date,
+           producto, proveedor,
+           count(*) FILTER (WHERE accion = 'ALTA'),
+           COALESCE(sum(cantidad) FILTER (WHERE estado_nuevo = 'Recibido'), 0)
+    FROM ev
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (local_id, semana, producto, proveedor) DO UPDATE SET
+        veces = w.veces + EXCLUDED.veces,
+        cantidad_recibida = w.cantidad_recibida + EXCLUDED.cantidad_recibida
+"""
+
+
+def bloquear_watermark(c) -> int:
+    # Toma el watermark (FOR UPDATE) y lo devuelve; la primera vez suma los faltantes viejos
+    primera_vez = c.execute(text("""
+        INSERT INTO stats_watermark (nombre) VALUES ('movimientos')
+        ON CONFLICT (nombre) DO NOTHING
+        RETURNING nombre
+    """)).first() is not None
+
+    desde = int(c.execute(text("""
+        SELECT ultimo_mov_id FROM stats_watermark WHERE nombre = 'movimientos' FOR UPDATE
+    """)).scalar_one())
+
+    if primera_vez:
+        c.execute(text(SQL_STATS_VIEJOS), {"local": None})
+    return desde
+
+
+# Solo se procesan movimientos con id > watermark. Se dejan 10 s de margen para no
+# saltear ids de transacciones que todavía no commitearon. Los restaurados no sirven de
+# margen: tienen ids nuevos pero el creado_en del backup.
+def refrescar_stats() -> int:
+    with transaccion() as c:
+        desde = bloquear_watermark(c)
+        hasta = int(c.execute(text("""
+            SELECT COALESCE(max(m.id), 0) FROM movimientos m
+            WHERE m.creado_en < now() - interval '10 seconds'
+              AND NOT EXISTS (SELECT 1 FROM stats_restaurados r WHERE r.mov_id = m.id)
+        """)).scalar_one())
+
+        if hasta <= desde:
+            return 0
+
+        c.execute(text(SQL_STATS_EVENTOS), {"desde": desde, "hasta": hasta, "local": None, "restaurados": False})
+
+        c.execute(text("""
+            UPDATE stats_watermark SET ultimo_mov_id = :hasta, actualizado_en = now()
+            WHERE nombre = 'movimientos'
+        """), {"hasta": hasta})
+        c.execute(text("DELETE FROM stats_restaurados WHERE mov_id <= :hasta"), {"hasta": hasta})
+
+        return hasta - desde
+
+
+def refrescar_stats_periodico() -> int:
+    return en_turno("stats", 60, refrescar_stats, sin_turno=0)
+
+
+def reset_stats(local: str, restaurados: list[int]):
+    # Después de un restore del local se recalculan solo sus resúmenes: hasta el watermark compartido
+    # y, aparte, los movimientos restaurados (ids nuevos, por encima del watermark). Estos quedan en
+    # stats_restaurados para que refrescar_stats no los vuelva a sumar ni los use como margen.
+    with transaccion() as c:
+        hasta = bloquear_watermark(c)
+        c.execute(text("DELETE FROM stats_producto WHERE local_id = :local"), {"local": local})
+        c.execute(text("DELETE FROM stats_semanal WHERE local_id = :local"), {"local": local})
+        if restaurados:
+            c.execute(text("""
+                INSERT INTO stats_restaurados (mov_id) SELECT unnest(CAST(:ids AS bigint[]))
+                ON CONFLICT DO NOTHING
+            """), {"ids": [int(i) for i in restaurados]})
+        c.execute(text(SQL_STATS_VIEJOS), {"local": local})
+        c.execute(text(SQL_STATS_EVENTOS), {"desde": 0, "hasta": hasta, "local": local, "restaurados": False})
+        # Los de este restore y los de uno anterior del local que refrescar_stats todavía no pasó
+        c.execute(text(SQL_STATS_EVENTOS), {
+            "desde": hasta, "hasta": 2 ** 63 - 1, "local": local, "restaurados": True,
+        })
+
 
 
-def log_mov(faltante_id: int, accion: str, estado_anterior: str = "", estado_nuevo: str = "", nota: str = ""):
-    auth = st.session_state.get("auth", {})
-    exec_("""
-        INSERT INTO movimientos (usuario, rol, faltante_id, accion, estado_anterior, estado_nuevo, nota)
-        VALUES (:usuario, :rol, :fid, :accion, :ea, :en, :nota)
-    """, {
-        "usuario": auth.get("user"),
-        "rol": auth.get("role"),
-        "fid": int(faltante_id),
-        "accion": accion,
-        "ea": estado_anterior or "",
-        "en": estado_nuevo or "",
-        "nota": nota or "",
-    })
 
+# ============================================================
+# Estado a una fecha: foto periódica de abiertos + replay de movimientos
+# ============================================================
+SNAPSHOT_HORAS = 24
+SNAPSHOT_RETENCION_DIAS = 400
+
+
+def tomar_snapshot() -> int:
+    # Solo los abiertos (Pendiente/Pedido): los cerrados que se reabren aparecen en el replay
+    with transaccion() as c:
+        hasta = int(c.execute(text("SELECT COALESCE(max(id), 0) FROM movimientos")).scalar_one())
+        snap_id = int(c.execute(
+            text("INSERT INTO snapshots (hasta_mov_id) VALUES (:hasta) RETURNING id"),
+            {"hasta": hasta}
+        ).scalar_one())
+        c.execute(text("""
+            INSERT INTO snapshot_faltantes
+            (snapshot_id, faltante_id, local_id, producto, categoria, cantidad, unidad, sector, proveedor, estado)
+            SELECT :snap, id, local_id, producto, categoria, cantidad, unidad, sector, proveedor, estado
+            FROM faltantes
+            WHERE estado IN ('Pendiente','Pedido')
+        """), {"snap": snap_id})
+        c.execute(
+            text("DELETE FROM snapshots WHERE tomado_en < now() - make_interval(days => :dias)"),
+            {"dias": SNAPSHOT_RETENCION_DIAS}
+        )
+    return snap_id
+
+
+def snapshot_periodico(horas: int) -> bool:
+    # Igual que el archivo: el turno hace de "cron" y la foto se toma cada `horas`
+    return en_turno("snapshot", 3600, _snapshot_si_toca, horas, sin_turno=False)
+
+
+def _snapshot_si_toca(horas: int) -> bool:
+    df = qdf("SELECT max(tomado_en) AS ultimo FROM snapshots", primario=True)
+    ultimo = df.iloc[0]["ultimo"]
+    if pd.notna(ultimo) and pd.Timestamp(ultimo) > pd.Timestamp.now(tz="UTC") - pd.Timedelta(hours=horas):
+        return False
+    tomar_snapshot()
+    return True
 
 
+def reset_snapshots(local: str):
+    # Después de un restore las fotos ya no coinciden con los datos del local. Sin su parte de la foto,
+    # estado_a_fecha lo rearma con los movimientos restaurados (ids nuevos, posteriores a toda foto)
+    exec_("DELETE FROM snapshot_faltantes WHERE local_id = :local", {"local": local})
+
+
+@st.cache_data(show_spinner=False, max_entries=16, ttl=600)
+def estado_a_fecha(local: str, ts: datetime) -> pd.DataFrame:
+    # Faltantes abiertos a `ts`: la foto más cercana anterior + los movimientos desde esa foto.
+    # El costo depende de los abiertos y del intervalo entre fotos, no del largo del log.
+    cols = ["id", "producto", "categoria", "cantidad", "unidad", "sector", "proveedor", "estado"]
+    snap = qdf("""
+        SELECT id, tomado_en, hasta_mov_id FROM snapshots
+        WHERE tomado_en <= :ts
+        ORDER BY tomado_en DESC
+        LIMIT 1
+    """, {"ts": ts})
+    if snap.empty:
+        snap_id, desde, hasta_mov = 0, datetime(1970, 1, 1, tzinfo=timezone.utc), 0
+    else:
+        snap_id = int(snap.iloc[0]["id"])
+        desde = pd.Timestamp(snap.iloc[0]["tomado_en"]).to_pydatetime()
+        hasta_mov = int(snap.iloc[0]["hasta_mov_id"])
+
+    base = qdf("""
+        SELECT faltante_id AS id, producto, categoria, cantidad, unidad, sector, proveedor, estado
+        FROM snapshot_faltantes
+        WHERE snapshot_id = :snap AND local_id = :local
+    """, {"snap": snap_id, "local": local})
+
+    movs = qdf("""
+        SELECT id AS mov_id, faltante_id AS id, creado_en, estado_nuevo
+        FROM movimientos
+        WHERE local_id = :local AND id > :hasta AND creado_en <= :ts AND estado_nuevo IS NOT NULL
+    """, {"local": local, "hasta": hasta_mov, "ts": ts})
+
+    # Los que no estaban en la foto: creados después o con movimientos (reabiertos)
+    ids_extra = sorted(set(movs["id"].astype(int)) - set(base["id"].astype(int)))
+    extra = qdf("""
+        SELECT id, producto, categoria, cantidad, unidad, sector, proveedor,
+               CASE WHEN creado_en > :desde THEN 'Pendiente' END AS estado
+        FROM faltantes_todos
+        WHERE id = ANY(CAST(:ids AS bigint[]))
+           OR (local_id = :local AND creado_en > :desde AND creado_en <= :ts)
+    """, {"ids": ids_extra, "local": local, "desde": desde, "ts": ts})
+
+    df = pd.concat([base[cols], extra[cols]], ignore_index=True).drop_duplicates("id")
+    if df.empty:
+        return pd.DataFrame(columns=cols)
+
+    # Último cambio de estado por faltante (vectorizado sobre el stream de eventos)
+    ultimo = movs.sort_values(["creado_en", "mov_id"]).groupby("id")["estado_nuevo"].last()
+    df["estado"] = df["id"].map(ultimo).fillna(df["estado"])
+    df = df[df["estado"].isin(["Pendiente", "Pedido"])]
+    return tipar(df.sort_values(["sector", "producto"]).reset_index(drop=True), TIPOS_FALTANTES)
+
+
+with seccion("snapshot"):
+    try:
+        snapshot_periodico(SNAPSHOT_HORAS)
+    except Exception:
+        pass  # mantenimiento; nunca debe romper la app
 
 
 # ============================================================
@@ -381,6 +2259,7 @@ def sectores_permitidos():
 # ============================================================
 # Header (Logo opcional)
 # ============================================================
+_t_header = time.perf_counter()
 c_logo, c_title, c_out = st.columns([1, 5, 1])
 
 with c_logo:
@@ -398,33 +2277,26 @@ with c_title:
         """,
         unsafe_allow_html=True
     )
-    st.caption(f"👤 {st.session_state.auth['user']}  |  Rol: {st.session_state.auth['role']}")
+    st.caption(f"👤 {st.session_state.auth['user']}  |  Rol: {st.session_state.auth['role']}  |  📍 {LOCAL}")
+    locales_auth = st.session_state.auth.get("locales") or [LOCAL_DEFAULT]
+    if len(locales_auth) > 1:
+        st.selectbox("Local", locales_auth, index=locales_auth.index(LOCAL), key="local_sel")
 
 with c_out:
     if st.button("Salir", use_container_width=True, key="logout"):
         st.session_state.auth = {"logged": False, "user": None, "role": None}
+        st.session_state.pop("local_sel", None)
         st.rerun()
 
 tab1, tab2, tab3, tab4 = st.tabs(
     ["➕ Cargar", "📋 Pendientes", "📅 Pedidos ", "🛠 Productos / Backup "]
 )
+registrar_seccion("header", _t_header)
 
 
 # ============================================================
 # Maestro productos
 # ============================================================
-def load_product_master():
-    df_prod = qdf("""
-        SELECT nombre, categoria, unidad, proveedor
-        FROM productos
-        WHERE activo = true
-        ORDER BY nombre
-    """)
-    productos = df_prod["nombre"].dropna().tolist() if not df_prod.empty else []
-    prod_map = {r["nombre"]: r for _, r in df_prod.iterrows()} if not df_prod.empty else {}
-    return productos, prod_map
-
-
 def upsert_producto(nombre: str, categoria: str, unidad: str, proveedor: str) -> str:
     nombre = (nombre or "").strip()
     proveedor = (proveedor or "").strip()
@@ -434,15 +2306,17 @@ def upsert_producto(nombre: str, categoria: str, unidad: str, proveedor: str) ->
 
     # Si existe, respetamos categoria guardada (bloqueo real)
     df_check = qdf(
-        "SELECT categoria FROM productos WHERE nombre = :nombre LIMIT 1",
-        {"nombre": nombre},
+        "SELECT categoria FROM productos WHERE local_id = :local AND nombre = :nombre LIMIT 1",
+        {"local": LOCAL, "nombre": nombre},
+        primario=True,
     )
 
     if df_check.empty:
         exec_("""
-            INSERT INTO productos (nombre, categoria, unidad, proveedor, activo, creado_en, actualizado_en)
-            VALUES (:nombre, :categoria, :unidad, :proveedor, true, now(), now())
+            INSERT INTO productos (local_id, nombre, categoria, unidad, proveedor, activo, creado_en, actualizado_en)
+            VALUES (:local, :nombre, :categoria, :unidad, :proveedor, true, now(), now())
         """, {
+            "local": LOCAL,
             "nombre": nombre,
             "categoria": categoria,
             "unidad": unidad,
@@ -461,21 +2335,211 @@ def upsert_producto(nombre: str, categoria: str, unidad: str, proveedor: str) ->
         SET unidad = :unidad,
             proveedor = :proveedor,
             actualizado_en = now()
-        WHERE nombre = :nombre
+        WHERE local_id = :local AND nombre = :nombre
     """, {
         "unidad": unidad,
         "proveedor": proveedor,
+        "local": LOCAL,
         "nombre": nombre,
     })
 
     return categoria
+
+
+# ============================================================
+# Sugerencias de reposición (historial de faltantes, vectorizado)
+# ============================================================
+REPO_ALPHA = 0.4          # suavizado exponencial de intervalos y cantidades
+REPO_MIN_EVENTOS = 3      # mínimo de faltantes previos para sugerir
+REPO_UMBRAL = 0.8         # sugerir cuando pasó el 80% del intervalo típico
+REPO_DIAS_HISTORIA = 365
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def perfil_reposicion(version: str, local: str) -> pd.DataFrame:
+    # Una fila por (producto, sector): último faltante, intervalo y cantidad suavizados
+    df_h = qdf(f"""
+        SELECT producto, sector, unidad, creado_en, cantidad, estado
+        FROM faltantes_todos
+        WHERE local_id = :local
+          AND creado_en >= now() - interval '{int(REPO_DIAS_HISTORIA)} days'
+        ORDER BY producto, sector, creado_en
+    """, {"local": local})
+    cols = ["producto", "sector", "unidad", "ultimo", "n", "int_ewm", "cant_ewm", "abierto"]
+    if df_h.empty:
+        return pd.DataFrame(columns=cols)
+
+    keys = ["producto", "sector"]
+    df_h["sector"] = df_h["sector"].fillna("")
+    df_h["creado_en"] = pd.to_datetime(df_h["creado_en"], utc=True)
+    df_h["cantidad"] = df_h["cantidad"].fillna(0).astype(float)
+    df_h["abierto"] = df_h["estado"].isin(["Pendiente", "Pedido"])
+    df_h["intervalo"] = df_h.groupby(keys, sort=False)["creado_en"].diff().dt.total_seconds() / 86400
+
+    g = df_h.groupby(keys, sort=False)
+    df_h["int_ewm"] = g["intervalo"].ewm(alpha=REPO_ALPHA, ignore_na=True).mean().reset_index(level=keys, drop=True)
+    df_h["cant_ewm"] = g["cantidad"].ewm(alpha=REPO_ALPHA).mean().reset_index(level=keys, drop=True)
+
+    perfil = df_h.groupby(keys, sort=False).agg(
+        unidad=("unidad", "last"),
+        ultimo=("creado_en", "max"),
+        n=("creado_en", "size"),
+        int_ewm=("int_ewm", "last"),
+        cant_ewm=("cant_ewm", "last"),
+        abierto=("abierto", "any"),
+    ).reset_index()
+    return perfil[cols]
+
+
+def sugerir_reposicion(sectores: list[str], limite: int = 15) -> pd.DataFrame:
+    perfil = perfil_reposicion(leer(version_datos), LOCAL)
+    if perfil.empty:
+        return perfil
+
+    p = perfil[
+        perfil["sector"].isin(sectores)
+        & ~perfil["abierto"]
+        & (perfil["n"] >= REPO_MIN_EVENTOS)
+        & (perfil["int_ewm"] > 0)
+    ]
+    dias = (pd.Timestamp.now(tz="UTC") - p["ultimo"]).dt.total_seconds() / 86400
+    out = pd.DataFrame({
+        "producto": p["producto"],
+        "sector": p["sector"],
+        "cantidad": p["cant_ewm"].round(1),
+        "unidad": p["unidad"],
+        "cada_dias": p["int_ewm"].round(1),
+        "hace_dias": dias.round(1),
+        "score": (dias / p["int_ewm"]).round(2),
+    })
+    out = out[out["score"] >= REPO_UMBRAL]
+    return out.sort_values("score", ascending=False).head(limite).reset_index(drop=True)
+
+
+with seccion("sugerencias"):
+    try:
+        df_sugeridos = sugerir_reposicion(sectores_permitidos())
+    except Exception:
+        df_sugeridos = pd.DataFrame()  # las sugerencias nunca deben romper la carga
+
+
+# ============================================================
+# Carga masiva (texto de WhatsApp o CSV -> un solo INSERT/merge, ver datos.importar_lote)
+# ============================================================
+RE_LINEA_ITEM = re.compile(r"^(?P<producto>.+?)\s+x\s*(?P<cantidad>\d+(?:[.,]\d+)?)\s*(?P<unidad>\S+)?$", re.IGNORECASE)
+
+
+def parsear_texto_lista(texto: str) -> pd.DataFrame:
+    # Mismo formato que el texto de WhatsApp: rubro en mayúsculas y "- Producto x2 kg"
+    rubros = {c.upper(): c for c in CATEGORIAS}
+    filas, rubro = [], ""
+    for linea in (texto or "").splitlines():
+        linea = linea.strip()
+        if not linea or linea.startswith("🧾"):
+            continue
+        es_item = linea[0] in "-•*"
+        linea = linea.lstrip("-•* ").strip()
+        m = RE_LINEA_ITEM.match(linea)
+        if not es_item and not m:
+            if linea.upper() in rubros:
+                rubro = rubros[linea.upper()]
+                continue
+            if linea == linea.upper():
+                continue  # encabezados que no son rubros
+        if m:
+            producto = m.group("producto").strip()
+            cantidad = float(m.group("cantidad").replace(",", "."))
+            unidad = m.group("unidad") or ""
+        else:
+            producto, cantidad, unidad = linea, 1.0, ""
+        filas.append({"producto": producto, "cantidad": cantidad, "unidad": unidad, "categoria": rubro})
+    return pd.DataFrame(filas, columns=["producto", "cantidad", "unidad", "categoria"])
+
+
+def parsear_csv_lista(archivo) -> pd.DataFrame:
+    df = pd.read_csv(archivo, dtype=str).fillna("")
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    if "producto" not in df.columns:
+        raise ValueError("El CSV tiene que tener una columna 'producto'.")
+    for col in ["cantidad", "unidad", "categoria", "proveedor", "notas"]:
+        if col not in df.columns:
+            df[col] = ""
+    df["cantidad"] = pd.to_numeric(df["cantidad"].str.replace(",", ".", regex=False), errors="coerce").fillna(1.0)
+    return df[["producto", "cantidad", "unidad", "categoria", "proveedor", "notas"]]
+
+
+def importar_faltantes(df: pd.DataFrame, sector: str, prioridad: str) -> tuple[int, int]:
+    # Todo el lote en una transacción (SQL_IMPORTAR). Devuelve (sumados, nuevos).
+    auth = st.session_state.get("auth", {})
+    params = params_lote(df, LOCAL, sector, prioridad, auth.get("user"), auth.get("role"))
+    t0 = time.perf_counter()
+    with transaccion() as c:
+        sumados, nuevos = importar_lote(c, params)
+    _registrar_si_lenta(get_engine(), SQL_IMPORTAR, params, t0)
+    return sumados, nuevos
+
+
+# ============================================================
+# Conteo de stock contra nivel par (planilla por rubro -> faltantes en una sola transacción)
+# ============================================================
+def planilla_conteo(local: str, sector: str, unidades: tuple[str, ...]) -> pd.DataFrame:
+    # Productos activos con su par en el sector y lo que ya está abierto (Pendiente/Pedido).
+    # Lo abierto se cruza en Python (cruzar_abiertos): la unidad del maestro se normaliza como en el import
+    params = {"local": local, "sector": sector}
+    df = qdf("""
+        SELECT p.id, p.nombre, p.categoria, p.unidad, p.proveedor, pp.par
+        FROM productos p
+        LEFT JOIN productos_par pp ON pp.producto_id = p.id AND pp.sector = CAST(:sector AS sector_t)
+        WHERE p.local_id = :local AND p.activo = true
+        ORDER BY p.nombre
+    """, params, primario=True)
+    abiertos = qdf("""
+        SELECT producto, categoria::text AS categoria, unidad::text AS unidad, sum(cantidad) AS abierto
+        FROM faltantes
+        WHERE local_id = :local AND sector = CAST(:sector AS sector_t) AND estado IN ('Pendiente','Pedido')
+        GROUP BY 1, 2, 3
+    """, params, primario=True)
+    return cruzar_abiertos(df, abiertos, unidades)
+
+
+def guardar_conteo(df: pd.DataFrame, lote: pd.DataFrame, sector: str, prioridad: str,
+                   guardar_par: bool) -> tuple[int, int]:
+    # Pares editados + faltantes del conteo en la misma transacción (importar_faltantes se suma a esta)
+    with transaccion() as c:
+        if guardar_par:
+            con_par = df[df["par"].fillna(0) > 0]
+            c.execute(text("""
+                DELETE FROM productos_par
+                WHERE sector = CAST(:sector AS sector_t)
+                  AND producto_id = ANY(CAST(:ids AS bigint[]))
+                  AND producto_id <> ALL(CAST(:con_par AS bigint[]))
+            """), {"sector": sector, "ids": df["id"].astype(int).tolist(),
+                   "con_par": con_par["id"].astype(int).tolist()})
+            c.execute(text("""
+                INSERT INTO productos_par (producto_id, sector, par, local_id, actualizado_en)
+                SELECT id, CAST(:sector AS sector_t), par, :local, now()
+                FROM unnest(CAST(:ids AS bigint[]), CAST(:pares AS double precision[])) AS t(id, par)
+                ON CONFLICT (producto_id, sector) DO UPDATE
+                SET par = EXCLUDED.par, actualizado_en = now()
+                WHERE productos_par.par IS DISTINCT FROM EXCLUDED.par
+            """), {"sector": sector, "local": LOCAL, "ids": con_par["id"].astype(int).tolist(),
+                   "pares": con_par["par"].astype(float).tolist()})
+        if lote.empty:
+            return 0, 0
+        return importar_faltantes(lote, sector, prioridad)
+
+
 # ============================================================
 # TAB 1: Cargar (Supabase)
 # ============================================================
-with tab1:
+with tab1, seccion("Cargar"):
     st.subheader("Nuevo faltante")
 
-    productos_existentes, prod_map = load_product_master()
+    productos_existentes, prod_map = leer(load_product_master, LOCAL)
+
+    if not df_sugeridos.empty:
+        with st.expander(f"💡 Probablemente falten pronto ({len(df_sugeridos)})", expanded=False):
+            st.dataframe(df_sugeridos, use_container_width=True, hide_index=True)
 
     with st.form("form_faltante", clear_on_submit=True):
 
@@ -558,9 +2622,10 @@ with tab1:
 
             # 2) Si ya existe faltante abierto (Pendiente/Pedido) -> sumar cantidad
             df_exist = qdf("""
-                SELECT id, cantidad
+                SELECT id, cantidad, version
                 FROM faltantes
-                WHERE producto = :producto
+                WHERE local_id = :local
+                  AND producto = :producto
                   AND categoria = :categoria
                   AND unidad = :unidad
                   AND sector = :sector
@@ -571,54 +2636,164 @@ with tab1:
                 "producto": producto,
                 "categoria": categoria,
                 "unidad": unidad,
-                "sector": sector
-            })
+                "sector": sector,
+                "local": LOCAL,
+            }, primario=True)
 
             if not df_exist.empty:
                 fid = int(df_exist.iloc[0]["id"])
                 cant_old = float(df_exist.iloc[0]["cantidad"] or 0)
                 cant_new = cant_old + float(cantidad)
 
-                exec_(
-                    "UPDATE faltantes SET cantidad=:cantidad WHERE id=:id",
-                    {"cantidad": cant_new, "id": fid}
-                )
+                with transaccion():
+                    sumado = actualizar_faltante(fid, int(df_exist.iloc[0]["version"]), cantidad=cant_new)
+                    if sumado:
+                        log_mov(fid, "SUMAR_CANTIDAD", nota=f"+{float(cantidad):g} {unidad}")
+
+                if sumado:
+                    st.success(f"✅ Ya existía → sumé cantidad: {cant_new:g} {unidad}")
+                    st.rerun()
+
+                st.warning("⚠ Ese faltante se acaba de modificar desde otro dispositivo. Volvé a cargarlo.")
+
+            else:
+                # 3) Insert nuevo faltante
+                with transaccion() as c:
+                    res = c.execute(
+                        text("""
+                            INSERT INTO faltantes
+                            (creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, notas, local_id)
+                            VALUES
+                            (now(), :producto, :categoria, :cantidad, :unidad, :prioridad, :sector, :proveedor, 'Pendiente', :notas, :local)
+                            RETURNING id
+                        """),
+                        {
+                            "local": LOCAL,
+                            "producto": producto,
+                            "categoria": categoria,
+                            "cantidad": float(cantidad),
+                            "unidad": unidad,
+                            "prioridad": prioridad,
+                            "sector": sector,
+                            "proveedor": proveedor,
+                            "notas": notas
+                        }
+                    )
+                    fid = int(res.scalar_one())
+                    log_mov(fid, "ALTA", "", "Pendiente")
+
+                st.success("✅ Cargado correctamente")
+                st.rerun()      
+
+    st.divider()
+    with st.expander("📥 Carga masiva (texto de WhatsApp o CSV)", expanded=False):
+        st.caption(
+            "Pegá una lista con el formato del pedido de WhatsApp (\"- Peceto x2 kg\", rubros en mayúsculas) "
+            "o subí un CSV con columnas producto, cantidad, unidad (opcionales: categoria, proveedor, notas)."
+        )
+        texto_masivo = st.text_area("Lista", height=180, key="bulk_texto")
+        # El uploader no se puede vaciar desde session_state: se rota su key después de importar
+        csv_masivo = st.file_uploader("O subir CSV", type=["csv"],
+                                      key=f"bulk_csv_{st.session_state.get('bulk_csv_n', 0)}")
 
-                # (opcional) log movimiento si tenés tabla movimientos
-                # exec_("INSERT INTO movimientos (...) VALUES (...)", {...})
+        b1, b2 = st.columns(2)
+        with b1:
+            sector_masivo = st.selectbox("Sector", sectores_permitidos(), index=0, key="bulk_sector")
+        with b2:
+            prioridad_masiva = st.selectbox("Prioridad", PRIORIDAD, index=0, key="bulk_prioridad")
 
-                st.success(f"✅ Ya existía → sumé cantidad: {cant_new:g} {unidad}")
+        try:
+            df_lote = parsear_csv_lista(csv_masivo) if csv_masivo is not None else parsear_texto_lista(texto_masivo)
+        except Exception as e:
+            st.error(f"No se pudo leer el CSV: {e}")
+            df_lote = pd.DataFrame()
+
+        if not df_lote.empty:
+            df_lote = resolver_lote(df_lote, prod_map, dominios()["unidad_t"])
+
+        if df_lote.empty:
+            st.info("Sin líneas para importar.")
+        else:
+            n_nuevos_maestro = int((~df_lote["en_maestro"]).sum())
+            st.caption(
+                f"{len(df_lote)} líneas · {n_nuevos_maestro} productos nuevos en el maestro "
+                "(se suman a los faltantes abiertos iguales, como en el formulario)."
+            )
+            st.dataframe(df_lote, use_container_width=True, hide_index=True)
+
+            if st.button(f"📥 Importar {len(df_lote)} líneas", use_container_width=True, key="bulk_importar"):
+                sumados, nuevos = importar_faltantes(df_lote, sector_masivo, prioridad_masiva)
+                st.session_state.pop("bulk_texto", None)
+                st.session_state["bulk_csv_n"] = st.session_state.get("bulk_csv_n", 0) + 1
+                st.success(f"✅ Importado: {nuevos} nuevos, {sumados} sumados a faltantes abiertos.")
                 st.rerun()
 
-            # 3) Insert nuevo faltante
-            exec_("""
-                INSERT INTO faltantes
-                (creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, notas)
-                VALUES
-                (now(), :producto, :categoria, :cantidad, :unidad, :prioridad, :sector, :proveedor, 'Pendiente', :notas)
-            """, {
-                "producto": producto,
-                "categoria": categoria,
-                "cantidad": float(cantidad),
-                "unidad": unidad,
-                "prioridad": prioridad,
-                "sector": sector,
-                "proveedor": proveedor,
-                "notas": notas
-            })
+    with st.expander("📋 Conteo de stock (contra nivel par)", expanded=False):
+        st.caption(
+            "Contá lo que hay de un rubro entero y guardá una sola vez: por cada producto con par se carga "
+            "como faltante lo que falta para llegar al par (descontando lo que ya está Pendiente/Pedido). "
+            "Lo que no se cuenta queda afuera."
+        )
+        k1, k2, k3 = st.columns(3)
+        with k1:
+            sector_conteo = st.selectbox("Sector", sectores_permitidos(), index=0, key="conteo_sector")
+        with k2:
+            rubro_conteo = st.selectbox("Rubro", ["", "Todos"] + CATEGORIAS, index=0, key="conteo_rubro",
+                                        format_func=lambda x: x or "Elegí un rubro")
+        with k3:
+            prioridad_conteo = st.selectbox("Prioridad", PRIORIDAD, index=0, key="conteo_prioridad")
+
+        if not rubro_conteo:
+            st.info("Elegí un rubro para abrir la planilla.")
+        else:
+            df_conteo = leer(planilla_conteo, LOCAL, sector_conteo, dominios()["unidad_t"])
+            if rubro_conteo != "Todos":
+                df_conteo = df_conteo[df_conteo["categoria"] == rubro_conteo]
 
-            st.success("✅ Cargado correctamente")
-            st.rerun()      
+            if df_conteo.empty:
+                st.info("No hay productos activos en ese rubro.")
+            else:
+                es_admin_conteo = st.session_state.auth["role"] == "Admin"
+                df_conteo = df_conteo.assign(hay=float("nan")).reset_index(drop=True)
+                with st.form("form_conteo", clear_on_submit=True):
+                    df_contado = st.data_editor(
+                        df_conteo,
+                        column_order=["nombre", "unidad", "par", "abierto", "hay"],
+                        column_config={
+                            "nombre": st.column_config.TextColumn("Producto"),
+                            "unidad": st.column_config.TextColumn("Unidad"),
+                            "par": st.column_config.NumberColumn("Par", min_value=0.0, step=0.5, format="%g"),
+                            "abierto": st.column_config.NumberColumn("Ya pedido", format="%g"),
+                            "hay": st.column_config.NumberColumn("Hay", min_value=0.0, step=0.5, format="%g"),
+                        },
+                        disabled=["nombre", "unidad", "abierto"] + ([] if es_admin_conteo else ["par"]),
+                        hide_index=True,
+                        use_container_width=True,
+                        key=f"conteo_ed_{sector_conteo}_{rubro_conteo}",
+                    )
+                    if not es_admin_conteo:
+                        st.caption("El par lo define el Admin.")
+                    guardar_cont = st.form_submit_button("💾 Guardar conteo", use_container_width=True)
+
+                if guardar_cont:
+                    lote_conteo = faltantes_de_conteo(df_contado)
+                    if not lote_conteo.empty:
+                        lote_conteo = resolver_lote(lote_conteo, prod_map, dominios()["unidad_t"])
+                    sumados, nuevos = guardar_conteo(df_contado, lote_conteo, sector_conteo, prioridad_conteo,
+                                                     guardar_par=es_admin_conteo)
+                    st.success(f"✅ Conteo guardado: {nuevos} faltantes nuevos, {sumados} sumados a abiertos.")
+                    st.rerun()
 
 
 # ============================================================
 # TAB 2: Lista + WhatsApp + Recibir Todo (Supabase)
 # ============================================================
-with tab2:
+with tab2, seccion("Pendientes"):
+    mostrar_conflictos()
     sub1, sub2 = st.tabs(["📋 Lista", "🧾 Pedido WhatsApp"])
 
     # ---------- SUBTAB LISTA ----------
-    with sub1:
+    with sub1, seccion("Lista"):
         st.subheader("Lista")
 
         with st.expander("🔎 Filtros", expanded=False):
@@ -632,13 +2807,24 @@ with tab2:
             else:
                 f_sector = []  # se filtra automático por rol
 
-            f_categoria = st.multiselect("Categoría", CATEGORIAS, default=[], key="f_categoria")
+            f_categoria = st.multiselect("Categoría", dominios()["categoria_t"], default=[], key="f_categoria")
             f_prioridad = st.multiselect("Prioridad", PRIORIDAD, default=[], key="f_prioridad")
             f_proveedor = st.text_input("Proveedor contiene", value="", key="f_proveedor")
-            buscar = st.text_input("Buscar producto", value="", key="f_buscar")
+            buscar = st.text_input("Buscar (producto o notas)", value="", key="f_buscar")
+
+        # Traer desde Supabase (con texto a buscar, la búsqueda la hace Postgres)
+        if buscar.strip() or f_proveedor.strip():
+            df = leer(buscar_faltantes, LOCAL, buscar.strip(), f_proveedor.strip())
+        else:
+            df = leer(lista_faltantes, LOCAL)
+        df = aplicar_journal(df)
 
-        # Traer todo desde Supabase
-        df = qdf("SELECT * FROM faltantes ORDER BY id DESC")
+        if WRITE_BEHIND:
+            _, n_pend_sync, n_err_sync = journal_estado()
+            if n_pend_sync:
+                st.caption(f"⏳ {n_pend_sync} cambios pendientes de sincronizar")
+            if n_err_sync:
+                st.warning(f"⚠ {n_err_sync} cambios no se pudieron aplicar (ver {JOURNAL_PATH})")
 
         # Filtro por rol automático
         role = st.session_state.auth["role"]
@@ -654,37 +2840,119 @@ with tab2:
             df = df[df["categoria"].isin(f_categoria)]
         if f_prioridad and not df.empty:
             df = df[df["prioridad"].isin(f_prioridad)]
-        if f_proveedor.strip() and not df.empty:
-            df = df[df["proveedor"].fillna("").str.contains(f_proveedor.strip(), case=False, na=False)]
-        if buscar.strip() and not df.empty:
-            df = df[df["producto"].fillna("").str.contains(buscar.strip(), case=False, na=False)]
+
+        # Métricas desde faltantes_counters cuando los filtros son por sector/categoría/estado;
+        # con filtros de texto/prioridad o cambios sin sincronizar se cuentan sobre el DF
+        hay_pendientes_sync = WRITE_BEHIND and bool(journal_estado()[1])
+        if f_prioridad or f_proveedor.strip() or buscar.strip() or hay_pendientes_sync:
+            n_por_estado = df["estado"].value_counts() if not df.empty else pd.Series(dtype="int64")
+        else:
+            cnt = leer(contadores_faltantes, LOCAL)
+            if role in ["Cocina", "Barra", "Salón"]:
+                cnt = cnt[cnt["sector"] == role]
+            if f_sector:
+                cnt = cnt[cnt["sector"].isin(f_sector)]
+            if f_categoria:
+                cnt = cnt[cnt["categoria"].isin(f_categoria)]
+            if f_estado:
+                cnt = cnt[cnt["estado"].isin(f_estado)]
+            n_por_estado = cnt.groupby("estado")["n"].sum()
 
         cA, cB, cC = st.columns(3)
-        cA.metric("Pendientes", int((df["estado"] == "Pendiente").sum()) if not df.empty else 0)
-        cB.metric("Pedido", int((df["estado"] == "Pedido").sum()) if not df.empty else 0)
-        cC.metric("Total", int(len(df)))
+        cA.metric("Pendientes", int(n_por_estado.get("Pendiente", 0)))
+        cB.metric("Pedido", int(n_por_estado.get("Pedido", 0)))
+        cC.metric("Total", int(n_por_estado.sum()))
+
+        if is_admin:
+            cnt_abiertos = leer(contadores_faltantes, LOCAL)
+            cnt_abiertos = cnt_abiertos[cnt_abiertos["estado"].isin(["Pendiente", "Pedido"])]
+            por_sector = cnt_abiertos.groupby("sector")["n"].sum()
+            st.caption("Abiertos por sector: " + " · ".join(f"{s} {int(por_sector.get(s, 0))}" for s in SECTORES))
 
-        # Recibir todo lo que está en Pedido (sobre DF filtrado)
+        vistas = versiones_en_pantalla("lista", df)
+
+        # Recibir todo lo que está en Pedido (sobre DF filtrado; solo lo que se veía en pantalla)
         df_pedido = df[df["estado"] == "Pedido"] if not df.empty else pd.DataFrame()
         if not df_pedido.empty:
             if st.button("📦 Recibir TODO el pedido", use_container_width=True, key="btn_recibir_todo"):
-                ids = df_pedido["id"].astype(int).tolist()
-
-                exec_("UPDATE faltantes SET estado='Recibido' WHERE id = ANY(:ids::bigint[])", {"ids": ids})
+                ids = [i for i in df_pedido["id"].astype(int).tolist() if i in vistas]
 
-                for fid_ in ids:
-                    log_mov(int(fid_), "RECIBIR_TODO", "Pedido", "Recibido")
+                conflictos = cambiar_estado(ids, [vistas[i] for i in ids], "Recibido", "Pedido", "RECIBIR_TODO")
 
-                st.success(f"✅ {len(ids)} ítems marcados como Recibido.")
+                st.success(f"✅ {len(ids) - len(conflictos)} ítems marcados como Recibido.")
                 st.rerun()
 
         st.divider()
 
+        # Vista compacta: una tabla con selección + una barra de acciones (cantidad fija de widgets)
+        compacta = st.toggle("📱 Vista compacta", key="lista_compacta")
+
         if df.empty:
             st.info("No hay faltantes con esos filtros.")
+        elif compacta:
+            is_admin = st.session_state.auth["role"] == "Admin"
+            df_tabla = df.reset_index(drop=True)
+
+            creado_ar = pd.to_datetime(df_tabla["creado_en"], utc=True).dt.tz_convert("America/Argentina/Buenos_Aires")
+            vista = pd.DataFrame({
+                "Producto": df_tabla["producto"],
+                "Cant.": df_tabla["cantidad"].fillna(0).astype(float).map("{:g}".format) + " "
+                         + df_tabla["unidad"].astype(object).fillna(""),
+                "Estado": df_tabla["estado"],
+                "Sector": df_tabla["sector"],
+                "Prio.": df_tabla["prioridad"],
+                "Categoría": df_tabla["categoria"],
+                "Proveedor": df_tabla["proveedor"],
+                "Cargado": creado_ar.dt.strftime("%d/%m %H:%M"),
+            })
+
+            # La selección viene por posición sobre la tabla que se dibujó antes; si otro dispositivo
+            # agregó o cerró filas, las posiciones ya no coinciden con df_tabla: se traducen con los
+            # ids de esa tabla
+            ids_dibujados = st.session_state.get("lista_tabla_ids", [])
+            st.session_state["lista_tabla_ids"] = df_tabla["id"].astype(int).tolist()
+
+            evento = st.dataframe(
+                vista,
+                use_container_width=True,
+                hide_index=True,
+                on_select="rerun",
+                selection_mode="multi-row",
+                key="lista_tabla",
+            )
+            ids_sel = {ids_dibujados[i] for i in evento.selection.rows if i < len(ids_dibujados)}
+            sel = df_tabla[df_tabla["id"].astype(int).isin(ids_sel)]
+            sel_abiertos = sel[~sel["estado"].isin(["Recibido", "Anulado"])]
+            sel_anulables = sel[sel["estado"] != "Anulado"]
+
+            st.caption(f"{len(sel)} seleccionados · para editar cantidad/notas usá la vista de tarjetas")
+
+            def aplicar_a_seleccion(filas_sel: pd.DataFrame, estado_nuevo: str):
+                # cambiar_estado registra un estado anterior por llamada: una por estado actual
+                for estado_ant, g in filas_sel.groupby("estado", observed=True):
+                    ids_g = g["id"].astype(int).tolist()
+                    cambiar_estado(ids_g, [vistas.get(i, v) for i, v in zip(ids_g, g["version"].astype(int))],
+                                   estado_nuevo, str(estado_ant))
+                st.session_state.pop("lista_tabla", None)  # las filas cambian: no arrastrar la selección
+
+            a1, a2, a3 = st.columns(3)
+            with a1:
+                if st.button("✅ Pedido", key="tabla_ped", use_container_width=True, disabled=sel_abiertos.empty):
+                    aplicar_a_seleccion(sel_abiertos, "Pedido")
+                    st.rerun()
+            with a2:
+                if st.button("📦 Recibido", key="tabla_rec", use_container_width=True, disabled=sel_abiertos.empty):
+                    aplicar_a_seleccion(sel_abiertos, "Recibido")
+                    st.rerun()
+            with a3:
+                if st.button("🗑️ Anular", key="tabla_anu", use_container_width=True,
+                             disabled=(not is_admin or sel_anulables.empty)):
+                    aplicar_a_seleccion(sel_anulables, "Anulado")
+                    st.rerun()
         else:
             is_admin = st.session_state.auth["role"] == "Admin"
 
+            t_cards = time.perf_counter()
             for _, row in df.iterrows():
                 fid = int(row["id"])
                 producto = row["producto"]
@@ -693,6 +2961,7 @@ with tab2:
                 unidad = row["unidad"]
                 proveedor = row["proveedor"] if row["proveedor"] else "-"
                 estado = str(row["estado"]).strip()
+                version = vistas.get(fid, int(row["version"]))  # la que se vio, no la releída
                 prioridad = row["prioridad"] if row["prioridad"] else "-"
                 categoria = row["categoria"] if row["categoria"] else "-"
                 from zoneinfo import ZoneInfo
@@ -747,37 +3016,22 @@ with tab2:
                     if st.button("✅ Pedido", key=f"card_ped_{fid}", use_container_width=True,
                                 disabled=(estado in ["Recibido", "Anulado"])):
 
-                        exec_(
-                            "UPDATE faltantes SET estado='Pedido' WHERE id=:id",
-                            {"id": fid}
-                        )
-
-                        log_mov(fid, "CAMBIO_ESTADO", estado, "Pedido")
+                        cambiar_estado([fid], [version], "Pedido", estado)
                         st.rerun()
 
                 with b2:
                     if st.button("📦 Recibido", key=f"card_rec_{fid}", use_container_width=True,
                                 disabled=(estado in ["Recibido", "Anulado"])):
 
-                        exec_(
-                            "UPDATE faltantes SET estado='Recibido' WHERE id=:id",
-                            {"id": fid}
-                        )
-
-                        log_mov(fid, "CAMBIO_ESTADO", estado, "Recibido")
+                        cambiar_estado([fid], [version], "Recibido", estado)
                         st.rerun()                
                 with b3:
                     if is_admin:
                         if st.button("🗑️ Anular", key=f"card_anu_{fid}", use_container_width=True,
                                     disabled=(estado == "Anulado")):
 
-                           exec_(
-                               "UPDATE faltantes SET estado='Anulado' WHERE id=:id",
-                                {"id": fid}
-                            )
-
-                           log_mov(fid, "CAMBIO_ESTADO", estado, "Anulado")
-                           st.rerun()
+                            cambiar_estado([fid], [version], "Anulado", estado)
+                            st.rerun()
                 
                     else:
                         st.button("🗑️ Anular", use_container_width=True, disabled=True, key=f"card_anu_disabled_{fid}")
@@ -798,29 +3052,28 @@ with tab2:
                         guardar_edit = st.form_submit_button("💾 Guardar")
 
                     if guardar_edit:
-                        exec_(
-                            "UPDATE faltantes SET cantidad=:c, notas=:n WHERE id=:id",
-                            {
-                                "c": float(nueva_cantidad),
-                                "n": nuevas_notas.strip(),
-                                "id": fid
-                            }
-                        )
-
-                        log_mov(fid, "EDITAR_FALTANTE", nota="Edición manual")
+                        with transaccion():
+                            editado = actualizar_faltante(fid, version, cantidad=float(nueva_cantidad),
+                                                          notas=nuevas_notas.strip())
+                            if editado:
+                                log_mov(fid, "EDITAR_FALTANTE", nota="Edición manual")
+
+                        if editado:
+                            st.success("✅ Faltante actualizado")
+                            st.rerun()
 
-                        st.success("✅ Faltante actualizado")
-                        st.rerun()
+                        st.warning("⚠ Otro dispositivo modificó este faltante. Recargá la lista y volvé a editarlo.")
 
                         # 👆👆👆 FIN EDITAR 👆👆👆
 
 
                 st.markdown("</div>", unsafe_allow_html=True)
+            registrar_seccion(f"Lista: {len(df)} tarjetas", t_cards)
 
 
 
     # ---------- SUBTAB WHATSAPP ----------
-    with sub2:
+    with sub2, seccion("Pedido WhatsApp"):
         st.subheader("Pedido WhatsApp (por rubro)")
 
         estados_incluir = st.multiselect(
@@ -831,12 +3084,10 @@ with tab2:
         )
 
         # Traemos Pendiente/Pedido desde DB
-        df_ped = qdf("""
-            SELECT *
-            FROM faltantes
-            WHERE estado IN ('Pendiente','Pedido')
-            ORDER BY categoria, producto
-        """)
+        df_ped = leer(faltantes_abiertos, LOCAL)
+        df_ped = aplicar_journal(df_ped)
+        if not df_ped.empty:
+            df_ped = df_ped[df_ped["estado"].isin(["Pendiente", "Pedido"])]
 
         # Filtro por rol
         role = st.session_state.auth["role"]
@@ -847,12 +3098,18 @@ with tab2:
         if estados_incluir and not df_ped.empty:
             df_ped = df_ped[df_ped["estado"].isin(estados_incluir)]
 
+        if not df_sugeridos.empty:
+            with st.expander(f"💡 Sumar al pedido? Probablemente falten pronto ({len(df_sugeridos)})", expanded=False):
+                st.dataframe(df_sugeridos, use_container_width=True, hide_index=True)
+
+        vistas_wp = versiones_en_pantalla("wp", df_ped)
+
         if df_ped.empty:
             st.info("No hay ítems para generar pedido con esos estados.")
         else:
             hoy = datetime.now().strftime("%d/%m")
 
-            df_ped["categoria"] = df_ped["categoria"].fillna("").astype(str).str.strip()
+            df_ped["categoria"] = df_ped["categoria"].astype(object).fillna("").astype(str).str.strip()
             df_ped.loc[df_ped["categoria"] == "", "categoria"] = "OTROS"
             df_ped = df_ped.sort_values(["categoria", "producto"])
 
@@ -883,34 +3140,33 @@ with tab2:
                 if st.button("💾 Guardar pedido", use_container_width=True, key="wp_guardar"):
                     estados_str = ",".join(estados_incluir)
 
-                    # Insert pedido y obtener ID (Postgres: RETURNING)
-                    with get_engine().begin() as c:
+                    # Pedido + ítems en una sola transacción (ID con RETURNING, ítems en un executemany)
+                    creado_en = datetime.now()
+                    with transaccion() as c:
                         res = c.execute(
                             text("""
-                                INSERT INTO pedidos (fecha, estados_incluidos, texto_wp)
-                                VALUES (current_date, :estados, :texto)
+                                INSERT INTO pedidos (fecha, estados_incluidos, texto_wp, local_id)
+                                VALUES (current_date, :estados, :texto, :local)
                                 RETURNING id
                             """),
-                            {"estados": estados_str, "texto": texto}
+                            {"estados": estados_str, "texto": texto, "local": LOCAL}
                         )
                         pedido_id = int(res.scalar_one())
 
-                    # Insert items
-                    creado_en = datetime.now()
-                    for _, r in df_ped.iterrows():
-                        exec_("""
+                        c.execute(text("""
                             INSERT INTO pedido_items (
                                 pedido_id, faltante_id, producto, categoria, cantidad, unidad,
-                                sector, proveedor, estado, prioridad, creado_en
+                                sector, proveedor, estado, prioridad, creado_en, local_id
                             ) VALUES (
                                 :pedido_id, :faltante_id, :producto, :categoria, :cantidad, :unidad,
-                                :sector, :proveedor, :estado, :prioridad, :creado_en
+                                :sector, :proveedor, :estado, :prioridad, :creado_en, :local
                             )
-                        """, {
+                        """), [{
+                            "local": LOCAL,
                             "pedido_id": pedido_id,
                             "faltante_id": int(r["id"]) if pd.notna(r["id"]) else None,
                             "producto": r.get("producto"),
-                            "categoria": r.get("categoria"),
+                            "categoria": None if r.get("categoria") == "OTROS" else r.get("categoria"),
                             "cantidad": float(r.get("cantidad") or 0),
                             "unidad": r.get("unidad"),
                             "sector": r.get("sector"),
@@ -918,20 +3174,18 @@ with tab2:
                             "estado": r.get("estado"),
                             "prioridad": r.get("prioridad"),
                             "creado_en": creado_en
-                        })
+                        } for _, r in df_ped.iterrows()])
 
                     st.success(f"✅ Pedido guardado (#{pedido_id})")
                     st.rerun()
 
             with col3:
                 if st.button("✅ Pend→Pedido", use_container_width=True, key="wp_btn_marcar"):
-                    ids = df_ped[df_ped["estado"] == "Pendiente"]["id"].astype(int).tolist()
+                    df_pend = df_ped[df_ped["estado"] == "Pendiente"]
+                    ids = [i for i in df_pend["id"].astype(int).tolist() if i in vistas_wp]
                     if ids:
-                        exec_(
-                            "UPDATE faltantes SET estado='Pedido' WHERE id = ANY(:ids::bigint[])",
-                            {"ids": ids}
-                        )
-                        st.success(f"✅ {len(ids)} ítems pasaron a 'Pedido'.")
+                        conflictos = cambiar_estado(ids, [vistas_wp[i] for i in ids], "Pedido", "Pendiente", "PEND_A_PEDIDO")
+                        st.success(f"✅ {len(ids) - len(conflictos)} ítems pasaron a 'Pedido'.")
                         st.rerun()
                     else:
                         st.info("No había Pendientes para marcar.")
@@ -941,7 +3195,120 @@ with tab2:
  # ============================================================
 # TAB 3: Pedidos por fecha + Historial (Supabase)
 # ============================================================
-with tab3:
+# PDF de un pedido guardado: se cachea por id y versión compartida "pedidos" (LRU de 64). Un pedido
+# guardado solo cambia si se borra un producto (se van sus ítems), que invalida la versión.
+# Se dibuja fila por fila con canvas (sin armar un layout platypus en memoria)
+# leyendo los ítems con cursor de servidor.
+def _fmt_totales(tot: dict) -> str:
+    return ", ".join(f"{v:g} {u}" for u, v in tot.items())
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def pedido_pdf(pedido_id: int, version: str) -> bytes:
+    bio = io.BytesIO()
+    pdf = canvas.Canvas(bio, pagesize=A4)
+    ancho, alto = A4
+    margen = 40
+    cols = [margen, margen + 230, margen + 300, margen + 350, margen + 420]
+    largos = [45, 10, 8, 12, 26]
+    y = alto - margen
+
+    def salto(min_y=margen + 20):
+        nonlocal y
+        if y < min_y:
+            pdf.showPage()
+            y = alto - margen
+
+    def fila(valores, font="Helvetica", size=9):
+        nonlocal y
+        salto()
+        pdf.setFont(font, size)
+        for x, largo, v in zip(cols, largos, valores):
+            pdf.drawString(x, y, str(v)[:largo])
+        y -= 13
+
+    with usar_conexion(get_engine()) as c:
+        cab = c.execute(
+            text("SELECT creado_en, estados_incluidos FROM pedidos WHERE id=:id"),
+            {"id": int(pedido_id)}
+        ).first()
+        creado = pd.to_datetime(cab.creado_en, utc=True).tz_convert("America/Argentina/Buenos_Aires")
+
+        pdf.setTitle(f"Pedido {pedido_id}")
+        pdf.setFont("Helvetica-Bold", 16)
+        pdf.drawString(margen, y, f"Pedido #{pedido_id}")
+        y -= 18
+        pdf.setFont("Helvetica", 10)
+        pdf.drawString(margen, y, f"{creado.strftime('%d/%m/%Y %H:%M hs')}  |  Estados: {cab.estados_incluidos or ''}")
+        y -= 24
+
+        # Cursor de servidor solo para esta sentencia: la conexión puede ser la de la corrida y
+        # con la opción puesta en ella todo lo que siga saldría como DECLARE ... CURSOR
+        rows = c.execute(
+            text("""
+                SELECT COALESCE(categoria::text, 'OTROS') AS categoria,
+                       producto, cantidad, unidad, sector, proveedor
+                FROM pedido_items
+                WHERE pedido_id = :pid
+                ORDER BY 1, producto
+            """).execution_options(stream_results=True),
+            {"pid": int(pedido_id)}
+        )
+
+        rubro_actual = None
+        n_rubro, tot_rubro = 0, {}
+        n_total, tot_total = 0, {}
+
+        def cerrar_rubro():
+            nonlocal y
+            if rubro_actual is None:
+                return
+            fila([f"Total {rubro_actual}: {n_rubro} ítems", "", "", "", _fmt_totales(tot_rubro)], "Helvetica-Oblique")
+            y -= 6
+
+        for r in rows:
+            if r.categoria != rubro_actual:
+                cerrar_rubro()
+                rubro_actual, n_rubro, tot_rubro = r.categoria, 0, {}
+                salto(margen + 50)
+                fila([str(rubro_actual).upper()], "Helvetica-Bold", 11)
+                fila(["Producto", "Cantidad", "Unidad", "Sector", "Proveedor"], "Helvetica-Bold", 8)
+
+            cant = float(r.cantidad or 0)
+            fila([r.producto or "", f"{cant:g}", r.unidad or "", r.sector or "", r.proveedor or ""])
+            n_rubro += 1
+            n_total += 1
+            tot_rubro[r.unidad or "-"] = tot_rubro.get(r.unidad or "-", 0) + cant
+            tot_total[r.unidad or "-"] = tot_total.get(r.unidad or "-", 0) + cant
+
+        cerrar_rubro()
+
+    y -= 6
+    fila([f"TOTAL: {n_total} ítems", "", "", "", _fmt_totales(tot_total)], "Helvetica-Bold", 10)
+    pdf.save()
+    return bio.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def pedido_texto_wp(pedido_id: int) -> str:
+    # El texto se trae solo para el pedido que se está viendo (no viaja con el resumen de la página)
+    df_t = qdf("SELECT texto_wp FROM pedidos WHERE id = :pid", {"pid": int(pedido_id)}, primario=True)
+    return "" if df_t.empty else str(df_t.iloc[0]["texto_wp"])
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def pedido_items_df(pedido_id: int, version: str) -> pd.DataFrame:
+    # Por versión compartida "pedidos", como pedido_pdf (se leen del primario: una réplica atrasada
+    # dejaría cacheado un pedido vacío)
+    return qdf("""
+        SELECT producto, categoria, cantidad, unidad, sector, proveedor
+        FROM pedido_items
+        WHERE pedido_id = :pid
+        ORDER BY categoria::text, producto
+    """, {"pid": int(pedido_id)}, primario=True)
+
+
+with tab3, seccion("Pedidos"):
     st.subheader("📅 Pedidos por fecha")
 
     hoy = date.today()
@@ -951,63 +3318,121 @@ with tab3:
     with c2:
         hasta = st.date_input("Hasta", value=hoy, key="p_hasta")
 
-    df_p = qdf("""
-        SELECT id, creado_en, fecha, estados_incluidos
-        FROM pedidos
-        WHERE fecha BETWEEN :desde AND :hasta
-        ORDER BY id DESC
-    """, {
-        "desde": desde,
-        "hasta": hasta
-    })
+    # Paginación keyset: pila de "id < cursor" por página; se reinicia si cambia el rango
+    if st.session_state.get("p_rango") != (LOCAL, desde, hasta):
+        st.session_state["p_rango"] = (LOCAL, desde, hasta)
+        st.session_state["p_cursores"] = [None]
+    cursores = st.session_state["p_cursores"]
+
+    df_p = leer(pedidos_resumen, LOCAL, desde, hasta, cursores[-1])
 
     if df_p.empty:
         st.info("No hay pedidos guardados en ese rango.")
     else:
+        df_p["creado_txt"] = (
+            pd.to_datetime(df_p["creado_en"], utc=True)
+            .dt.tz_convert("America/Argentina/Buenos_Aires")
+            .dt.strftime("%d/%m/%Y %H:%M hs")
+        )
+        df_p = df_p.set_index("id", drop=False)
+        etiquetas = {
+            int(i): f"Pedido #{i} — {t} ({n} ítems)"
+            for i, t, n in zip(df_p["id"], df_p["creado_txt"], df_p["items"])
+        }
+
+        st.dataframe(
+            df_p[["id", "creado_txt", "items", "unidades", "categorias"]],
+            use_container_width=True,
+            hide_index=True,
+        )
+
+        cp1, cp2 = st.columns(2)
+        with cp1:
+            if st.button("◀ Más nuevos", use_container_width=True, key="p_prev", disabled=len(cursores) <= 1):
+                cursores.pop()
+                st.rerun()
+        with cp2:
+            if st.button("Más viejos ▶", use_container_width=True, key="p_next",
+                         disabled=len(df_p) < PEDIDOS_POR_PAGINA):
+                cursores.append(int(df_p["id"].iloc[-1]))
+                st.rerun()
+
         pid = st.selectbox(
             "Seleccioná un pedido",
-            options=df_p["id"].tolist(),
-            format_func=lambda x: (
-                f"Pedido #{x} — " +
-                pd.to_datetime(
-                    df_p.loc[df_p['id']==x,'creado_en'].iloc[0],
-                    utc=True
+            options=list(etiquetas.keys()),
+            format_func=etiquetas.get,
+            key="p_sel"
         )
-        .tz_convert("America/Argentina/Buenos_Aires")
-        .strftime("%d/%m/%Y %H:%M hs")
-    ),
-    key="p_sel"
-)
 
-        cab = qdf("SELECT * FROM pedidos WHERE id=:id", {"id": int(pid)}).iloc[0]
-        creado = pd.to_datetime(cab["creado_en"], utc=True)
-        creado = creado.tz_convert("America/Argentina/Buenos_Aires")
-        creado = creado.strftime("%d/%m/%Y %H:%M hs")
+        if pid not in etiquetas:  # quedó seleccionado uno de otra página
+            pid = next(iter(etiquetas))
+
+        cab = df_p.loc[int(pid)]
+        creado = cab["creado_txt"]
 
         st.write(
             f"**Creado:** {creado}  |  **Estados incluidos:** {cab.get('estados_incluidos', '')}"
 )
 
-        st.text_area("Texto WhatsApp guardado", value=str(cab["texto_wp"]), height=260, key="p_texto")
+        texto_wp = pedido_texto_wp(int(pid))
+        st.text_area("Texto WhatsApp guardado", value=texto_wp, height=260, key="p_texto")
 
-        df_items = qdf("""
-            SELECT producto, categoria, cantidad, unidad, sector, proveedor
-            FROM pedido_items
-            WHERE pedido_id = :pid
-            ORDER BY categoria, producto
-        """, {"pid": int(pid)})
+        v_pedidos = version_compartida("pedidos")
+        df_items = pedido_items_df(int(pid), v_pedidos)
 
         st.dataframe(df_items, use_container_width=True)
 
         st.download_button(
             "⬇️ Descargar pedido seleccionado (.txt)",
-            data=str(cab["texto_wp"]).encode("utf-8"),
+            data=texto_wp.encode("utf-8"),
             file_name=f"pedido_{pid}.txt",
             mime="text/plain",
             use_container_width=True,
             key="p_dl"
         )
 
+        try:
+            st.download_button(
+                "⬇️ Descargar pedido seleccionado (.pdf)",
+                data=pedido_pdf(int(pid), v_pedidos),
+                file_name=f"pedido_{pid}.pdf",
+                mime="application/pdf",
+                use_container_width=True,
+                key="p_dl_pdf"
+            )
+        except Exception as e:
+            st.warning(f"No se pudo generar el PDF: {e}")
+
+    st.divider()
+    st.subheader("🕰 Qué estaba abierto a una fecha")
+
+    # Por defecto, ahora en Buenos Aires (el servidor puede estar en UTC)
+    ahora_ar = datetime.now(ZoneInfo("America/Argentina/Buenos_Aires")).replace(second=0, microsecond=0)
+    c1, c2, c3 = st.columns([2, 2, 1])
+    with c1:
+        tt_fecha = st.date_input("Fecha", value=ahora_ar.date(), key="tt_fecha", format="DD/MM/YYYY")
+    with c2:
+        tt_hora = st.time_input("Hora", value=ahora_ar.time(), key="tt_hora")
+    with c3:
+        st.write("")
+        if st.button("🔎 Ver", use_container_width=True, key="tt_ver"):
+            st.session_state["tt_ts"] = (
+                pd.Timestamp(datetime.combine(tt_fecha, tt_hora))
+                .tz_localize("America/Argentina/Buenos_Aires")
+                .to_pydatetime()
+            )
+
+    if st.session_state.get("tt_ts") is not None:
+        tt_ts = st.session_state["tt_ts"]
+        df_tt = estado_a_fecha(LOCAL, tt_ts)
+        df_tt = df_tt[df_tt["sector"].isin(sectores_permitidos())]
+        st.caption(
+            f"{len(df_tt)} faltantes Pendiente/Pedido al "
+            f"{pd.Timestamp(tt_ts).tz_convert('America/Argentina/Buenos_Aires').strftime('%d/%m/%Y %H:%M')} hs "
+            "(la cantidad es la de la foto diaria anterior, o la actual si se cargó después)."
+        )
+        st.dataframe(df_tt, use_container_width=True, hide_index=True)
+
     st.divider()
     st.subheader("📜 Historial de movimientos")
 
@@ -1018,22 +3443,7 @@ with tab3:
         hist_limite = st.selectbox("Mostrar", [50, 100, 200, 500], index=1, key="hist_limite")
 
     # Traemos movimientos + nombre del producto
-    df_hist = qdf(f"""
-    SELECT
-        m.creado_en,
-        m.usuario,
-        m.rol,
-        m.faltante_id,
-        f.producto,
-        m.accion,
-        m.estado_anterior,
-        m.estado_nuevo,
-        m.nota
-    FROM movimientos m
-    JOIN faltantes f ON f.id = m.faltante_id
-    ORDER BY m.id DESC
-    LIMIT {int(hist_limite)}
-    """)
+    df_hist = leer(historial_movimientos, LOCAL, int(hist_limite))
 
 # Filtro buscar
 if hist_buscar.strip() and not df_hist.empty:
@@ -1057,20 +3467,21 @@ import zipfile
 # ============================================================
 # TAB 4: Maestro de Productos + Backup (Supabase)
 # ============================================================
-with tab4:
+with tab4, seccion("Productos / Backup"):
     st.subheader("🛠 Productos / Backup")
 
     role = st.session_state.auth["role"]
     is_admin = role == "Admin"
 
-    sub_new, sub_list, sub_backup = st.tabs(
-        ["➕ Nuevo producto", "📋 Productos", "💾 Backup / Restore"]
+    sub_new, sub_list, sub_stats, sub_slow, sub_perfil, sub_backup = st.tabs(
+        ["➕ Nuevo producto", "📋 Productos", "📊 Estadísticas", "🐢 Consultas lentas", "⏱ Perfil",
+         "💾 Backup / Restore"]
     )
 
     # ============================================================
     # SUBTAB: NUEVO PRODUCTO
     # ============================================================
-    with sub_new:
+    with sub_new, seccion("Nuevo producto"):
         st.markdown("### ➕ Cargar nuevo producto")
 
         with st.form("form_add_producto", clear_on_submit=True):
@@ -1090,18 +3501,20 @@ with tab4:
                 st.error("El nombre es obligatorio.")
             else:
                 df_check = qdf(
-                    "SELECT id FROM productos WHERE lower(nombre)=lower(:n) LIMIT 1",
-                    {"n": nombre},
+                    "SELECT id FROM productos WHERE local_id = :local AND lower(nombre)=lower(:n) LIMIT 1",
+                    {"local": LOCAL, "n": nombre},
+                    primario=True,
                 )
                 if not df_check.empty:
                     st.error("Ya existe un producto con ese nombre.")
                 else:
                     exec_(
                         """
-                        INSERT INTO productos (nombre, categoria, unidad, proveedor, activo, creado_en, actualizado_en)
-                        VALUES (:nombre, :categoria, :unidad, :proveedor, :activo, now(), now())
+                        INSERT INTO productos (local_id, nombre, categoria, unidad, proveedor, activo, creado_en, actualizado_en)
+                        VALUES (:local, :nombre, :categoria, :unidad, :proveedor, :activo, now(), now())
                         """,
                         {
+                            "local": LOCAL,
                             "nombre": nombre,
                             "categoria": n_categoria,
                             "unidad": n_unidad,
@@ -1115,7 +3528,7 @@ with tab4:
     # ============================================================
     # SUBTAB: LISTADO + EDITAR + ELIMINAR + HISTORIAL
     # ============================================================
-    with sub_list:
+    with sub_list, seccion("Productos"):
         st.markdown("### 📋 Productos cargados")
 
         col_f1, col_f2 = st.columns(2)
@@ -1128,13 +3541,7 @@ with tab4:
 
         solo_activos = st.checkbox("Solo activos", value=True, key="prod_solo_activos")
 
-        df_prod = qdf(
-            """
-            SELECT id, nombre, categoria, unidad, proveedor, activo
-            FROM productos
-            ORDER BY nombre
-            """
-        )
+        df_prod = leer(productos_todos, LOCAL)
 
         if df_prod.empty:
             st.info("No hay productos cargados todavía.")
@@ -1219,8 +3626,9 @@ with tab4:
                     st.stop()
 
                 df_check = qdf(
-                    "SELECT id FROM productos WHERE lower(nombre)=lower(:n) LIMIT 1",
-                    {"n": nuevo_nombre},
+                    "SELECT id FROM productos WHERE local_id = :local AND lower(nombre)=lower(:n) LIMIT 1",
+                    {"local": LOCAL, "n": nuevo_nombre},
+                    primario=True,
                 )
                 if not df_check.empty and int(df_check.iloc[0]["id"]) != int(prod_id):
                     st.error("Ya existe un producto con ese nombre. No se puede duplicar.")
@@ -1249,24 +3657,27 @@ with tab4:
                     },
                 )
 
-                # Propagar a faltantes existentes por nombre viejo (si cambió)
-                exec_(
-                    """
-                    UPDATE faltantes
-                    SET producto=:nuevo,
-                        categoria=:categoria,
-                        unidad=:unidad,
-                        proveedor=:proveedor
-                    WHERE producto=:viejo
-                    """,
-                    {
-                        "nuevo": nuevo_nombre,
-                        "viejo": old_name,
-                        "categoria": categoria,
-                        "unidad": unidad,
-                        "proveedor": (proveedor or "").strip(),
-                    },
-                )
+                # Propagar a faltantes existentes por nombre viejo (si cambió), activos e histórico
+                for tabla in ("faltantes", "faltantes_historico"):
+                    exec_(
+                        f"""
+                        UPDATE {tabla}
+                        SET producto=:nuevo,
+                            categoria=:categoria,
+                            unidad=:unidad,
+                            proveedor=:proveedor
+                            {", version = version + 1" if tabla == "faltantes" else ""}
+                        WHERE local_id=:local AND producto=:viejo
+                        """,
+                        {
+                            "local": LOCAL,
+                            "nuevo": nuevo_nombre,
+                            "viejo": old_name,
+                            "categoria": categoria,
+                            "unidad": unidad,
+                            "proveedor": (proveedor or "").strip(),
+                        },
+                    )
 
                 st.success("✅ Producto actualizado en maestro y faltantes.")
                 st.rerun()
@@ -1302,28 +3713,40 @@ with tab4:
                             key="btn_confirm_delete_prod",
                         ):
                             df_rel = qdf(
-                                "SELECT COUNT(*) AS total FROM faltantes WHERE producto=:p",
-                                {"p": prod["nombre"]},
+                                "SELECT COUNT(*) AS total FROM faltantes_todos WHERE local_id=:local AND producto=:p",
+                                {"local": LOCAL, "p": prod["nombre"]},
+                                primario=True,
                             )
                             total_rel = int(df_rel.iloc[0]["total"]) if not df_rel.empty else 0
 
                             # ids de faltantes relacionados a este producto
-                            df_ids = qdf("SELECT id FROM faltantes WHERE producto=:p", {"p": prod["nombre"]})
+                            df_ids = qdf(
+                                "SELECT id FROM faltantes_todos WHERE local_id=:local AND producto=:p",
+                                {"local": LOCAL, "p": prod["nombre"]},
+                                primario=True,
+                            )
                             ids = df_ids["id"].astype(int).tolist() if not df_ids.empty else []
 
                             # (opcional) borrar historial de movimientos de esos faltantes
                             if ids:
-                                exec_("DELETE FROM movimientos WHERE faltante_id = ANY(:ids::bigint[])", {"ids": ids})
+                                exec_("DELETE FROM movimientos WHERE faltante_id = ANY(CAST(:ids AS bigint[]))", {"ids": ids})
 
                                 # (opcional) borrar ítems de pedidos que apunten a esos faltantes
-                                exec_("DELETE FROM pedido_items WHERE faltante_id = ANY(:ids::bigint[])", {"ids": ids})
+                                exec_("DELETE FROM pedido_items WHERE faltante_id = ANY(CAST(:ids AS bigint[]))", {"ids": ids})
 
                                 # borrar faltantes del producto
-                                exec_("DELETE FROM faltantes WHERE id = ANY(:ids::bigint[])", {"ids": ids})
+                                exec_("DELETE FROM faltantes WHERE id = ANY(CAST(:ids AS bigint[]))", {"ids": ids})
+                                exec_("DELETE FROM faltantes_historico WHERE id = ANY(CAST(:ids AS bigint[]))", {"ids": ids})
 
                             # borrar producto
                             exec_("DELETE FROM productos WHERE id=:id", {"id": int(prod_id)})
 
+                            # Los pedidos guardados perdieron ítems: este proceso ya, las demás réplicas por versión
+                            if ids:
+                                pedido_pdf.clear()
+                                pedido_items_df.clear()
+                                invalidar_compartida("pedidos")
+
                             st.success("🗑 Producto eliminado (incluye faltantes asociados).")
                             st.session_state["confirm_delete_prod_flag"] = False
                             st.rerun()
@@ -1355,12 +3778,12 @@ with tab4:
                         m.estado_nuevo,
                         m.nota
                     FROM movimientos m
-                    JOIN faltantes f ON f.id = m.faltante_id
-                    WHERE f.producto = :p
+                    JOIN faltantes_todos f ON f.id = m.faltante_id
+                    WHERE f.local_id = :local AND f.producto = :p
                     ORDER BY m.id DESC
                     LIMIT 300
                     """,
-                    {"p": nombre_prod},
+                    {"local": LOCAL, "p": nombre_prod},
                 )
 
                 if df_hist_prod.empty:
@@ -1374,26 +3797,249 @@ with tab4:
                     )
                     st.dataframe(df_hist_prod, use_container_width=True)
 
+    # ============================================================
+    # SUBTAB: ESTADÍSTICAS (lee solo las tablas de resumen)
+    # ============================================================
+    with sub_stats, seccion("Estadísticas"):
+        st.markdown("### 📊 Estadísticas por producto / proveedor")
+
+        if not is_admin:
+            st.info("Solo el Admin puede ver las estadísticas.")
+        else:
+            try:
+                refrescar_stats_periodico()
+            except Exception as e:
+                st.warning(f"No se pudieron actualizar las estadísticas: {e}")
+
+            if st.button("🔄 Actualizar ahora", use_container_width=True, key="btn_stats_refresh"):
+                n_mov = refrescar_stats()
+                soltar_turno("stats")
+                st.success(f"✅ {n_mov} movimientos nuevos procesados.")
+
+            df_stats = qdf("""
+                SELECT
+                    producto,
+                    proveedor,
+                    veces,
+                    round((seg_pend_pedido / NULLIF(n_pedido, 0) / 3600)::numeric, 1) AS hs_pend_a_pedido,
+                    round((seg_pedido_recibido / NULLIF(n_recibido_con_pedido, 0) / 3600)::numeric, 1) AS hs_pedido_a_recibido,
+                    round((seg_pend_recibido / NULLIF(n_recibido, 0) / 3600)::numeric, 1) AS hs_total,
+                    cantidad_recibida,
+                    ultimo_faltante
+                FROM stats_producto
+                WHERE local_id = :local
+                ORDER BY veces DESC, producto
+                LIMIT 200
+            """, {"local": LOCAL})
+
+            if df_stats.empty:
+                st.info("Todavía no hay estadísticas.")
+            else:
+                df_stats["ultimo_faltante"] = (
+                    pd.to_datetime(df_stats["ultimo_faltante"], utc=True)
+                    .dt.tz_convert("America/Argentina/Buenos_Aires")
+                    .dt.strftime("%d/%m/%Y")
+                )
+                st.dataframe(df_stats, use_container_width=True)
+
+            st.markdown("#### Últimas 12 semanas")
+            df_sem = qdf("""
+                SELECT semana, sum(veces) AS veces, sum(cantidad_recibida) AS cantidad_recibida
+                FROM stats_semanal
+                WHERE local_id = :local AND semana >= current_date - 84
+                GROUP BY semana
+                ORDER BY semana
+            """, {"local": LOCAL})
+            if df_sem.empty:
+                st.info("Sin datos semanales.")
+            else:
+                st.bar_chart(df_sem.set_index("semana")[["veces"]])
+
+                prod_sem = st.selectbox(
+                    "Cantidad recibida por semana de",
+                    [""] + (df_stats["producto"].drop_duplicates().tolist() if not df_stats.empty else []),
+                    key="stats_prod_sem",
+                )
+                if prod_sem:
+                    df_sem_p = qdf("""
+                        SELECT semana, sum(veces) AS veces, sum(cantidad_recibida) AS cantidad_recibida
+                        FROM stats_semanal
+                        WHERE local_id = :local AND producto = :p AND semana >= current_date - 84
+                        GROUP BY semana
+                        ORDER BY semana
+                    """, {"local": LOCAL, "p": prod_sem})
+                    st.dataframe(df_sem_p, use_container_width=True)
+
+    # ============================================================
+    # SUBTAB: CONSULTAS LENTAS
+    # ============================================================
+    with sub_slow, seccion("Consultas lentas"):
+        st.markdown("### 🐢 Consultas lentas")
+
+        if not is_admin:
+            st.info("Solo el Admin puede ver las consultas lentas.")
+        else:
+            st.caption(
+                f"Se registran las consultas de más de {SLOW_MS:g} ms con su plan (EXPLAIN ANALYZE). "
+                "Los parámetros se guardan sin valores."
+            )
+
+            df_slow = qdf("""
+                SELECT
+                    huella,
+                    count(*) AS veces,
+                    round(avg(duracion_ms)::numeric) AS ms_prom,
+                    round(max(duracion_ms)::numeric) AS ms_max,
+                    max(creado_en) AS ultima,
+                    min(sql_norm) AS sql
+                FROM consultas_lentas
+                GROUP BY huella
+                ORDER BY ms_max DESC
+                LIMIT 100
+            """)
+
+            if df_slow.empty:
+                st.info("No hay consultas lentas registradas.")
+            else:
+                df_slow["ultima"] = (
+                    pd.to_datetime(df_slow["ultima"], utc=True)
+                    .dt.tz_convert("America/Argentina/Buenos_Aires")
+                    .dt.strftime("%d/%m/%Y %H:%M hs")
+                )
+                st.dataframe(df_slow, use_container_width=True, hide_index=True)
+
+                huella_sel = st.selectbox("Ver plan de", df_slow["huella"].tolist(), key="slow_sel")
+                df_plan = qdf("""
+                    SELECT creado_en, duracion_ms, engine, params, sql_norm, plan
+                    FROM consultas_lentas
+                    WHERE huella = :h
+                    ORDER BY id DESC
+                    LIMIT 1
+                """, {"h": huella_sel})
+                if not df_plan.empty:
+                    fila_plan = df_plan.iloc[0]
+                    st.caption(f"{fila_plan['duracion_ms']:.0f} ms en {fila_plan['engine']} | params: {fila_plan['params']}")
+                    st.code(fila_plan["sql_norm"], language="sql")
+                    st.code(fila_plan["plan"] or "(sin plan)")
+
+            if st.button("🧹 Borrar registro", use_container_width=True, key="btn_slow_clear"):
+                exec_("TRUNCATE TABLE consultas_lentas")
+                st.success("✅ Registro borrado.")
+                st.rerun()
+
+    # ============================================================
+    # SUBTAB: PERFIL DE CORRIDAS
+    # ============================================================
+    with sub_perfil, seccion("Perfil"):
+        st.markdown("### ⏱ Perfil de corridas")
+
+        if not is_admin:
+            st.info("Solo el Admin puede ver el perfil de corridas.")
+        else:
+            st.caption(
+                f"Últimas {PERFIL_CORRIDAS} corridas de este proceso (todas las sesiones), con el tiempo de "
+                "cada sección. SQL es la suma de las consultas de la corrida, incluidas las paralelas."
+            )
+
+            buf_perfil, lock_perfil = perfil_buffer()
+            with lock_perfil:
+                corridas = [c for c in buf_perfil if c is not _perfil][::-1]  # la actual todavía no terminó
+
+            if not corridas:
+                st.info("Todavía no hay corridas registradas.")
+            else:
+                df_corridas = pd.DataFrame([
+                    {
+                        "inicio": c["inicio"],
+                        "usuario": c["usuario"] or "-",
+                        "total_ms": c["total_ms"],
+                        "sql_ms": c["sql_ms"],
+                        "secciones": len(c["secciones"]),
+                        "mas_lenta": max(list(c["secciones"]) or [{"seccion": "-", "dur_ms": 0}], key=lambda x: x["dur_ms"])["seccion"],
+                        "cprofile": c["cprofile"] is not None,
+                    }
+                    for c in corridas
+                ])
+                df_corridas["inicio"] = (
+                    pd.to_datetime(df_corridas["inicio"], utc=True)
+                    .dt.tz_convert("America/Argentina/Buenos_Aires")
+                    .dt.strftime("%d/%m %H:%M:%S")
+                )
+                st.dataframe(df_corridas, use_container_width=True, hide_index=True)
+
+                # Por id y no por posición: cada rerun suma una corrida adelante y corre las demás
+                por_id = {c["id"]: c for c in corridas}
+                etiquetas = {
+                    c["id"]: f"{f['inicio']} · {f['usuario']} · {f['total_ms']:.0f} ms"
+                    for c, f in zip(corridas, df_corridas.to_dict("records"))
+                }
+                id_sel = st.selectbox("Ver corrida", list(por_id), format_func=etiquetas.get, key="perfil_sel")
+                corrida = por_id[id_sel]
+                # list(): copia atómica, la corrida puede seguir en curso en otra sesión
+                df_secc = pd.DataFrame(list(corrida["secciones"]), columns=["seccion", "nivel", "inicio_ms", "dur_ms"])
+                if df_secc.empty:
+                    st.info("La corrida no cerró ninguna sección.")
+                else:
+                    # Línea de tiempo: en el orden en que empezó cada sección, con sangría por anidamiento
+                    df_secc = df_secc.sort_values(["inicio_ms", "nivel"]).reset_index(drop=True)
+                    df_secc["seccion"] = [
+                        f"{i + 1:02d} {'· ' * int(n)}{nombre}"
+                        for i, (n, nombre) in enumerate(zip(df_secc["nivel"], df_secc["seccion"]))
+                    ]
+                    st.bar_chart(df_secc.set_index("seccion")["dur_ms"], horizontal=True, sort=False)
+                    st.dataframe(df_secc, use_container_width=True, hide_index=True)
+
+                if corrida["cprofile"]:
+                    st.markdown("**cProfile (top 40 por tiempo acumulado)**")
+                    st.code(corrida["cprofile"])
+
+                st.download_button(
+                    "⬇️ Exportar corridas (JSON)",
+                    data=json.dumps(corridas, ensure_ascii=False, indent=2).encode("utf-8"),
+                    file_name="perfil_corridas.json",
+                    mime="application/json",
+                    use_container_width=True,
+                    key="perfil_json",
+                )
+
+            if st.button("🔬 Perfilar la próxima corrida con cProfile", use_container_width=True, key="perfil_cprofile"):
+                st.session_state["perfil_cprofile_pedido"] = True
+                st.rerun()
+
     # ============================================================
     # SUBTAB: BACKUP / RESTORE
     # ============================================================
-    with sub_backup:
+    with sub_backup, seccion("Backup"):
         st.subheader("💾 Backup / Restaurar (ZIP CSV)")
 
         if not is_admin:
             st.info("Solo el Admin puede ver y ejecutar backups/restores.")
+            cerrar_corrida()  # fin normal de la corrida para los demás roles
             st.stop()
 
+        st.markdown("### 🗄 Archivar cerrados")
+        st.caption(
+            f"Recibidos/Anulados con más de {ARCHIVO_DIAS} días pasan a faltantes_historico "
+            "(se hace solo una vez por hora; el historial y el backup los siguen viendo)."
+        )
+        if st.button("🗄 Archivar ahora", use_container_width=True, key="btn_archivar"):
+            n_arch = archivar_cerrados(ARCHIVO_DIAS)
+            st.success(f"✅ {n_arch} faltantes archivados.")
+
+        st.divider()
+
         st.markdown("### ⬇️ Descargar backup (ZIP)")
+        st.caption(f"El backup y el restore son del local actual: {LOCAL}.")
 
         if st.button("📦 Generar ZIP de backup", use_container_width=True, key="btn_make_zip"):
-            tables = ["productos", "faltantes", "pedidos", "pedido_items", "movimientos"]
+            tables = ["productos", "productos_par", "faltantes", "faltantes_historico", "pedidos", "pedido_items",
+                      "movimientos"]
             bio = io.BytesIO()
 
             with zipfile.ZipFile(bio, "w", compression=zipfile.ZIP_DEFLATED) as z:
                 for t in tables:
                     try:
-                        df_t = qdf(f"SELECT * FROM {t} ORDER BY 1")
+                        df_t = qdf(f"SELECT * FROM {t} WHERE local_id = :local ORDER BY 1", {"local": LOCAL})
                     except Exception:
                         df_t = pd.DataFrame()
                     z.writestr(f"{t}.csv", df_t.to_csv(index=False))
@@ -1402,7 +4048,7 @@ with tab4:
             st.download_button(
                 "⬇️ Descargar backup_faltantes.zip",
                 data=bio.getvalue(),
-                file_name="backup_faltantes.zip",
+                file_name=f"backup_faltantes_{LOCAL}.zip",
                 mime="application/zip",
                 use_container_width=True,
                 key="dl_zip",
@@ -1415,7 +4061,7 @@ with tab4:
 
         modo = st.radio(
             "Modo de restauración",
-            ["Reemplazar todo (BORRA y carga de cero)", "Agregar (append)"],
+            ["Reemplazar este local (BORRA y carga de cero)", "Agregar (append)"],
             index=0,
             key="restore_mode",
         )
@@ -1438,23 +4084,67 @@ with tab4:
                         return pd.DataFrame()
 
                 df_productos = read_csv("productos.csv")
+                df_par = read_csv("productos_par.csv")
                 df_faltantes = read_csv("faltantes.csv")
+                df_historico = read_csv("faltantes_historico.csv")
                 df_pedidos = read_csv("pedidos.csv")
                 df_pedido_items = read_csv("pedido_items.csv")
                 df_mov = read_csv("movimientos.csv")
 
-            eng = get_engine()
-
-            if modo.startswith("Reemplazar"):
-                exec_(
-                    "TRUNCATE TABLE pedido_items, pedidos, movimientos, faltantes, productos RESTART IDENTITY CASCADE"
-                )
+            tablas = ["pedido_items", "pedidos", "movimientos", "faltantes", "faltantes_historico", "productos_par",
+                      "productos"]
+
+            # Lo restaurado queda en el local actual, aunque el ZIP venga de otro
+            for df_t in (df_productos, df_par, df_faltantes, df_historico, df_pedidos, df_pedido_items, df_mov):
+                if not df_t.empty:
+                    df_t["local_id"] = LOCAL
+
+            # Columnas enum: fuera de la transacción del restore (ALTER TYPE ... ADD VALUE)
+            for t, df_t in [("faltantes", df_faltantes), ("faltantes_historico", df_historico),
+                            ("pedido_items", df_pedido_items), ("movimientos", df_mov), ("productos_par", df_par)]:
+                ampliar_dominios(t, df_t)
+
+            with transaccion() as c:
+                if modo.startswith("Reemplazar"):
+                    # Solo las filas de este local: los demás locales comparten las tablas
+                    for t in tablas:
+                        c.execute(text(f"DELETE FROM {t} WHERE local_id = :local"), {"local": LOCAL})
+
+                # Ids nuevos para todo lo restaurado y referencias traducidas
+                # (faltantes_historico usa los ids de faltantes)
+                existentes = dict(c.execute(
+                    text("SELECT nombre, id FROM productos WHERE local_id = :local"), {"local": LOCAL}
+                ).all())
+                mapa_prod = {}
+                if not df_productos.empty:
+                    # Modo agregar: un producto que ya existe (mismo nombre) no se duplica, se referencia
+                    ya = df_productos["nombre"].isin(existentes)
+                    mapa_prod = {int(i): existentes[n] for i, n in df_productos.loc[ya, ["id", "nombre"]].values}
+                    df_productos = df_productos[~ya].copy()
+                    mapa_prod.update(renumerar(c, "productos", df_productos))
+                mapa_falt = renumerar(c, "faltantes", df_faltantes, df_historico)
+                mapa_ped = renumerar(c, "pedidos", df_pedidos)
+                renumerar(c, "pedido_items", df_pedido_items)
+                renumerar(c, "movimientos", df_mov)
+
+                df_par = traducir_ref(df_par, "producto_id", mapa_prod)
+                if not df_par.empty:
+                    pares = set(c.execute(text("""
+                        SELECT producto_id, sector::text FROM productos_par WHERE local_id = :local
+                    """), {"local": LOCAL}).all())
+                    df_par = df_par[[(int(p), str(s)) not in pares for p, s in zip(df_par["producto_id"], df_par["sector"])]]
+                df_pedido_items = traducir_ref(df_pedido_items, "pedido_id", mapa_ped)
+                df_pedido_items = traducir_ref(df_pedido_items, "faltante_id", mapa_falt, obligatoria=False)
+                df_mov = traducir_ref(df_mov, "faltante_id", mapa_falt)
 
-            with eng.begin() as c:
                 if not df_productos.empty:
                     df_productos.to_sql("productos", c, if_exists="append", index=False, method="multi")
+                if not df_par.empty:
+                    df_par.to_sql("productos_par", c, if_exists="append", index=False, method="multi")
                 if not df_faltantes.empty:
                     df_faltantes.to_sql("faltantes", c, if_exists="append", index=False, method="multi")
+                if not df_historico.empty:
+                    df_historico.to_sql("faltantes_historico", c, if_exists="append", index=False, method="multi")
                 if not df_pedidos.empty:
                     df_pedidos.to_sql("pedidos", c, if_exists="append", index=False, method="multi")
                 if not df_pedido_items.empty:
@@ -1462,5 +4152,13 @@ with tab4:
                 if not df_mov.empty:
                     df_mov.to_sql("movimientos", c, if_exists="append", index=False, method="multi")
 
+                # En la misma transacción: los restaurados quedan sumados y marcados junto con las filas
+                reset_stats(LOCAL, df_mov["id"].tolist() if not df_mov.empty else [])
+            soltar_turno("stats")
+            reset_snapshots(LOCAL)
+
             st.success("✅ Restore completado.")
-            st.rerun()
\ No newline at end of file
+            st.rerun()
+
+
+cerrar_corrida()
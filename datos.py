@@ -0,0 +1,252 @@
+"""
+Acceso a datos compartido por app.py (Streamlit) y api.py (ingesta JSON).
+
+Sin Streamlit: listas de dominios, normalización de lotes y escrituras por conjunto sobre una
+Connection de SQLAlchemy ya abierta (la transacción, el engine y el usuario los pone quien llama).
+"""
+import pandas as pd
+from sqlalchemy import text
+
+LOCAL_DEFAULT = "principal"
+
+# Defaults (siembran los enums, ver DOMINIOS en app.py)
+CATEGORIAS = ["Almacén", "Verdulería", "Fiambre", "Carnicería", "Pescaderia", "Limpieza", "Descartables", "Bebidas",  "Panaderia", "Frezzer", "Enfriado", "Otros"]
+PRIORIDAD = ["Alta", "Media", "Baja"]
+ESTADOS = ["Pendiente", "Pedido", "Recibido", "Anulado"]
+SECTORES = ["Cocina", "Barra", "Salón"]
+UNIDADES = ["und", "caja", "kg", "atado", "lt", "pack", "bolsa"]
+
+
+# ============================================================
+# Lotes de faltantes (carga masiva, conteo, API)
+# ============================================================
+UNIDADES_ALIAS = {
+    "u": "und", "un": "und", "unid": "und", "unidad": "und", "unidades": "und",
+    "cajas": "caja", "kgs": "kg", "kilo": "kg", "kilos": "kg",
+    "atados": "atado", "l": "lt", "lts": "lt", "litro": "lt", "litros": "lt",
+    "packs": "pack", "bolsas": "bolsa",
+}
+
+
+def normalizar_unidad(u) -> str:
+    u = str(u or "").strip().lower()
+    if u in UNIDADES:
+        return u
+    return UNIDADES_ALIAS.get(u, "")
+
+
+def maestro_productos(c, local: str) -> dict:
+    # nombre -> fila del maestro (activos), el prod_map que espera resolver_lote
+    df_prod = pd.read_sql(text("""
+        SELECT nombre, categoria, unidad, proveedor
+        FROM productos
+        WHERE local_id = :local AND activo = true
+        ORDER BY nombre
+    """), c, params={"local": local})
+    return {r["nombre"]: r for _, r in df_prod.iterrows()}
+
+
+def resolver_lote(df: pd.DataFrame, prod_map: dict, unidades=UNIDADES) -> pd.DataFrame:
+    # Matchea contra el maestro sin distinguir mayúsculas; el maestro manda en categoría/unidad.
+    # unidades: etiquetas válidas del enum (pueden ser más que UNIDADES si se ampliaron)
+    df = df.copy()
+    for col in ["unidad", "categoria", "proveedor", "notas"]:
+        if col not in df.columns:
+            df[col] = ""
+    df["producto"] = df["producto"].astype(str).str.strip()
+    df = df[(df["producto"] != "") & (df["cantidad"] > 0)]
+
+    maestro = {str(k).lower(): v for k, v in prod_map.items()}
+    m = df["producto"].str.lower().map(maestro)
+    df["en_maestro"] = m.notna()
+    df["producto"] = [r["nombre"] if isinstance(r, pd.Series) else p for p, r in zip(df["producto"], m)]
+
+    def de_maestro(campo):
+        return m.map(lambda r: (r.get(campo) or "") if isinstance(r, pd.Series) else "")
+
+    unidad = df["unidad"].map(normalizar_unidad)
+    unidad = unidad.where(unidad != "", de_maestro("unidad"))
+    df["unidad"] = unidad.where(unidad.isin(list(unidades)), UNIDADES[0])
+    categoria = de_maestro("categoria")
+    categoria = categoria.where(categoria != "", df["categoria"].astype(str).str.strip())
+    df["categoria"] = categoria.where(categoria.isin(CATEGORIAS), "Otros")
+    proveedor = de_maestro("proveedor")
+    df["proveedor"] = proveedor.where(proveedor != "", df["proveedor"].astype(str).str.strip())
+    return df[["producto", "cantidad", "unidad", "categoria", "proveedor", "notas", "en_maestro"]].reset_index(drop=True)
+
+
+def faltantes_de_conteo(df: pd.DataFrame) -> pd.DataFrame:
+    # df: la planilla de conteo (nombre, categoria, unidad, proveedor, par, abierto) con "hay" cargado.
+    # Una pasada vectorizada: falta = par - hay - abierto (lo ya pedido no se vuelve a pedir).
+    # Sin par o sin contar no genera nada. Devuelve el formato de lote de la carga masiva.
+    contado = df[df["par"].notna() & df["hay"].notna()]
+    falta = (contado["par"] - contado["hay"] - contado["abierto"]).clip(lower=0)
+    contado, falta = contado[falta > 0], falta[falta > 0]
+    return pd.DataFrame({
+        "producto": contado["nombre"],
+        "cantidad": falta,
+        "unidad": contado["unidad"].fillna(""),
+        "categoria": contado["categoria"].fillna(""),
+        "proveedor": contado["proveedor"].fillna(""),
+        "notas": ("Conteo: hay " + contado["hay"].map("{:g}".format).astype(str)
+                  + " / par " + contado["par"].map("{:g}".format).astype(str)),
+    }).reset_index(drop=True)
+
+
+def cruzar_abiertos(planilla: pd.DataFrame, abiertos: pd.DataFrame, unidades=UNIDADES) -> pd.DataFrame:
+    # planilla: productos del maestro (nombre, categoria, unidad, ...); abiertos: producto, categoria,
+    # unidad, abierto de los faltantes en Pendiente/Pedido. Se cruzan con la clave con la que el import
+    # suma a un abierto: producto+categoría+unidad como quedan después de resolver_lote (una unidad
+    # vacía o con alias en el maestro no es la del faltante). Devuelve la planilla con "abierto".
+    planilla = planilla.drop(columns="abierto", errors="ignore")
+    if planilla.empty:
+        return planilla.assign(abierto=pd.Series(dtype="float64"))
+    prod_map = {r["nombre"]: r for _, r in planilla.iterrows()}
+    # El lote como lo arma faltantes_de_conteo: con la unidad del maestro, que resolver_lote normaliza
+    lote = resolver_lote(pd.DataFrame({
+        "producto": planilla["nombre"], "cantidad": 1.0, "unidad": planilla["unidad"].fillna(""),
+    }), prod_map, unidades)
+    clave = lote[["producto", "categoria", "unidad"]].merge(
+        abiertos[["producto", "categoria", "unidad", "abierto"]], on=["producto", "categoria", "unidad"], how="left"
+    )
+    abierto = clave.set_index("producto")["abierto"].astype("float64").fillna(0.0)
+    return planilla.assign(abierto=planilla["nombre"].map(abierto).fillna(0.0).to_numpy())
+
+
+# Todo el lote en una sentencia: alta de productos nuevos, merge con abiertos
+# (misma regla que el formulario: producto+categoría+unidad+sector en Pendiente/Pedido),
+# alta del resto y sus movimientos. Devuelve (sumados, nuevos).
+SQL_IMPORTAR = """
+    WITH lote_raw AS (
+        SELECT * FROM unnest(
+            CAST(:productos AS text[]), CAST(:categorias AS categoria_t[]), CAST(:unidades AS unidad_t[]),
+            CAST(:cantidades AS double precision[]), CAST(:proveedores AS text[]), CAST(:notas AS text[])
+        ) AS t(producto, categoria, unidad, cantidad, proveedor, notas)
+    ), lote AS (
+        SELECT producto, categoria, unidad, sum(cantidad) AS cantidad,
+               max(proveedor) AS proveedor, string_agg(NULLIF(notas, ''), ' / ') AS notas
+        FROM lote_raw
+        GROUP BY producto, categoria, unidad
+    ), prod AS (
+        INSERT INTO productos (local_id, nombre, categoria, unidad, proveedor, activo, creado_en, actualizado_en)
+        SELECT DISTINCT ON (producto) :local, producto, categoria, unidad, proveedor, true, now(), now()
+        FROM lote
+        ORDER BY producto
+        ON CONFLICT (local_id, nombre) DO NOTHING
+    ), abiertos AS (
+        SELECT DISTINCT ON (f.producto, f.categoria, f.unidad) f.id, f.producto, f.categoria, f.unidad
+        FROM faltantes f
+        JOIN lote l USING (producto, categoria, unidad)
+        WHERE f.local_id = :local
+          AND f.sector = :sector
+          AND f.estado IN ('Pendiente','Pedido')
+        ORDER BY f.producto, f.categoria, f.unidad, f.id DESC
+    ), sumados AS (
+        UPDATE faltantes f
+        SET cantidad = COALESCE(f.cantidad, 0) + l.cantidad, version = f.version + 1
+        FROM abiertos a
+        JOIN lote l USING (producto, categoria, unidad)
+        WHERE f.id = a.id
+        RETURNING f.id, l.cantidad AS sumado, f.unidad
+    ), nuevos AS (
+        INSERT INTO faltantes
+        (creado_en, producto, categoria, cantidad, unidad, prioridad, sector, proveedor, estado, notas, local_id)
+        SELECT now(), l.producto, l.categoria, l.cantidad, l.unidad, :prioridad, :sector, l.proveedor,
+               'Pendiente', COALESCE(l.notas, ''), :local
+        FROM lote l
+        WHERE NOT EXISTS (
+            SELECT 1 FROM abiertos a
+            WHERE a.producto = l.producto AND a.categoria = l.categoria AND a.unidad = l.unidad
+        )
+        RETURNING id
+    ), movs AS (
+        INSERT INTO movimientos (usuario, rol, faltante_id, accion, estado_anterior, estado_nuevo, nota, local_id)
+        SELECT :usuario, :rol, id, 'SUMAR_CANTIDAD', NULL::estado_t, NULL::estado_t,
+               '+' || sumado::text || ' ' || unidad, :local FROM sumados
+        UNION ALL
+        SELECT :usuario, :rol, id, 'ALTA', NULL, 'Pendiente', '', :local FROM nuevos
+    )
+    SELECT (SELECT count(*) FROM sumados) AS sumados, (SELECT count(*) FROM nuevos) AS nuevos
+"""
+
+
+def params_lote(df: pd.DataFrame, local: str, sector: str, prioridad: str, usuario, rol) -> dict:
+    # df ya pasado por resolver_lote
+    return {
+        "productos": df["producto"].astype(str).tolist(),
+        "categorias": df["categoria"].astype(str).tolist(),
+        "unidades": df["unidad"].astype(str).tolist(),
+        "cantidades": df["cantidad"].astype(float).tolist(),
+        "proveedores": df["proveedor"].fillna("").astype(str).tolist(),
+        "notas": df["notas"].fillna("").astype(str).tolist(),
+        "local": local,
+        "sector": sector,
+        "prioridad": prioridad,
+        "usuario": usuario,
+        "rol": rol,
+    }
+
+
+def importar_lote(c, params: dict) -> tuple[int, int]:
+    sumados, nuevos = c.execute(text(SQL_IMPORTAR), params).one()
+    return int(sumados), int(nuevos)
+
+
+# ============================================================
+# Cambios de estado por conjunto (journal write-behind, API)
+# ============================================================
+# Los que permite la UI (tarjetas y vista compacta); la API aplica los mismos
+TRANSICIONES = {
+    "Pendiente": {"Pedido", "Recibido", "Anulado"},
+    "Pedido": {"Pedido", "Recibido", "Anulado"},
+    "Recibido": {"Anulado"},
+    "Anulado": set(),
+}
+
+SQL_CAMBIAR_ESTADO = """
+    UPDATE faltantes f
+    SET estado = :estado, version = f.version + 1
+    FROM unnest(CAST(:ids AS bigint[]), CAST(:versiones AS bigint[])) AS v(id, version)
+    WHERE f.id = v.id AND (v.version IS NULL OR f.version = v.version) AND f.local_id = :local
+    RETURNING f.id
+"""
+
+
+def marcar_aplicada(c, clave: str) -> bool:
+    # Registra la clave de idempotencia; False si ya estaba (reintento: no hay que aplicar nada).
+    # Va en la misma transacción que el cambio: si este falla, la clave tampoco queda.
+    return c.execute(
+        text("INSERT INTO journal_aplicado (clave) VALUES (:clave) ON CONFLICT (clave) DO NOTHING RETURNING clave"),
+        {"clave": clave}
+    ).first() is not None
+
+
+def aplicar_entrada(c, p: dict) -> list[int]:
+    # Aplica un cambio de estado (la idempotencia la resuelve quien llama con marcar_aplicada).
+    # Devuelve los ids en conflicto.
+    # p["anteriores"] ({id: estado}, opcional): estado previo real por faltante para el movimiento;
+    # si no está, se registra p["estado_anterior"] para todos.
+    ids = [int(r[0]) for r in c.execute(text(SQL_CAMBIAR_ESTADO), {
+        "estado": p["estado_nuevo"],
+        "ids": p["ids"],
+        "versiones": p.get("versiones") or [None] * len(p["ids"]),  # sin versión: gana el último
+        "local": p.get("local", LOCAL_DEFAULT),
+    })]
+    # creado_en queda en now(): el watermark de stats (max id con creado_en viejo) supone que crece
+    # con el id. La hora en que se encoló el cambio (journal) va en la nota.
+    c.execute(text("""
+        INSERT INTO movimientos (usuario, rol, faltante_id, accion, estado_anterior, estado_nuevo, nota, local_id)
+        SELECT :usuario, :rol, v.fid, :accion, COALESCE(v.ea, :ea), :en, :nota, :local
+        FROM unnest(CAST(:ids AS bigint[]), CAST(:eas AS estado_t[])) AS v(fid, ea)
+    """), {
+        "local": p.get("local", LOCAL_DEFAULT),
+        "usuario": p.get("usuario"),
+        "rol": p.get("rol"),
+        "ids": ids,
+        "eas": [(p.get("anteriores") or {}).get(i) for i in ids],
+        "accion": p["accion"],
+        "ea": p.get("estado_anterior") or None,
+        "en": p["estado_nuevo"],
+        "nota": f"en cola desde {p['ts'][:19].replace('T', ' ')} UTC" if p.get("ts") else "",
+    })
+    return sorted(set(int(i) for i in p["ids"]) - set(ids))
@@ -0,0 +1,295 @@
+"""
+Prueba de carga: N sesiones headless de app.py en paralelo contra un PostgreSQL local.
+
+    python loadtest.py --url postgresql+psycopg2://postgres:@localhost/faltantes_test --sesiones 1,4,8,16
+
+Cada sesión es un AppTest que se loguea con un rol (Admin / Cocina / Barra / Salón) y repite
+flujos reales: Cargar, Pedido desde una tarjeta, Recibir TODO, Guardar pedido y Pend→Pedido.
+Todas las sesiones comparten un mismo "runtime" (caches, script compilado, engine y pool de
+SQLAlchemy), igual que los celulares conectados a un único servidor de Streamlit.
+
+Por nivel de concurrencia informa percentiles de latencia de rerun, espera por conexiones del
+pool, conexiones en uso del pool y conexiones abiertas en PostgreSQL.
+
+OJO: escribe datos de prueba (productos "LT-...") en la base indicada. Usar una base descartable.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from unittest.mock import MagicMock
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool, QueuePool
+
+import streamlit as st
+import streamlit.testing.v1.app_test as app_test
+import streamlit.testing.v1.local_script_runner as local_script_runner
+from streamlit.components.v2.component_manager import BidiComponentManager
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+
+USUARIOS = [
+    {"user": "lt_admin", "pass": "lt", "role": "Admin"},
+    {"user": "lt_cocina", "pass": "lt", "role": "Cocina"},
+    {"user": "lt_barra", "pass": "lt", "role": "Barra"},
+    {"user": "lt_salon", "pass": "lt", "role": "Salón"},
+]
+BOTON_GUARDAR = "FormSubmitter:form_faltante-💾 Guardar"
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+# ============================================================
+# Un solo runtime para todas las sesiones (como un servidor real)
+# ============================================================
+class _RuntimeCompartido:
+    # AppTest pone y saca Runtime._instance en cada corrida; con sesiones en paralelo eso
+    # rompe a las demás. Sus asignaciones caen acá y el runtime real queda fijo.
+    _instance = None
+
+
+def preparar_runtime(url: str):
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    runtime.dataframe_source_mgr = DataframeSourceManager()
+    componentes = BidiComponentManager()
+    componentes.discover_and_register_components(start_file_watching=False)
+    runtime.bidi_component_registry = componentes
+    Runtime._instance = runtime
+    app_test.Runtime = _RuntimeCompartido
+
+    # Un ScriptCache compartido: compilar app.py en paralelo rompe ast.parse en CPython
+    script_cache = ScriptCache()
+    app_test.ScriptCache = lambda: script_cache
+    local_script_runner.ScriptCache = lambda: script_cache
+
+    # Secrets globales fijos: si cada AppTest trae los suyos, los cambia y restaura por corrida
+    secrets = Secrets()
+    secrets._secrets = {"db": {"url": url}, "auth": {"users": USUARIOS}}
+    st.secrets = secrets
+
+
+# ============================================================
+# Métricas
+# ============================================================
+class Metricas:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reruns: list[float] = []
+        self.por_accion: dict[str, list[float]] = {}
+        self.esperas_pool: list[float] = []
+        self.errores: list[str] = []
+        self.pool_max = 0
+        self.conexiones_db_max = 0
+        self.conexiones_activas_max = 0
+
+    def rerun(self, accion: str, seg: float):
+        with self.lock:
+            self.reruns.append(seg)
+            self.por_accion.setdefault(accion, []).append(seg)
+
+    def error(self, msg: str):
+        with self.lock:
+            self.errores.append(msg)
+
+
+METRICAS = Metricas()
+_POOLS: list[QueuePool] = []
+
+
+def instrumentar_pool():
+    # Mide cuánto espera cada checkout del pool (incluye abrir conexión nueva)
+    do_get = QueuePool._do_get
+    init = QueuePool.__init__
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return do_get(self)
+        finally:
+            with METRICAS.lock:
+                METRICAS.esperas_pool.append(time.perf_counter() - t0)
+
+    def __init__(self, *a, **kw):
+        init(self, *a, **kw)
+        _POOLS.append(self)
+
+    QueuePool._do_get = _do_get
+    QueuePool.__init__ = __init__
+
+
+def muestrear(url: str, parar: threading.Event, cada: float = 0.25):
+    engine = create_engine(url, poolclass=NullPool)
+    with engine.connect() as c:
+        while not parar.is_set():
+            fila = c.execute(text("""
+                SELECT count(*), count(*) FILTER (WHERE state = 'active')
+                FROM pg_stat_activity
+                WHERE datname = current_database() AND pid <> pg_backend_pid()
+            """)).one()
+            en_uso = sum(p.checkedout() for p in list(_POOLS))
+            with METRICAS.lock:
+                METRICAS.conexiones_db_max = max(METRICAS.conexiones_db_max, int(fila[0]))
+                METRICAS.conexiones_activas_max = max(METRICAS.conexiones_activas_max, int(fila[1]))
+                METRICAS.pool_max = max(METRICAS.pool_max, en_uso)
+            c.rollback()
+            parar.wait(cada)
+    engine.dispose()
+
+
+def percentil(valores: list[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    v = sorted(valores)
+    return v[min(len(v) - 1, int(round(p / 100 * (len(v) - 1))))]
+
+
+# ============================================================
+# Sesiones
+# ============================================================
+def correr(at: AppTest, accion: str) -> AppTest:
+    t0 = time.perf_counter()
+    at.run()
+    METRICAS.rerun(accion, time.perf_counter() - t0)
+    if at.exception:
+        METRICAS.error(f"{accion}: {at.exception[0].value}")
+    return at
+
+
+def botones(at: AppTest, prefijo: str) -> list:
+    return [b for b in at.button if (b.key or "").startswith(prefijo) and not b.disabled]
+
+
+def sesion(n: int, usuario: dict, acciones: int, pausa: float, timeout: float):
+    rnd = random.Random(n)
+    try:
+        at = AppTest.from_file(APP, default_timeout=timeout)
+        correr(at, "inicio")
+        at.text_input(key="login_user").input(usuario["user"])
+        at.text_input(key="login_pass").input(usuario["pass"])
+        at.button(key="login_btn").click()
+        correr(at, "login")
+
+        for i in range(acciones):
+            time.sleep(rnd.uniform(0, pausa))
+            if usuario["role"] == "Admin":
+                accion = rnd.choice(["recibir_todo", "guardar_pedido", "pend_a_pedido", "refrescar"])
+            else:
+                accion = rnd.choice(["cargar", "cargar", "pedido", "refrescar"])
+
+            if accion == "cargar":
+                at.text_input(key="c_prod_new").input(f"LT-{rnd.randint(1, 40)}")
+                at.button(key=BOTON_GUARDAR).click()
+            elif accion == "pedido" and botones(at, "card_ped_"):
+                rnd.choice(botones(at, "card_ped_")).click()
+            elif accion == "recibir_todo" and botones(at, "btn_recibir_todo"):
+                at.button(key="btn_recibir_todo").click()
+            elif accion == "guardar_pedido" and botones(at, "wp_guardar"):
+                at.button(key="wp_guardar").click()
+            elif accion == "pend_a_pedido" and botones(at, "wp_btn_marcar"):
+                at.button(key="wp_btn_marcar").click()
+            else:
+                accion = "refrescar"
+            correr(at, accion)
+    except Exception as e:
+        METRICAS.error(f"sesión {n}: {type(e).__name__}: {e}")
+
+
+def nivel(url: str, n_sesiones: int, acciones: int, pausa: float, timeout: float) -> dict:
+    global METRICAS
+    METRICAS = Metricas()
+    parar = threading.Event()
+    sampler = threading.Thread(target=muestrear, args=(url, parar), daemon=True)
+    sampler.start()
+
+    t0 = time.perf_counter()
+    hilos = [
+        threading.Thread(
+            target=sesion,
+            args=(i, USUARIOS[i % len(USUARIOS)], acciones, pausa, timeout),
+            name=f"sesion-{i}",
+        )
+        for i in range(n_sesiones)
+    ]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    duracion = time.perf_counter() - t0
+    parar.set()
+    sampler.join()
+
+    m = METRICAS
+    return {
+        "sesiones": n_sesiones,
+        "reruns": len(m.reruns),
+        "reruns_por_seg": round(len(m.reruns) / duracion, 2) if duracion else 0,
+        "errores": len(m.errores),
+        "rerun_ms": {p: round(percentil(m.reruns, p) * 1000) for p in (50, 90, 99)},
+        "rerun_max_ms": round(max(m.reruns, default=0) * 1000),
+        "por_accion_p50_ms": {
+            a: round(statistics.median(v) * 1000) for a, v in sorted(m.por_accion.items())
+        },
+        "pool_espera_ms": {p: round(percentil(m.esperas_pool, p) * 1000, 1) for p in (50, 99)},
+        "pool_espera_max_ms": round(max(m.esperas_pool, default=0) * 1000, 1),
+        "pool_en_uso_max": m.pool_max,
+        "conexiones_db_max": m.conexiones_db_max,
+        "conexiones_activas_max": m.conexiones_activas_max,
+        "primeros_errores": m.errores[:5],
+    }
+
+
+def imprimir(resultados: list[dict]):
+    cab = f"{'ses':>4} {'reruns':>6} {'r/s':>6} {'err':>4} {'p50':>6} {'p90':>6} {'p99':>6} {'max':>6} " \
+          f"{'pool p99':>9} {'pool max':>9} {'pool uso':>8} {'conex db':>8}"
+    print(cab)
+    print("-" * len(cab))
+    for r in resultados:
+        print(
+            f"{r['sesiones']:>4} {r['reruns']:>6} {r['reruns_por_seg']:>6} {r['errores']:>4} "
+            f"{r['rerun_ms'][50]:>6} {r['rerun_ms'][90]:>6} {r['rerun_ms'][99]:>6} {r['rerun_max_ms']:>6} "
+            f"{r['pool_espera_ms'][99]:>9} {r['pool_espera_max_ms']:>9} {r['pool_en_uso_max']:>8} "
+            f"{r['conexiones_db_max']:>8}"
+        )
+    print("(tiempos en ms)")
+    for r in resultados:
+        for e in r["primeros_errores"]:
+            print(f"  [{r['sesiones']} ses] {e}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Prueba de carga de app.py con sesiones AppTest concurrentes")
+    ap.add_argument("--url", required=True, help="URL SQLAlchemy de un PostgreSQL de prueba")
+    ap.add_argument("--sesiones", default="1,4,8,16", help="niveles de concurrencia, separados por coma")
+    ap.add_argument("--acciones", type=int, default=15, help="acciones por sesión en cada nivel")
+    ap.add_argument("--pausa", type=float, default=0.5, help="pausa máxima entre acciones (seg)")
+    ap.add_argument("--timeout", type=float, default=120, help="timeout por rerun (seg)")
+    ap.add_argument("--json", help="guardar los resultados en este archivo")
+    args = ap.parse_args()
+
+    preparar_runtime(args.url)
+    instrumentar_pool()
+
+    resultados = []
+    for n in [int(x) for x in args.sesiones.split(",") if x.strip()]:
+        print(f"→ {n} sesiones...", flush=True)
+        resultados.append(nivel(args.url, n, args.acciones, args.pausa, args.timeout))
+
+    imprimir(resultados)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
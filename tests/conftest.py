@@ -0,0 +1,5 @@
+# Los módulos de la app están en la raíz del repo (no es un paquete instalable)
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,215 @@
+import pandas as pd
+import pytest
+
+from datos import UNIDADES, cruzar_abiertos, faltantes_de_conteo, normalizar_unidad, resolver_lote
+
+COLUMNAS_LOTE = ["producto", "cantidad", "unidad", "categoria", "proveedor", "notas"]
+
+
+def planilla(filas: list[dict]) -> pd.DataFrame:
+    # Mismo formato que planilla_conteo() + la columna "hay" del data_editor
+    cols = ["id", "nombre", "categoria", "unidad", "proveedor", "par", "abierto", "hay"]
+    df = pd.DataFrame(filas, columns=cols)
+    return df.astype({"par": "float64", "abierto": "float64", "hay": "float64"})
+
+
+def maestro(filas: list[dict]) -> dict:
+    # Como maestro_productos(): nombre -> fila
+    df = pd.DataFrame(filas, columns=["nombre", "categoria", "unidad", "proveedor"])
+    return {r["nombre"]: r for _, r in df.iterrows()}
+
+
+# ============================================================
+# normalizar_unidad
+# ============================================================
+@pytest.mark.parametrize("entrada, esperada", [
+    ("kg", "kg"),
+    ("  KG ", "kg"),
+    ("Kilos", "kg"),
+    ("u", "und"),
+    ("Unidades", "und"),
+    ("L", "lt"),
+    ("litros", "lt"),
+    ("cajas", "caja"),
+    ("bolsas", "bolsa"),
+])
+def test_normalizar_unidad_alias(entrada, esperada):
+    assert normalizar_unidad(entrada) == esperada
+
+
+@pytest.mark.parametrize("entrada", ["", None, "docena", float("nan")])
+def test_normalizar_unidad_desconocida(entrada):
+    # NaN: celda vacía de un CSV
+    assert normalizar_unidad(entrada) == ""
+
+
+def test_normalizar_unidad_todas_las_validas():
+    assert [normalizar_unidad(u) for u in UNIDADES] == UNIDADES
+
+
+# ============================================================
+# faltantes_de_conteo
+# ============================================================
+def test_conteo_vacio():
+    lote = faltantes_de_conteo(planilla([]))
+    assert lote.empty
+    assert list(lote.columns) == COLUMNAS_LOTE
+
+
+def test_conteo_sin_par_no_genera():
+    lote = faltantes_de_conteo(planilla([
+        {"id": 1, "nombre": "Leche", "categoria": "Bebidas", "unidad": "lt", "proveedor": "",
+         "par": None, "abierto": 0, "hay": 0},
+    ]))
+    assert lote.empty
+
+
+def test_conteo_sin_contar_no_genera():
+    lote = faltantes_de_conteo(planilla([
+        {"id": 1, "nombre": "Leche", "categoria": "Bebidas", "unidad": "lt", "proveedor": "",
+         "par": 10, "abierto": 0, "hay": None},
+    ]))
+    assert lote.empty
+
+
+def test_conteo_nada_bajo_par():
+    lote = faltantes_de_conteo(planilla([
+        {"id": 1, "nombre": "Leche", "categoria": "Bebidas", "unidad": "lt", "proveedor": "",
+         "par": 10, "abierto": 0, "hay": 12},
+    ]))
+    assert lote.empty
+    assert list(lote.columns) == COLUMNAS_LOTE
+
+
+def test_conteo_falta_par_menos_hay():
+    lote = faltantes_de_conteo(planilla([
+        {"id": 1, "nombre": "Leche", "categoria": "Bebidas", "unidad": "lt", "proveedor": "Lácteos SA",
+         "par": 10, "abierto": 0, "hay": 4},
+        {"id": 2, "nombre": "Soda", "categoria": "Bebidas", "unidad": "und", "proveedor": None,
+         "par": 6, "abierto": 0, "hay": 6},
+    ]))
+    assert lote.to_dict("records") == [{
+        "producto": "Leche", "cantidad": 6.0, "unidad": "lt", "categoria": "Bebidas",
+        "proveedor": "Lácteos SA", "notas": "Conteo: hay 4 / par 10",
+    }]
+
+
+def test_conteo_descuenta_lo_ya_abierto():
+    lote = faltantes_de_conteo(planilla([
+        {"id": 1, "nombre": "Leche", "categoria": "Bebidas", "unidad": "lt", "proveedor": "",
+         "par": 10, "abierto": 3, "hay": 4},
+        {"id": 2, "nombre": "Soda", "categoria": "Bebidas", "unidad": "und", "proveedor": "",
+         "par": 6, "abierto": 5, "hay": 2},
+    ]))
+    assert lote[["producto", "cantidad"]].values.tolist() == [["Leche", 3.0]]
+
+
+def test_conteo_indice_desde_cero():
+    lote = faltantes_de_conteo(planilla([
+        {"id": 1, "nombre": "A", "categoria": "Otros", "unidad": "und", "proveedor": "",
+         "par": 1, "abierto": 0, "hay": 5},
+        {"id": 2, "nombre": "B", "categoria": "Otros", "unidad": "und", "proveedor": "",
+         "par": 2.5, "abierto": 0, "hay": 1},
+    ]))
+    assert list(lote.index) == [0]
+    assert lote.loc[0, "notas"] == "Conteo: hay 1 / par 2.5"
+
+
+# ============================================================
+# cruzar_abiertos
+# ============================================================
+def productos(filas: list[dict]) -> pd.DataFrame:
+    # Como planilla_conteo() antes de cruzar lo abierto
+    return pd.DataFrame(filas, columns=["id", "nombre", "categoria", "unidad", "proveedor", "par"])
+
+
+def abiertos(filas: list[tuple]) -> pd.DataFrame:
+    return pd.DataFrame(filas, columns=["producto", "categoria", "unidad", "abierto"])
+
+
+def test_abiertos_misma_clave():
+    df = cruzar_abiertos(
+        productos([{"id": 1, "nombre": "Leche", "categoria": "Bebidas", "unidad": "lt", "proveedor": "", "par": 10}]),
+        abiertos([("Leche", "Bebidas", "lt", 3.0), ("Leche", "Bebidas", "kg", 5.0)]),
+    )
+    assert df["abierto"].tolist() == [3.0]
+
+
+def test_abiertos_unidad_del_maestro_normalizada():
+    # Alias, vacía o NULL en el maestro: el faltante se cargó con la unidad normalizada / por defecto
+    df = cruzar_abiertos(
+        productos([
+            {"id": 1, "nombre": "Leche", "categoria": "Bebidas", "unidad": "Litros", "proveedor": "", "par": 10},
+            {"id": 2, "nombre": "Soda", "categoria": "Bebidas", "unidad": "", "proveedor": "", "par": 6},
+            {"id": 3, "nombre": "Pan", "categoria": "Panaderia", "unidad": None, "proveedor": "", "par": 4},
+        ]),
+        abiertos([("Leche", "Bebidas", "lt", 3.0), ("Soda", "Bebidas", UNIDADES[0], 2.0),
+                  ("Pan", "Panaderia", UNIDADES[0], 1.0)]),
+    )
+    assert df["abierto"].tolist() == [3.0, 2.0, 1.0]
+
+
+def test_abiertos_sin_abiertos():
+    df = cruzar_abiertos(
+        productos([{"id": 1, "nombre": "Leche", "categoria": "Bebidas", "unidad": "lt", "proveedor": "", "par": 10}]),
+        abiertos([]),
+    )
+    assert df["abierto"].tolist() == [0.0]
+    assert list(df.columns) == ["id", "nombre", "categoria", "unidad", "proveedor", "par", "abierto"]
+
+
+def test_abiertos_planilla_vacia():
+    df = cruzar_abiertos(productos([]), abiertos([("Leche", "Bebidas", "lt", 3.0)]))
+    assert df.empty
+    assert "abierto" in df.columns
+
+
+# ============================================================
+# resolver_lote
+# ============================================================
+def test_resolver_lote_vacio():
+    df = pd.DataFrame({"producto": pd.Series([], dtype=str), "cantidad": pd.Series([], dtype=float)})
+    lote = resolver_lote(df, {})
+    assert lote.empty
+    assert list(lote.columns) == COLUMNAS_LOTE + ["en_maestro"]
+
+
+def test_resolver_lote_descarta_sin_producto_o_sin_cantidad():
+    df = pd.DataFrame({"producto": ["Leche", " ", "Soda", "Pan"], "cantidad": [1, 2, 0, -1]})
+    lote = resolver_lote(df, {})
+    assert lote["producto"].tolist() == ["Leche"]
+
+
+def test_resolver_lote_el_maestro_manda():
+    prod_map = maestro([{"nombre": "Leche Entera", "categoria": "Bebidas", "unidad": "lt", "proveedor": "Lácteos SA"}])
+    df = pd.DataFrame({"producto": ["  leche entera "], "cantidad": [2.0], "unidad": [""],
+                       "categoria": ["Almacén"], "proveedor": [""]})
+    fila = resolver_lote(df, prod_map).iloc[0]
+    assert fila["producto"] == "Leche Entera"
+    assert fila["categoria"] == "Bebidas"
+    assert fila["unidad"] == "lt"
+    assert fila["proveedor"] == "Lácteos SA"
+    assert bool(fila["en_maestro"])
+
+
+def test_resolver_lote_unidad_del_lote_con_alias():
+    prod_map = maestro([{"nombre": "Papa", "categoria": "Verdulería", "unidad": "kg", "proveedor": ""}])
+    df = pd.DataFrame({"producto": ["Papa", "Agua"], "cantidad": [1.0, 3.0], "unidad": ["bolsas", "Litros"]})
+    lote = resolver_lote(df, prod_map)
+    assert lote["unidad"].tolist() == ["bolsa", "lt"]
+
+
+def test_resolver_lote_fuera_del_maestro():
+    df = pd.DataFrame({"producto": ["Cosa"], "cantidad": [1.0], "unidad": ["docena"],
+                       "categoria": ["Inventada"], "proveedor": [" Prov "]})
+    fila = resolver_lote(df, {}).iloc[0]
+    assert fila["unidad"] == UNIDADES[0]
+    assert fila["categoria"] == "Otros"
+    assert fila["proveedor"] == "Prov"
+    assert not bool(fila["en_maestro"])
+
+
+def test_resolver_lote_unidades_del_enum():
+    # Una unidad que no está en el enum (aunque tenga alias) cae a la por defecto
+    df = pd.DataFrame({"producto": ["Agua"], "cantidad": [1.0], "unidad": ["litros"]})
+    assert resolver_lote(df, {}, unidades=["und", "kg"])["unidad"].tolist() == [UNIDADES[0]]